@@ -0,0 +1,190 @@
+"""
+Scalability benchmarks of AWS API paths
+
+Seeds a moto mocked CloudFormation account with many stacks, a stack with a
+deep event history and a stack with many resources, then measures the wall
+time and AWS API requests of the code paths behind stacks subcommands and
+lookups. Results are appended to a json lines history file and compared to
+the last run at the same scale, so scaling regressions show up before they
+reach production accounts.
+
+  python -m benchmarks.api --stacks 2000 --events 1000 --resources 200
+
+Exits with 1 if a benchmark makes more API requests than the last run or
+takes more than --tolerance times as long.
+"""
+import sys
+import json
+import time
+import argparse
+import platform
+
+from datetime import datetime
+
+from moto import mock_cloudformation_deprecated
+from moto.cloudformation.models import cloudformation_backends, FakeEvent
+from tabulate import tabulate
+
+from stacks import aws
+from stacks import cf
+from stacks import metrics
+from stacks import __about__
+from stacks.backend import Backend, SERVICES
+
+REGION = 'us-east-1'
+PREFIX = 'bench-'
+DEEP_STACK = PREFIX + 'events'
+BIG_STACK = PREFIX + 'resources'
+HISTORY = 'benchmarks/history.jsonl'
+
+
+class MotoBackend(Backend):
+    """Connections to moto's mocked AWS, which takes any credentials"""
+
+    def new_connection(self, service, region, profile=None):
+        conn = SERVICES[service].connect_to_region(region, aws_access_key_id='bench', aws_secret_access_key='bench')
+        return metrics.instrument(conn, service)
+
+
+def seed(stacks, events, resources, region=REGION):
+    """Create stacks in the mocked account of a region"""
+    backend = cloudformation_backends[region]
+    for n in range(stacks):
+        backend.create_stack(PREFIX + str(n), _template(1, 'Out', PREFIX + str(n) + '-Out'), {}, region)
+
+    backend.create_stack(BIG_STACK, _template(resources, 'Out'), {}, region)
+
+    deep = backend.create_stack(DEEP_STACK, _template(1, 'Out'), {}, region)
+    for n in range(events):
+        status = 'UPDATE_IN_PROGRESS' if n % 2 == 0 else 'UPDATE_COMPLETE'
+        deep.events.append(FakeEvent(deep.stack_id, DEEP_STACK, 'Handle{}'.format(n % 50), 'handle-{}'.format(n % 50),
+                                     'AWS::CloudFormation::WaitConditionHandle', status))
+
+
+def benchmarks(stacks):
+    """Return a list of (name, function of a CloudFormation connection) pairs"""
+    last = PREFIX + str(stacks - 1)
+
+    def get_export(conn):
+        aws.reset_exports()
+        return aws.get_export(conn, last + '-Out')
+
+    return [
+        ('list', lambda conn: cf.get_stacks(conn)),
+        ('list --limit 10', lambda conn: cf.get_stacks(conn, limit=10)),
+        ('status', lambda conn: cf.get_stack_status(conn, last)),
+        ('outputs --pattern', lambda conn: cf.get_all_outputs(conn, PREFIX + '1*')),
+        ('events --lines 100', lambda conn: cf.tail_events(conn, DEEP_STACK, 100)),
+        ('resources', lambda conn: cf.get_resources(conn, BIG_STACK)),
+        ('get_stack_output', lambda conn: aws.get_stack_output(conn, last, 'Out')),
+        ('get_stack_resource', lambda conn: aws.get_stack_resource(conn, BIG_STACK, 'Handle0')),
+        ('get_export', get_export),
+    ]
+
+
+def measure(conn, func, repeat=3):
+    """Return a tuple of the best wall time of func and the API requests it makes"""
+    best = None
+    requests = 0
+    for _ in range(repeat):
+        metrics.reset()
+        start = time.perf_counter()
+        func(conn)
+        elapsed = time.perf_counter() - start
+        requests = sum(v for _, _, v in metrics.counter('stacks_aws_requests', 'AWS API requests').samples())
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best, 4), requests
+
+
+def run(stacks, events, resources, repeat=3):
+    """Seed a mocked account and return a list of result dicts"""
+    with mock_cloudformation_deprecated():
+        seed(stacks, events, resources)
+        backend = MotoBackend()
+        conn = backend.client('cloudformation', REGION)
+        try:
+            results = []
+            for name, func in benchmarks(stacks):
+                seconds, requests = measure(conn, func, repeat)
+                results.append({'benchmark': name, 'seconds': seconds, 'requests': requests})
+            return results
+        finally:
+            backend.close()
+
+
+def load_history(fname):
+    """Return the list of recorded runs, oldest first"""
+    try:
+        with open(fname) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except OSError:
+        return []
+
+
+def record(fname, run_info):
+    """Append a run to the history file"""
+    with open(fname, 'a') as f:
+        f.write(json.dumps(run_info, sort_keys=True) + '\n')
+
+
+def regressions(results, previous, tolerance=1.5):
+    """Return a list of (benchmark, reason) tuples of results worse than previous"""
+    before = {r['benchmark']: r for r in previous['results']} if previous else {}
+    found = []
+    for r in results:
+        b = before.get(r['benchmark'])
+        if not b:
+            continue
+        if r['requests'] > b['requests']:
+            found.append((r['benchmark'], 'requests {} -> {}'.format(b['requests'], r['requests'])))
+        elif r['seconds'] > b['seconds'] * tolerance:
+            found.append((r['benchmark'], 'seconds {} -> {}'.format(b['seconds'], r['seconds'])))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark stacks AWS API paths against a mocked account')
+    parser.add_argument('--stacks', type=int, default=2000, help='Number of stacks in the account')
+    parser.add_argument('--events', type=int, default=1000, help='Number of events of the deep history stack')
+    parser.add_argument('--resources', type=int, default=200, help='Number of resources of the big stack')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per benchmark, the fastest is kept')
+    parser.add_argument('--history', default=HISTORY, help='Json lines file results are appended to')
+    parser.add_argument('--no-record', dest='record', action='store_false', help='Do not append results')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='Slowdown factor over the last run reported as a regression')
+    args = parser.parse_args(argv)
+
+    results = run(args.stacks, args.events, args.resources, args.repeat)
+    scale = {'stacks': args.stacks, 'events': args.events, 'resources': args.resources}
+    previous = [r for r in load_history(args.history) if r['scale'] == scale]
+    found = regressions(results, previous[-1] if previous else None, args.tolerance)
+
+    print(tabulate([[r['benchmark'], r['seconds'], r['requests']] for r in results],
+                   headers=['benchmark', 'seconds', 'requests'], tablefmt='plain'))
+    for name, reason in found:
+        print('Regression: {}: {}'.format(name, reason))
+
+    if args.record:
+        record(args.history, {
+            'timestamp': datetime.utcnow().isoformat(),
+            'version': __about__.__version__,
+            'python': platform.python_version(),
+            'scale': scale,
+            'results': results,
+        })
+    return 1 if found else 0
+
+
+def _template(resources, output, export=None):
+    output_def = {'Value': 'value-{}'.format(export or output)}
+    if export:
+        output_def['Export'] = {'Name': export}
+    return json.dumps({
+        'Resources': {'Handle{}'.format(n): {'Type': 'AWS::CloudFormation::WaitConditionHandle'}
+                      for n in range(resources)},
+        'Outputs': {output: output_def},
+    })
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,7 +11,7 @@ install_requires = [
     'awscli>=1.11.130',
     'configargparse>=0.9.3',
     'PyYAML>=3.11',
-    'Jinja2>=2.7.3',
+    'Jinja2>=2.9',
     'boto>=2.40.0',
     'tabulate>=0.7.5',
     'setuptools',
@@ -29,7 +29,7 @@ config = {
     'version': about['__version__'],
     'maintainer': about['__maintainer__'],
     'maintainer_email': about['__maintainer_email__'],
-    'packages': find_packages(),
+    'packages': find_packages(exclude=['benchmarks']),
     'install_requires': install_requires,
     'tests_require': tests_require,
     'entry_points': {
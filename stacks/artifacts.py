@@ -0,0 +1,154 @@
+"""
+Content-addressed cache of rendered templates
+
+Rendered templates are stored under a hash of everything their rendering
+depends on: the template source and the snippets it includes, the config and
+the values returned by lookups. Lookup values are only known once a template
+is rendered, so a manifest keyed by the source and config hash lists the
+lookups made. On a later run these lookups are resolved again, concurrently,
+and if an artifact exists for the values they return it is used as is,
+without rendering the template at all.
+"""
+import json
+import hashlib
+import threading
+
+import boto.connection
+
+from jinja2 import meta
+
+from stacks import cache
+from stacks import lookups
+from stacks import __about__
+from stacks.backend import PooledClient
+from stacks.config import LazyValue, MEMO_KEY
+
+ARTIFACTS_DIR = 'artifacts'
+
+
+def source_key(env, tpl_name, config):
+    """Return a hash of a template, the templates it includes and config
+
+    Return None if the template includes templates by a dynamic name, which
+    cannot be known without rendering it.
+    """
+    sources = _sources(env, tpl_name)
+    if sources is None:
+        return None
+    h = hashlib.sha256()
+    h.update(__about__.__version__.encode())
+    for name in sorted(sources):
+        h.update(json.dumps([name, sources[name]]).encode())
+    try:
+        values = dict((k, v) for k, v in config.items() if k != MEMO_KEY)
+        h.update(json.dumps(values, sort_keys=True, default=_fingerprint).encode())
+    except (TypeError, ValueError):
+        return None
+    return h.hexdigest()
+
+
+def load(key, config, workers=lookups.DEFAULT_WORKERS):
+    """Return a cached artifact or None
+
+    The lookups listed in the manifest of key are resolved again, a lookup
+    failing is a cache miss.
+    """
+    manifest = cache.load_json(cache.cache_path(ARTIFACTS_DIR, 'manifests', key + '.json'))
+    if manifest is None:
+        return None
+    calls = {}
+    for name, conn_key, args in manifest['lookups']:
+        if not callable(config.get(name)):
+            return None
+        calls[(name, config.get(conn_key)) + _hashable(args)] = config[name]
+    results = lookups.resolve_lookups(calls, workers)
+    if any(err for _, err in results.values()):
+        return None
+    values = [results[call][0] for call in calls]
+    return cache.load_json(cache.cache_path(ARTIFACTS_DIR, _artifact_key(key, values) + '.json'))
+
+
+def save(key, recorded, artifact):
+    """Store an artifact and the lookups made rendering it"""
+    recorded = sorted(recorded, key=lambda call: json.dumps(call[:3], default=str))
+    calls = [[name, conn_key, args] for name, conn_key, args, _ in recorded]
+    values = [value for _, _, _, value in recorded]
+    cache.save_json(cache.cache_path(ARTIFACTS_DIR, 'manifests', key + '.json'), {'lookups': calls})
+    cache.save_json(cache.cache_path(ARTIFACTS_DIR, _artifact_key(key, values) + '.json'), artifact)
+
+
+def recording_context(config, recorded):
+    """Return a copy of config with lookup helpers recording their calls
+
+    Each distinct call is appended to recorded as a (helper name, connection
+    config key, args, value) tuple.
+    """
+    lock = threading.Lock()
+    seen = set()
+
+    def recorder(name, func):
+        def record(conn, args, value):
+            conn_key = next((k for k, v in config.items() if v is conn and k.endswith('_conn')), None)
+            call = (name, conn_key, list(args))
+            key = json.dumps(call, default=str)
+            with lock:
+                if key not in seen:
+                    seen.add(key)
+                    recorded.append(call + (value,))
+
+        def lookup(conn, *args):
+            value = func(conn, *args)
+            record(conn, args, value)
+            return value
+        # Lookups resolved ahead of a render, see stacks.lookups, may call the
+        # original helper and report their values to record instead
+        lookup.__wrapped__ = func
+        lookup.record = record
+        return lookup
+
+    context = dict(config)
+    # Lazy lookups evaluated by earlier renders of the run have to be made
+    # again to be recorded
+    context[MEMO_KEY] = {}
+    for name in lookups._helpers(config):
+        context[name] = recorder(name, config[name])
+    return context
+
+
+def _artifact_key(key, values):
+    return hashlib.sha256(json.dumps([key, values], default=str).encode()).hexdigest()
+
+
+def _hashable(args):
+    return tuple(_hashable(a) if isinstance(a, list) else a for a in args)
+
+
+def _sources(env, tpl_name):
+    """Return a dict of sources of a template and all templates it includes"""
+    sources = {}
+    pending = [tpl_name]
+    while pending:
+        name = pending.pop()
+        if name in sources:
+            continue
+        source, _, _ = env.loader.get_source(env, name)
+        sources[name] = source
+        for ref in meta.find_referenced_templates(env.parse(source)):
+            if ref is None:
+                return None
+            pending.append(ref)
+    return sources
+
+
+def _fingerprint(value):
+    """Return a stable json serializable stand-in for a config value"""
+    if isinstance(value, LazyValue):
+        if value.tag == '!env' and not any(isinstance(a, LazyValue) for a in value.args):
+            return [str(value), value.resolve({})]
+        return str(value)
+    # Connections and lookup helpers are accounted for by the lookups made
+    if callable(value) or isinstance(value, (PooledClient, boto.connection.AWSAuthConnection)):
+        return type(value).__name__
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    return repr(value)
@@ -1,7 +1,48 @@
 import time
+import logging
+import threading
+import weakref
 
 from boto.exception import BotoServerError
 
+from stacks import cache
+from stacks import cassette
+from stacks import metrics
+from stacks.exceptions import LookupFailedError
+
+log = logging.getLogger(__name__)
+
+# Seconds the exports index is kept in the cache across runs, 0 keeps it for
+# the current run only
+EXPORTS_TTL = 0
+
+_exports_lock = threading.Lock()
+_exports = weakref.WeakKeyDictionary()
+
+
+def pause(seconds):
+    """Sleep between AWS API calls, unless replaying recorded responses"""
+    if not cassette.replaying():
+        time.sleep(seconds)
+
+
+class RateLimiter(object):
+    """Space out API calls shared by threads to at most rate calls per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = 0
+
+    def wait(self):
+        """Pause until the next call is allowed"""
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            pause(delay)
+
 
 def throttling_retry(func):
     """Retry when AWS is throttling API calls"""
@@ -9,13 +50,15 @@ def throttling_retry(func):
         retries = 0
         while True:
             try:
-                retval = func(*args)
+                retval = func(*args, **kwargs)
                 return retval
             except BotoServerError as err:
                 if (err.code == 'Throttling' or err.code == 'RequestLimitExceeded') and retries <= 3:
                     sleep = 3 * (2**retries)
-                    print('Being throttled. Retrying after {} seconds..'.format(sleep))
-                    time.sleep(sleep)
+                    log.warning('Being throttled. Retrying after {} seconds..'.format(sleep))
+                    metrics.counter('stacks_throttle_retries', 'AWS API calls retried due to throttling').inc(
+                        {'function': func.__name__})
+                    pause(sleep)
                     retries += 1
                 else:
                     raise err
@@ -26,46 +69,52 @@ def throttling_retry(func):
 def get_ami_id(conn, name):
     """Return the first AMI ID given its name"""
     images = conn.get_all_images(filters={'name': name})
-    conn.close()
     if len(images) != 0:
         return images[0].id
     else:
-        raise RuntimeError('{} AMI not found'.format(name))
+        raise LookupFailedError('{} AMI not found'.format(name))
 
 
 @throttling_retry
 def get_zone_id(conn, name):
     """Return the first Route53 zone ID given its name"""
     zone = conn.get_zone(name)
-    conn.close()
     if zone:
         return zone.id
     else:
-        raise RuntimeError('{} zone not found'.format(name))
+        raise LookupFailedError('{} zone not found'.format(name))
 
 
 @throttling_retry
 def get_vpc_id(conn, name):
     """Return the first VPC ID given its name and region"""
     vpcs = conn.get_all_vpcs(filters={'tag:Name': name})
-    conn.close()
     if len(vpcs) == 1:
         return vpcs[0].id
     else:
-        raise RuntimeError('{} VPC not found'.format(name))
+        raise LookupFailedError('{} VPC not found'.format(name))
 
 
-@throttling_retry
 def get_stack_output(conn, name, key):
     """Return stack output key value"""
+    return output_value(describe_stack(conn, name), key)
+
+
+@throttling_retry
+def describe_stack(conn, name):
+    """Return a stack given its name"""
     result = conn.describe_stacks(name)
     if len(result) != 1:
-        raise RuntimeError('{} stack not found'.format(name))
-    outputs = [s.outputs for s in result][0]
-    for output in outputs:
+        raise LookupFailedError('{} stack not found'.format(name))
+    return result[0]
+
+
+def output_value(stack, key):
+    """Return the value of a stack output given its key"""
+    for output in stack.outputs:
         if output.key == key:
             return output.value
-    raise RuntimeError('{} output not found'.format(key))
+    raise LookupFailedError('{} output not found'.format(key))
 
 
 @throttling_retry
@@ -73,17 +122,170 @@ def get_stack_tag(conn, name, tag):
     """Return stack tag"""
     result = conn.describe_stacks(name)
     if len(result) != 1:
-        raise RuntimeError('{} stack not found'.format(name))
+        raise LookupFailedError('{} stack not found'.format(name))
     tags = [s.tags for s in result][0]
     return tags.get(tag, '')
 
 
-@throttling_retry
 def get_stack_resource(conn, stack_name, logical_id):
     """Return a physical_resource_id given its logical_id"""
-    resources = conn.describe_stack_resources(stack_name_or_id=stack_name)
+    return resource_id(describe_stack_resources(conn, stack_name), logical_id)
+
+
+@throttling_retry
+def describe_stack_resources(conn, stack_name):
+    """Return all resources of a stack"""
+    return conn.describe_stack_resources(stack_name_or_id=stack_name)
+
+
+def resource_id(resources, logical_id):
+    """Return a physical_resource_id from resources given its logical_id"""
     for r in resources:
         # TODO: would be nice to check for resource_status
         if r.logical_resource_id == logical_id:
             return r.physical_resource_id
     return None
+
+
+@throttling_retry
+def describe_stacks_page(conn, next_token=None):
+    """Return a page of all stacks descriptions"""
+    return conn.describe_stacks(next_token=next_token)
+
+
+@throttling_retry
+def list_stacks_page(conn, states=None, next_token=None):
+    """Return a page of stack summaries, filtered by status if states are given"""
+    return conn.list_stacks(stack_status_filters=states, next_token=next_token)
+
+
+class Export(object):
+    """A CloudFormation export, as listed by ListExports"""
+
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.exporting_stack_id = None
+        self.name = None
+        self.value = None
+
+    def startElement(self, name, attrs, connection):
+        return None
+
+    def endElement(self, name, value, connection):
+        if name == 'ExportingStackId':
+            self.exporting_stack_id = value
+        elif name == 'Name':
+            self.name = value
+        elif name == 'Value':
+            self.value = value
+
+    @property
+    def stack_name(self):
+        """Name of the exporting stack, taken from its id"""
+        return self.exporting_stack_id.split('/')[1] if self.exporting_stack_id else None
+
+
+class Import(object):
+    """A stack importing an export, as listed by ListImports"""
+
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.stack_name = None
+
+    def startElement(self, name, attrs, connection):
+        return None
+
+    def endElement(self, name, value, connection):
+        if name == 'member':
+            self.stack_name = value
+
+
+@throttling_retry
+def list_exports_page(conn, next_token=None):
+    """Return a page of exports of the account and region"""
+    params = {}
+    if next_token:
+        params['NextToken'] = next_token
+    return conn.get_list('ListExports', params, [('member', Export)])
+
+
+def list_exports(conn):
+    """Return a dict of (value, exporting stack name) tuples keyed by export name"""
+    exports = {}
+    next_token = None
+    while True:
+        page = list_exports_page(conn, next_token)
+        for export in page:
+            exports[export.name] = (export.value, export.stack_name)
+        next_token = page.next_token
+        if not next_token:
+            break
+    return exports
+
+
+@throttling_retry
+def list_imports_page(conn, export_name, next_token=None):
+    """Return a page of stacks importing an export"""
+    params = {'ExportName': export_name}
+    if next_token:
+        params['NextToken'] = next_token
+    return conn.get_list('ListImports', params, [('member', Import)])
+
+
+def list_imports(conn, export_name):
+    """Return a list of names of stacks importing an export"""
+    names = []
+    next_token = None
+    while True:
+        try:
+            page = list_imports_page(conn, export_name, next_token)
+        except BotoServerError as err:
+            # CloudFormation reports exports nobody imports as an error
+            if 'is not imported' in (err.message or ''):
+                return names
+            raise
+        names.extend(i.stack_name for i in page)
+        next_token = page.next_token
+        if not next_token:
+            break
+    return names
+
+
+def exports_index(conn):
+    """Return the exports index of a connection, listing exports on first use
+
+    The index is built once per connection and reused for the rest of the run.
+    With EXPORTS_TTL, it is kept in the cache and reused by later runs until
+    it is older than EXPORTS_TTL seconds.
+    """
+    with _exports_lock:
+        if conn not in _exports:
+            _exports[conn] = _load_exports(conn)
+        return _exports[conn]
+
+
+def _load_exports(conn):
+    fname = None
+    if EXPORTS_TTL > 0:
+        fname = cache.cache_path('exports', '{}-{}.json'.format(conn.region.name, conn.profile_name or 'default'))
+        cached = cache.load_json(fname)
+        if cached and time.time() - cached['timestamp'] < EXPORTS_TTL:
+            return {name: tuple(export) for name, export in cached['exports'].items()}
+    exports = list_exports(conn)
+    if fname:
+        cache.save_json(fname, {'timestamp': time.time(), 'exports': exports})
+    return exports
+
+
+def get_export(conn, name):
+    """Return the value of a CloudFormation export given its name"""
+    try:
+        return exports_index(conn)[name][0]
+    except KeyError:
+        raise LookupFailedError('{} export not found'.format(name))
+
+
+def reset_exports():
+    """Forget all loaded exports indexes"""
+    with _exports_lock:
+        _exports.clear()
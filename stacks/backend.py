@@ -0,0 +1,189 @@
+"""
+AWS connection pooling
+
+boto connections are not safe to share across threads, so the backend keeps
+a pool of idle connections, keyed by service, region and profile. A call
+checks a connection out of the pool and returns it when done, so threads of
+any executor reuse connections for the life of the backend, which saves a
+TLS handshake per call. Pooled clients stand in for boto connections and
+check out a connection per call, so they can be shared freely, e.g. in
+config. Objects returned by a call, like S3 buckets, keep using the
+connection they came from, so sequences of such calls hold a connection with
+checked_out().
+
+Backends are pluggable: subclasses override new_connection() to connect to
+something else than AWS, e.g. moto's server mode or test doubles.
+"""
+import threading
+
+from contextlib import contextmanager
+from datetime import datetime
+
+import boto.ec2
+import boto.vpc
+import boto.route53
+import boto.cloudformation
+import boto.s3
+
+from stacks import cassette
+from stacks import metrics
+from stacks.exceptions import AWSError
+
+SERVICES = {
+    'ec2': boto.ec2,
+    'vpc': boto.vpc,
+    'cloudformation': boto.cloudformation,
+    'route53': boto.route53,
+    's3': boto.s3,
+}
+# Idle connections kept per service, region and profile, connections returned
+# to a full pool are closed
+POOL_SIZE = 10
+
+
+class Backend(object):
+    """Pool of AWS connections, keyed by service, region and profile
+
+    At most pool_size idle connections are kept per key. With record_dir, AWS
+    responses are recorded to cassettes in it. With replay_dir, responses
+    recorded in it are replayed instead of calling AWS.
+    """
+
+    def __init__(self, record_dir=None, replay_dir=None, pool_size=POOL_SIZE):
+        self.record_dir = record_dir
+        self.replay_dir = replay_dir
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._connections = set()
+
+    def client(self, service, region, profile=None):
+        """Return a pooled client of a service, usable from any thread"""
+        if service not in SERVICES:
+            raise AWSError('Unknown AWS service {}'.format(service))
+        return PooledClient(self, service, region, profile)
+
+    @contextmanager
+    def connection(self, service, region, profile=None):
+        """Check a connection out of the pool for the calling thread
+
+        A new connection is made if none is idle. It is returned to the pool
+        when the block is done with it.
+        """
+        key = (service, region, profile)
+        conn = self.checkout(key)
+        try:
+            yield conn
+        finally:
+            self.checkin(key, conn)
+
+    def checkout(self, key):
+        """Return an idle connection of key, connecting if there is none"""
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        try:
+            conn = self.new_connection(*key)
+        except AWSError:
+            raise
+        except Exception as err:
+            raise AWSError(str(err))
+        if conn is None:
+            raise AWSError('Unable to connect to {} in region {}'.format(key[0], key[1]))
+        with self._lock:
+            self._connections.add(conn)
+        return conn
+
+    def checkin(self, key, conn):
+        """Return a checked out connection to the pool, closing it if the pool is full"""
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            # Connections of a closed backend are not pooled again
+            if conn not in self._connections:
+                return
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+            self._connections.discard(conn)
+        conn.close()
+
+    def new_connection(self, service, region, profile=None):
+        """Return a new boto connection"""
+        module = SERVICES[service]
+        if self.replay_dir:
+            conn = module.connect_to_region(region, **cassette.REPLAY_CREDENTIALS)
+        else:
+            conn = module.connect_to_region(region, profile_name=profile)
+        if conn is None:
+            return None
+        if self.record_dir:
+            cassette.use(conn, self.record_dir, service, cassette.RECORD)
+        elif self.replay_dir:
+            cassette.use(conn, self.replay_dir, service, cassette.REPLAY)
+        return metrics.instrument(conn, service)
+
+    def now(self, key):
+        """Return the current time, recorded and replayed with AWS responses
+
+        Stack events are followed from a time taken before a change, replaying
+        them needs the time taken when they were recorded. key names the time
+        among others taken in a run, e.g. concurrently.
+        """
+        if self.record_dir:
+            return cassette.now(self.record_dir, cassette.RECORD, key)
+        if self.replay_dir:
+            return cassette.now(self.replay_dir, cassette.REPLAY, key)
+        return datetime.now()
+
+    def close(self):
+        """Close all connections, idle or checked out"""
+        with self._lock:
+            conns, self._connections = self._connections, set()
+            self._idle = {}
+        for conn in conns:
+            conn.close()
+
+
+@contextmanager
+def checked_out(conn):
+    """Hold a connection of a pooled client for the calling thread
+
+    Plain boto connections are used as they are.
+    """
+    if isinstance(conn, PooledClient):
+        with conn.connection() as c:
+            yield c
+    else:
+        yield conn
+
+
+class PooledClient(object):
+    """Stands in for a boto connection, calling through the backend pool"""
+
+    def __init__(self, backend, service, region, profile=None):
+        self._backend = backend
+        self._key = (service, region, profile)
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name in ('_backend', '_key'):
+            raise AttributeError(name)
+        with self._backend.connection(*self._key) as conn:
+            attr = getattr(conn, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self._backend.connection(*self._key) as conn:
+                return getattr(conn, name)(*args, **kwargs)
+        return call
+
+    def connection(self):
+        """Check a connection out of the pool, see Backend.connection()"""
+        return self._backend.connection(*self._key)
+
+    def close(self):
+        """Keep the connection alive, the backend closes it"""
+
+    def __repr__(self):
+        return 'PooledClient({}, {}, {})'.format(*self._key)
@@ -0,0 +1,254 @@
+"""
+Portable bundles of rendered templates
+
+A bundle splits deploys into a render stage and a deploy stage. The render
+stage, which needs jinja2, the config tree and lookup access, renders a set
+of templates for an environment into a bundle directory: the rendered
+templates, nested stack templates of split templates and a bundle.json
+manifest of their stack names, tags, MD5 sums and the order to deploy them
+in. The deploy stage creates or updates the stacks of a bundle without
+rendering anything, so what is deployed is exactly what was reviewed.
+
+Stacks are deployed in waves. A stack importing exports of another stack of
+the bundle comes in a later wave, every stack in a wave is deployed
+concurrently and the next wave starts once all of them are done.
+"""
+import os
+import json
+
+from os import path
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from stacks import cf
+from stacks import __about__
+from stacks.exceptions import StacksError, NoUpdatesError
+from stacks.states import COMPLETE_STACK_STATES
+
+MANIFEST = 'bundle.json'
+TEMPLATES_DIR = 'templates'
+# Version of the bundle layout, bundles of other versions are not deployed
+FORMAT = 1
+
+NO_UPDATES = 'NO_UPDATES'
+SKIPPED = 'SKIPPED'
+
+
+def create(templates, config, output_dir, split=False, jobs=None, use_cache=False):
+    """Render templates into a bundle in output_dir and return its manifest
+
+    Templates are rendered concurrently. Stack names come from the template
+    metadata. Stacks are ordered by the exports they import, see
+    import_dependencies().
+    """
+    def render(tpl_path):
+        with open(tpl_path) as tpl_file:
+            return cf.render_template(tpl_file, config, use_cache=use_cache)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        artifacts = list(executor.map(render, templates))
+
+    stacks = []
+    bodies = {}
+    for tpl_path, artifact in zip(templates, artifacts):
+        tags, name, disable_rollback = cf.stack_settings(artifact['metadata'], config['env'], artifact['md5'])
+        if not name:
+            raise StacksError('Template {} has no stack name in its metadata.'.format(tpl_path))
+        if name in bodies:
+            raise StacksError('Stack {} is defined by more than one template.'.format(name))
+        bodies[name] = artifact['template']
+        tpl, children = cf.split_rendered(artifact['template']) if split else (artifact['template'], None)
+        stacks.append({
+            'name': name,
+            'source': tpl_path,
+            'template': _write(output_dir, path.join(TEMPLATES_DIR, name + '.json'), tpl),
+            'md5': cf._calc_md5(tpl),
+            'tags': tags,
+            'disable_rollback': disable_rollback,
+            'children': {
+                child: _write(output_dir, path.join(TEMPLATES_DIR, name, child + '.json'),
+                              json.dumps(child_tpl, indent=2, sort_keys=True))
+                for child, child_tpl in (children or {}).items()
+            },
+        })
+
+    dependencies = import_dependencies(bodies)
+    manifest = {
+        'format': FORMAT,
+        'version': __about__.__version__,
+        'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'env': config['env'],
+        'region': config['region'],
+        'templates_bucket_name': config.get('templates_bucket_name'),
+        'stacks': stacks,
+        'dependencies': {name: sorted(deps) for name, deps in dependencies.items()},
+        'waves': deploy_waves(dependencies),
+    }
+    with open(path.join(output_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def import_dependencies(bodies):
+    """Return a dict of sets of stacks each stack depends on, given their template bodies
+
+    A stack depends on another stack of the bundle when it imports one of its
+    exports with Fn::ImportValue. Export names may be given with Fn::Sub and
+    ${AWS::StackName}.
+    """
+    templates = dict((name, json.loads(body)) for name, body in bodies.items())
+    exporters = {}
+    for name, tpl in templates.items():
+        for output in (tpl.get('Outputs') or {}).values():
+            if isinstance(output, dict) and isinstance(output.get('Export'), dict):
+                export = _export_name(output['Export'].get('Name'), name)
+                if export:
+                    exporters[export] = name
+
+    dependencies = {}
+    for name, tpl in templates.items():
+        imported = set(exporters.get(_export_name(value, name)) for value in _imports(tpl))
+        dependencies[name] = imported - set([None, name])
+    return dependencies
+
+
+def deploy_waves(dependencies):
+    """Return a list of waves of stacks, stacks come after the stacks they depend on"""
+    return list(reversed(cf.deletion_waves(dependencies)))
+
+
+def load(bundle_dir):
+    """Return the manifest of a bundle with the templates it lists
+
+    Templates are checked against their MD5 sums, a bundle changed since it
+    was created is not deployed.
+    """
+    try:
+        with open(path.join(bundle_dir, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as err:
+        raise StacksError('Invalid bundle {}: {}'.format(bundle_dir, err))
+    if manifest.get('format') != FORMAT:
+        raise StacksError('Unsupported bundle format {}, expected {}.'.format(manifest.get('format'), FORMAT))
+
+    for stack in manifest['stacks']:
+        stack['body'] = _read(bundle_dir, stack['template'])
+        if cf._calc_md5(stack['body']) != stack['md5']:
+            raise StacksError('Template {} of stack {} does not match its MD5 sum.'.format(
+                stack['template'], stack['name']))
+        stack['children'] = {child: json.loads(_read(bundle_dir, f)) for child, f in stack['children'].items()}
+    return manifest
+
+
+def deploy(conn, manifest, config, jobs=None, interval=5, validate=False, report=None):
+    """Create or update the stacks of a loaded bundle wave by wave
+
+    config holds the env, region, S3 connection and templates bucket used to
+    upload templates, see deploy_config(). Deploying stops after a wave in
+    which a stack failed, the stacks of later waves are SKIPPED. report is
+    passed on to cf.wait_stacks(). Return a list of result dicts in manifest
+    order, errors are reported in them rather than raised.
+    """
+    stacks = dict((s['name'], s) for s in manifest['stacks'])
+    results = dict((name, {'name': name, 'status': SKIPPED, 'error': None}) for name in stacks)
+
+    for wave in manifest['waves']:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            started = list(executor.map(lambda name: _deploy(conn, stacks[name], config, validate), wave))
+        for result in started:
+            results[result['name']] = result
+        waiting = [r['name'] for r in started if r['status'] is None and not r['error']]
+        statuses = cf.wait_stacks(conn, waiting, interval=interval, report=report) if waiting else {}
+        for name, status in statuses.items():
+            results[name]['status'] = status
+        if any(failed(results[name]) for name in wave):
+            break
+
+    return [results[s['name']] for s in manifest['stacks']]
+
+
+def deploy_config(manifest, region=None):
+    """Return the config a bundle is deployed with, without connections
+
+    Bundles are deployed to the region they were rendered for, as their
+    templates hold the results of lookups made in that region.
+    """
+    if region and region != manifest['region']:
+        raise StacksError('Bundle was rendered for region {}, not {}.'.format(manifest['region'], region))
+    config = {'env': manifest['env'], 'region': manifest['region']}
+    if manifest.get('templates_bucket_name'):
+        config['templates_bucket_name'] = manifest['templates_bucket_name']
+    return config
+
+
+def stack_rows(manifest):
+    """Return tabulate rows of the stacks of a bundle by wave"""
+    stacks = dict((s['name'], s) for s in manifest['stacks'])
+    rows = []
+    for i, wave in enumerate(manifest['waves']):
+        for name in wave:
+            rows.append(['Wave {}:'.format(i + 1), name, stacks[name]['md5'], stacks[name]['source']])
+    return rows
+
+
+def failed(result):
+    """Tell whether a stack of a bundle failed to deploy"""
+    return result['status'] not in COMPLETE_STACK_STATES + [NO_UPDATES]
+
+
+def result_rows(results):
+    """Return tabulate rows of deploy results"""
+    return [[r['name'], r['status'] or '', r['error'] or ''] for r in results]
+
+
+def _deploy(conn, stack, config, validate=False):
+    """Create or update a stack of a bundle, return a result dict"""
+    result = {'name': stack['name'], 'status': None, 'error': None}
+    # Uploaded templates of split stacks do not match the bundled template
+    md5 = None if stack['children'] else stack['md5']
+    try:
+        cf.deploy_template(conn, config, stack['name'], stack['body'], stack['tags'], stack['disable_rollback'],
+                           stack['children'], md5, update=True, create_on_update=True, validate=validate)
+    except NoUpdatesError:
+        result['status'] = NO_UPDATES
+    except Exception as err:
+        result['error'] = str(err)
+    return result
+
+
+def _imports(node):
+    """Yield the values of Fn::ImportValue functions of a template"""
+    if isinstance(node, list):
+        for value in node:
+            for imported in _imports(value):
+                yield imported
+    elif isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'Fn::ImportValue':
+                yield value
+            else:
+                for imported in _imports(value):
+                    yield imported
+
+
+def _export_name(value, stack_name):
+    """Return an export name, None if it is only known once deployed"""
+    if isinstance(value, dict) and list(value) == ['Fn::Sub'] and isinstance(value['Fn::Sub'], str):
+        value = value['Fn::Sub'].replace('${AWS::StackName}', stack_name)
+    if isinstance(value, str) and '${' not in value:
+        return value
+    return None
+
+
+def _write(output_dir, fname, content):
+    """Write a file of a bundle, return its path relative to the bundle"""
+    p = path.join(output_dir, fname)
+    os.makedirs(path.dirname(p), exist_ok=True)
+    with open(p, 'w') as f:
+        f.write(content)
+    return fname
+
+
+def _read(bundle_dir, fname):
+    with open(path.join(bundle_dir, fname)) as f:
+        return f.read()
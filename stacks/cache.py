@@ -0,0 +1,41 @@
+"""
+Local cache storage
+
+Cache files live under STACKS_CACHE_DIR, which defaults to
+$XDG_CACHE_HOME/stacks or ~/.cache/stacks.
+"""
+import os
+import json
+import tempfile
+
+CACHE_DIR = os.environ.get(
+    'STACKS_CACHE_DIR',
+    os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.environ.get('HOME', ''), '.cache')), 'stacks'))
+
+
+def cache_path(*parts):
+    """Return path of a cache file, creating its parent directory"""
+    p = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(p), exist_ok=True)
+    return p
+
+
+def load_json(fname):
+    """Return a cached json document or None if it is missing or corrupt"""
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_json(fname, data):
+    """Atomically write a json document to a cache file"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, sort_keys=True)
+        os.replace(tmp, fname)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
@@ -0,0 +1,195 @@
+"""
+Recording and replaying of AWS API responses
+
+A cassette is a json file per AWS service holding recorded responses keyed by
+request. Recorded requests are replayed in order, the last response of a
+request is repeated once its recording is used up, so polling loops end in the
+state they were recorded in. Replaying needs no credentials nor network and
+does not sleep between polls.
+
+Times taken while recording, like the start of a stack update events are
+followed from, are kept in a clock cassette and replayed likewise.
+"""
+import os
+import json
+import atexit
+import base64
+import hashlib
+import threading
+
+from datetime import datetime
+
+from stacks.exceptions import AWSError
+
+RECORD = 'record'
+REPLAY = 'replay'
+CLOCK = 'clock'
+
+# Credentials of connections replaying cassettes, they are never used to sign
+# a request
+REPLAY_CREDENTIALS = {'aws_access_key_id': 'replay', 'aws_secret_access_key': 'replay'}
+
+_lock = threading.Lock()
+_cassettes = {}
+_replaying = False
+
+
+class RecordedResponse(object):
+    """Stands in for an http.client.HTTPResponse returned by boto"""
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.msg = dict(headers)
+        self._body = body
+
+    def read(self, amt=None):
+        if amt is None:
+            amt = len(self._body)
+        data, self._body = self._body[:amt], self._body[amt:]
+        return data
+
+    def getheader(self, name, default=None):
+        for key, value in self.headers:
+            if key.lower() == name.lower():
+                return value
+        return default
+
+    def getheaders(self):
+        return list(self.headers)
+
+
+class Cassette(object):
+    """Recorded responses of one AWS service"""
+
+    def __init__(self, directory, service, mode):
+        self.path = os.path.join(directory, service + '.json')
+        self.mode = mode
+        self.played = {}
+        self.interactions = {}
+        if mode == REPLAY:
+            try:
+                with open(self.path) as f:
+                    self.interactions = json.load(f)
+            except (OSError, ValueError) as err:
+                raise AWSError('Unable to load cassette {}: {}'.format(self.path, err))
+
+    def wrap(self, conn):
+        """Record or replay HTTP requests made by a boto connection"""
+        mexe = conn._mexe
+
+        def recorded_mexe(request, *args, **kwargs):
+            key = request_key(request)
+            if self.mode == REPLAY:
+                return self.play(key)
+            response = mexe(request, *args, **kwargs)
+            return self.record(key, response)
+        conn._mexe = recorded_mexe
+        return conn
+
+    def record(self, key, response):
+        recorded = RecordedResponse(response.status, response.reason, response.getheaders(), response.read())
+        self.record_value(key, _dump_response(recorded))
+        return recorded
+
+    def play(self, key):
+        return _load_response(self.play_value(key))
+
+    def record_value(self, key, value):
+        """Append a json serializable value to the recording of key"""
+        with _lock:
+            self.interactions.setdefault(key, []).append(value)
+
+    def play_value(self, key):
+        """Return the next recorded value of key, the last one once all are played"""
+        with _lock:
+            values = self.interactions.get(key)
+            if not values:
+                raise AWSError('No recorded response in {} for {}'.format(self.path, key))
+            n = self.played.get(key, 0)
+            self.played[key] = n + 1
+            return values[min(n, len(values) - 1)]
+
+    def save(self):
+        if self.mode != RECORD:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with _lock:
+            with open(self.path, 'w') as f:
+                json.dump(self.interactions, f, indent=1, sort_keys=True)
+
+
+def use(conn, directory, service, mode):
+    """Record or replay responses of a boto connection in directory
+
+    Connections to the same service share a cassette.
+    """
+    global _replaying
+    cassette = _cassette(directory, service, mode)
+    with _lock:
+        _replaying = _replaying or mode == REPLAY
+    return cassette.wrap(conn)
+
+
+def now(directory, mode, key):
+    """Return the current time, recorded to or replayed from directory under key
+
+    Replaying returns the times recorded under key in order.
+    """
+    clock = _cassette(directory, CLOCK, mode)
+    if mode == REPLAY:
+        return datetime.fromtimestamp(clock.play_value(key))
+    value = datetime.now()
+    clock.record_value(key, value.timestamp())
+    return value
+
+
+def _cassette(directory, service, mode):
+    """Return the cassette of a service in directory, shared by all its users"""
+    key = (os.path.abspath(directory), service, mode)
+    with _lock:
+        if not _cassettes:
+            atexit.register(save_all)
+        if key not in _cassettes:
+            _cassettes[key] = Cassette(directory, service, mode)
+        return _cassettes[key]
+
+
+def replaying():
+    """Return True if AWS responses are being replayed"""
+    return _replaying
+
+
+def save_all():
+    """Write out all recording cassettes"""
+    for cassette in list(_cassettes.values()):
+        cassette.save()
+
+
+def request_key(request):
+    """Return a key identifying a request independently of its signature"""
+    body = request.body or b''
+    if not isinstance(body, bytes):
+        body = str(body).encode()
+    params = sorted((k, str(v)) for k, v in request.params.items())
+    return json.dumps([request.method, request.host, request.path, params, hashlib.md5(body).hexdigest()])
+
+
+def _dump_response(response):
+    body = response.read()
+    response._body = body
+    try:
+        encoded = {'body': body.decode('utf-8')}
+    except UnicodeDecodeError:
+        encoded = {'body_base64': base64.b64encode(body).decode()}
+    encoded.update({'status': response.status, 'reason': response.reason, 'headers': response.getheaders()})
+    return encoded
+
+
+def _load_response(recorded):
+    if 'body_base64' in recorded:
+        body = base64.b64decode(recorded['body_base64'])
+    else:
+        body = recorded['body'].encode('utf-8')
+    return RecordedResponse(recorded['status'], recorded['reason'], [tuple(h) for h in recorded['headers']], body)
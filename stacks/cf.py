@@ -4,6 +4,9 @@ Cloudformation related functions
 # An attempt to support python 2.7.x
 from __future__ import print_function
 
+import os
+import re
+import shlex
 import sys
 import builtins
 import time
@@ -11,40 +14,66 @@ import yaml
 import json
 import jinja2
 import hashlib
+import heapq
 import boto
 
 from os import path
 from jinja2 import meta
 from fnmatch import fnmatch
+from fnmatch import translate as fnmatch_translate
 from tabulate import tabulate
 from boto.exception import BotoServerError
 from operator import attrgetter
+from itertools import islice
+from collections import OrderedDict
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 from awscli.customizations.cloudformation.yamlhelper import intrinsics_multi_constructor
 
+from stacks import artifacts
+from stacks import cache
+from stacks import lint
+from stacks import lookups
+from stacks import metrics
+from stacks.exceptions import StacksError, TemplateError, AWSError, StackNotFoundError, from_boto
+from stacks.backend import checked_out
+from stacks.split import needs_split, split_template
+from stacks.config import render_context, resolve
 from stacks.aws import get_stack_tag
+from stacks.aws import list_exports, list_imports
+from stacks.aws import describe_stacks_page
+from stacks.aws import list_stacks_page
 from stacks.aws import throttling_retry
-from stacks.states import FAILED_STACK_STATES, COMPLETE_STACK_STATES, ROLLBACK_STACK_STATES, IN_PROGRESS_STACK_STATES
+from stacks.aws import pause
+from stacks.aws import RateLimiter
+from stacks.states import IN_PROGRESS_STACK_STATES
+from stacks.states import DELETED_STACK_STATES, TERMINAL_STACK_STATES, LIVE_STACK_STATES
 
-YES = ['y', 'Y', 'yes', 'YES', 'Yes']
+MAX_TEMPLATE_BODY_SIZE = 51200
+NESTED_STACK_TYPE = 'AWS::CloudFormation::Stack'
+# DescribeStackEvents calls per second shared by the streams of a stack and
+# its nested stacks while following events
+EVENTS_RATE = 5
 
+_jinja_envs = {}
+# Compiled snippets shared by all jinja2 environments, keyed by file name and
+# modification time
+_snippets_code = {}
 
-def gen_template(tpl_file, config):
-    """Return a tuple of json string template and options dict"""
-    tpl_path, tpl_fname = path.split(tpl_file.name)
-    env = _new_jinja_env(tpl_path)
 
-    _check_missing_vars(env, tpl_file, config)
+def gen_template(tpl_file, config, parallel_lookups=False):
+    """Return a tuple of json string template and options dict
 
-    tpl = env.get_template(tpl_fname)
-    rendered = tpl.render(config)
+    With parallel_lookups, AWS lookups made by the template are resolved
+    concurrently before the final render.
+    """
+    rendered = render_source(tpl_file, config, parallel_lookups)
     try:
         yaml.SafeLoader.add_multi_constructor("!", intrinsics_multi_constructor)
         docs = list(yaml.safe_load_all(rendered))
     except yaml.parser.ParserError as err:
-        print(err)
-        sys.exit(1)
+        raise TemplateError(str(err))
 
     if len(docs) == 2:
         return json.dumps(docs[1], indent=2, sort_keys=True), docs[0]
@@ -52,6 +81,59 @@ def gen_template(tpl_file, config):
         return json.dumps(docs[0], indent=2, sort_keys=True), None
 
 
+def render_source(tpl_file, config, parallel_lookups=False):
+    """Return a template rendered by jinja2, before it is parsed as YAML"""
+    tpl_path, tpl_fname = path.split(tpl_file.name)
+    with metrics.timer('stacks_render_seconds', 'Template render duration in seconds'):
+        env = get_jinja_env(tpl_path, snippets_path(config))
+
+        _check_missing_vars(env, tpl_file, config)
+
+        tpl = env.get_template(tpl_fname)
+        if parallel_lookups:
+            return lookups.render(tpl, render_context(config))
+        return tpl.render(render_context(config))
+
+
+def lint_template(tpl_file, config):
+    """Render a template offline and return a list of lint problem dicts
+
+    Lookups are not made, they render placeholders, see stacks.lint.
+    """
+    context = dict(config)
+    context.update(lookups.placeholder_helpers())
+    try:
+        docs, duplicates = lint.load_template(render_source(tpl_file, context))
+    except yaml.YAMLError as err:
+        raise TemplateError(str(err))
+    return lint.lint(docs[-1] or {}, duplicates) if docs else []
+
+
+def render_template(tpl_file, config, parallel_lookups=False, use_cache=False):
+    """Return a dict of a rendered template, its metadata, size and md5
+
+    Rendered templates are cached as artifacts, see stacks.artifacts. The
+    cached key tells whether the template was served from the cache.
+    """
+    tpl_path, tpl_fname = path.split(tpl_file.name)
+    key = None
+    if use_cache:
+        key = artifacts.source_key(get_jinja_env(tpl_path, snippets_path(config)), tpl_fname, config)
+    if key:
+        artifact = artifacts.load(key, config)
+        if artifact:
+            artifact['cached'] = True
+            return artifact
+
+    recorded = []
+    tpl, metadata = gen_template(tpl_file, artifacts.recording_context(config, recorded), parallel_lookups)
+    artifact = {'template': tpl, 'metadata': metadata, 'size': len(tpl), 'md5': _calc_md5(tpl)}
+    if key:
+        artifacts.save(key, recorded, artifact)
+    artifact['cached'] = False
+    return artifact
+
+
 def _check_missing_vars(env, tpl_file, config):
     """Check for missing variables in a template string"""
     tpl_str = tpl_file.read()
@@ -60,58 +142,181 @@ def _check_missing_vars(env, tpl_file, config):
     missing_properties = required_properties - config.keys() - set(dir(builtins))
 
     if len(missing_properties) > 0:
-        print('Required properties not set: {}'.format(','.join(missing_properties)))
-        sys.exit(1)
+        raise TemplateError('Required properties not set: {}'.format(','.join(sorted(missing_properties))))
+
 
+def get_jinja_env(tpl_path, snippets=()):
+    """Return a jinja2 environment for templates in tpl_path
 
-def _new_jinja_env(tpl_path):
+    Templates are looked up in tpl_path first and then in the snippets library
+    directories. Environments are cached per process, so templates rendered
+    more than once are only compiled once.
+    """
+    key = (tpl_path, tuple(snippets))
+    if key not in _jinja_envs:
+        _jinja_envs[key] = _new_jinja_env(tpl_path, snippets)
+    return _jinja_envs[key]
+
+
+def _new_jinja_env(tpl_path, snippets=()):
     loader = jinja2.loaders.FileSystemLoader(tpl_path)
+    if snippets:
+        loader = jinja2.loaders.ChoiceLoader([loader, SnippetLoader(list(snippets))])
     env = jinja2.Environment(loader=loader)
+    env.context_class = _LazyContext
     return env
 
 
+def snippets_path(config):
+    """Return a tuple of snippets library directories from config"""
+    value = config.get('snippets_path') or ()
+    if isinstance(value, str):
+        value = value.split(os.pathsep)
+    return tuple(value)
+
+
+class SnippetLoader(jinja2.loaders.BaseLoader):
+    """Loads snippets from a library search path
+
+    Like jinja2's ModuleLoader, snippets are compiled to python code once per
+    process, which is then shared by all templates and environments. A snippet
+    is compiled again only when its file changes.
+    """
+
+    def __init__(self, searchpath):
+        self.searchpath = searchpath
+
+    def _find(self, template):
+        pieces = jinja2.loaders.split_template_path(template)
+        for searchpath in self.searchpath:
+            filename = path.join(searchpath, *pieces)
+            if path.isfile(filename):
+                return filename
+        raise jinja2.TemplateNotFound(template)
+
+    def get_source(self, environment, template):
+        filename = self._find(template)
+        with open(filename) as f:
+            source = f.read()
+        mtime = path.getmtime(filename)
+        return source, filename, lambda: path.isfile(filename) and path.getmtime(filename) == mtime
+
+    def load(self, environment, name, globals=None):
+        filename = self._find(name)
+        mtime = path.getmtime(filename)
+        key = (filename, mtime)
+        code = _snippets_code.get(key)
+        if code is None:
+            source, filename, _ = self.get_source(environment, name)
+            code = environment.compile(source, name, filename)
+            _snippets_code[key] = code
+
+        def uptodate():
+            return path.isfile(filename) and path.getmtime(filename) == mtime
+
+        return environment.template_class.from_code(environment, code, environment.make_globals(globals), uptodate)
+
+    def list_templates(self):
+        found = set()
+        for searchpath in self.searchpath:
+            for dirpath, _, filenames in os.walk(searchpath):
+                for filename in filenames:
+                    found.add(path.relpath(path.join(dirpath, filename), searchpath).replace(os.sep, '/'))
+        return sorted(found)
+
+
+def compile_snippets(snippets):
+    """Compile all snippets found in the snippets library directories"""
+    loader = SnippetLoader(list(snippets))
+    env = jinja2.Environment(loader=loader)
+    for name in loader.list_templates():
+        try:
+            loader.load(env, name)
+        except jinja2.TemplateError:
+            # Reported when a template includes the snippet
+            pass
+
+
+class _LazyContext(jinja2.runtime.Context):
+    """Template context evaluating lazy config values when they are used"""
+
+    def resolve_or_missing(self, key):
+        return resolve(self.parent, super(_LazyContext, self).resolve_or_missing(key))
+
+
 # TODO(vaijab): fix 'S3ResponseError: 301 Moved Permanently', this happens when
 # a connection to S3 is being made from a different region than the one a bucket
 # was created in.
-def upload_template(config, tpl, stack_name):
-    """Upload a template to S3 bucket and returns S3 key url"""
-    bn = config.get('templates_bucket_name', '{}-stacks-{}'.format(config['env'], config['region']))
+def upload_template(config, tpl, stack_name, expires_in=30, md5=None):
+    """Upload a template to S3 bucket and returns S3 key url
 
-    try:
-        b = config['s3_conn'].get_bucket(bn)
-    except boto.exception.S3ResponseError as err:
-        if err.code == 'NoSuchBucket':
-            print('Bucket {} does not exist.'.format(bn))
-        else:
-            print(err)
-        sys.exit(1)
+    md5 is the template hash, if it is known already.
+    """
+    bn = config.get('templates_bucket_name', '{}-stacks-{}'.format(config['env'], config['region']))
 
-    h = _calc_md5(tpl)
-    k = boto.s3.key.Key(b)
-    k.key = '{}/{}/{}'.format(config['env'], stack_name, h)
-    k.set_contents_from_string(tpl)
-    url = k.generate_url(expires_in=30)
+    # The bucket and key use the connection they came from
+    with checked_out(config['s3_conn']) as s3_conn:
+        try:
+            b = s3_conn.get_bucket(bn)
+        except boto.exception.S3ResponseError as err:
+            if err.code == 'NoSuchBucket':
+                raise AWSError('Bucket {} does not exist.'.format(bn))
+            raise AWSError(str(err))
+
+        h = md5 or _calc_md5(tpl)
+        k = boto.s3.key.Key(b)
+        k.key = '{}/{}/{}'.format(config['env'], stack_name, h)
+        k.set_contents_from_string(tpl)
+        url = k.generate_url(expires_in=expires_in)
     return url
 
 
-def stack_resources(conn, stack_name, logical_resource_id=None):
-    """List stack resources"""
+def upload_nested_templates(config, parent, children, stack_name):
+    """Upload child templates of a split template concurrently
+
+    Child stack TemplateURLs are set in the parent template, which is returned
+    as a json string. Child template URLs stay valid for an hour, as
+    CloudFormation fetches them only when it gets to create the child stacks.
+    """
+    def upload(child):
+        tpl = json.dumps(children[child], indent=2, sort_keys=True)
+        return upload_template(config, tpl, '{}-{}'.format(stack_name, child), expires_in=3600)
+
+    with ThreadPoolExecutor() as executor:
+        urls = dict(zip(children, executor.map(upload, children)))
+    for child, url in urls.items():
+        parent['Resources'][child]['Properties']['TemplateURL'] = url
+    return json.dumps(parent, indent=2, sort_keys=True)
+
+
+def get_resources(conn, stack_name, logical_resource_id=None):
+    """Return a list of stack resources dicts"""
     try:
         result = conn.describe_stack_resources(stack_name_or_id=stack_name,
                                                logical_resource_id=logical_resource_id)
     except BotoServerError as err:
-        print(err.message)
-        sys.exit(1)
+        raise from_boto(err)
+    return [{
+        'logical_resource_id': r.logical_resource_id,
+        'physical_resource_id': r.physical_resource_id,
+        'resource_type': r.resource_type,
+        'resource_status': r.resource_status,
+    } for r in result]
+
+
+def stack_resources(conn, stack_name, logical_resource_id=None):
+    """List stack resources"""
+    result = get_resources(conn, stack_name, logical_resource_id)
     resources = []
     if logical_resource_id:
-        resources.append([r.physical_resource_id for r in result])
+        resources.append([r['physical_resource_id'] for r in result])
     else:
         for r in result:
             columns = [
-                r.logical_resource_id,
-                r.physical_resource_id,
-                r.resource_type,
-                r.resource_status,
+                r['logical_resource_id'],
+                r['physical_resource_id'],
+                r['resource_type'],
+                r['resource_status'],
             ]
             resources.append(columns)
 
@@ -120,90 +325,260 @@ def stack_resources(conn, stack_name, logical_resource_id=None):
     return None
 
 
-def stack_outputs(conn, stack_name, output_name):
-    """List stacks outputs"""
+def get_outputs(conn, stack_name):
+    """Return a dict of stack output values keyed by output key"""
     try:
         result = conn.describe_stacks(stack_name)
     except BotoServerError as err:
-        print(err.message)
-        sys.exit(1)
+        raise from_boto(err)
+    if len(result) < 1:
+        raise StackNotFoundError('Stack with id {} does not exist'.format(stack_name))
+    return OrderedDict((o.key, o.value) for o in result[0].outputs)
+
+
+def stack_outputs(conn, stack_name, output_name):
+    """List stacks outputs"""
+    outs = get_outputs(conn, stack_name)
 
     outputs = []
-    outs = [s.outputs for s in result][0]
-    for o in outs:
+    for key, value in outs.items():
         if not output_name:
-            columns = [o.key, o.value]
+            columns = [key, value]
             outputs.append(columns)
-        elif output_name and o.key == output_name:
-            outputs.append([o.value])
+        elif output_name and key == output_name:
+            outputs.append([value])
 
-    if len(result) >= 1:
-        return tabulate(outputs, tablefmt='plain')
-    return None
+    return tabulate(outputs, tablefmt='plain')
 
 
-def list_stacks(conn, name_filter='*', verbose=False):
-    """List active stacks"""
-    states = FAILED_STACK_STATES + COMPLETE_STACK_STATES + IN_PROGRESS_STACK_STATES + ROLLBACK_STACK_STATES
-    s = conn.list_stacks(states)
+def iter_described_stacks(conn):
+    """Yield descriptions of all stacks, following describe_stacks pagination"""
+    next_token = None
+    while True:
+        try:
+            page = describe_stacks_page(conn, next_token)
+        except BotoServerError as err:
+            raise from_boto(err)
+        for stack in page:
+            yield stack
+        next_token = page.next_token
+        if not next_token:
+            break
 
-    stacks = []
-    for n in s:
-        if name_filter and fnmatch(n.stack_name, name_filter):
-            columns = [n.stack_name, n.stack_status]
-            if verbose:
-                env = get_stack_tag(conn, n.stack_name, 'Env')
-                columns.append(env)
-                columns.append(n.template_description)
-            stacks.append(columns)
 
-    if len(stacks) >= 1:
-        return tabulate(stacks, tablefmt='plain')
-    return None
+def get_all_outputs(conn, name_filter='*'):
+    """Return a dict of output dicts keyed by names of stacks matching a unix shell-style pattern
 
+    All stacks are described in a single paginated sweep rather than a call
+    per stack.
+    """
+    match = re.compile(fnmatch_translate(name_filter)).match
+    outputs = {}
+    for stack in iter_described_stacks(conn):
+        if match(stack.stack_name):
+            outputs[stack.stack_name] = OrderedDict((o.key, o.value) for o in stack.outputs)
+    return OrderedDict(sorted(outputs.items()))
 
-def create_stack(conn, stack_name, tpl_file, config, update=False, dry=False, create_on_update=False):
-    """Create or update CloudFormation stack from a jinja2 template"""
-    tpl, metadata = gen_template(tpl_file, config)
 
-    # Set default tags which cannot be overwritten
-    default_tags = {
-        'Env': config['env'],
-        'MD5Sum': _calc_md5(tpl)
+def format_outputs(outputs, output_format='text', output_name=None):
+    """Return outputs of many stacks, a dict as returned by get_all_outputs()
+
+    text is a table of stack name, output key and value. json is an object of
+    outputs namespaced by stack name. env is shell assignments of quoted values
+    to variables named after the stack and output key, e.g. PROD_VPC_VPCID.
+    With output_name, only outputs of that key are included.
+    """
+    outputs = OrderedDict((name, OrderedDict((k, v) for k, v in outs.items()
+                                             if output_name is None or k == output_name))
+                          for name, outs in outputs.items())
+    if output_format == 'json':
+        return json.dumps(outputs, indent=2)
+    if output_format == 'env':
+        return '\n'.join('{}={}'.format(env_var_name(name, key), shlex.quote(value or ''))
+                         for name, outs in outputs.items() for key, value in outs.items())
+    rows = [[name, key, value] for name, outs in outputs.items() for key, value in outs.items()]
+    return tabulate(rows, tablefmt='plain')
+
+
+def env_var_name(*parts):
+    """Return a shell variable name made of parts"""
+    name = re.sub(r'[^A-Z0-9]+', '_', '_'.join(parts).upper()).strip('_')
+    if not name or name[0].isdigit():
+        name = '_' + name
+    return name
+
+
+def stack_pages(conn, name_filter='*', states=LIVE_STACK_STATES):
+    """Yield lists of stack summaries matching a unix shell-style pattern
+
+    Follows list_stacks pagination, yielding the matching stacks of each page
+    as soon as it is fetched. states are passed on as server side status
+    filters, None lists stacks in any state, deleted ones included.
+    """
+    match = re.compile(fnmatch_translate(name_filter or '*')).match
+    next_token = None
+    while True:
+        try:
+            page = list_stacks_page(conn, states, next_token)
+        except BotoServerError as err:
+            raise from_boto(err)
+        yield [s for s in page if match(s.stack_name)]
+        next_token = page.next_token
+        if not next_token:
+            break
+
+
+def iter_stacks(conn, name_filter='*', states=LIVE_STACK_STATES):
+    """Yield stack summaries matching a unix shell-style pattern, see stack_pages()"""
+    for page in stack_pages(conn, name_filter, states):
+        for s in page:
+            yield s
+
+
+def get_stacks(conn, name_filter='*', states=LIVE_STACK_STATES, limit=None):
+    """Return a list of at most limit stack dicts matching a unix shell-style pattern"""
+    return [_stack_dict(s) for s in islice(iter_stacks(conn, name_filter, states), limit)]
+
+
+def _stack_dict(s):
+    return {
+        'stack_name': s.stack_name,
+        'stack_status': s.stack_status,
+        'template_description': s.template_description,
     }
 
-    if metadata:
-        tags = _extract_tags(metadata)
-        tags.update(default_tags)
-        name_from_metadata = metadata.get('name')
-        disable_rollback = metadata.get('disable_rollback')
-    else:
-        name_from_metadata = None
-        tags = default_tags
-        disable_rollback = None
+
+def _stack_columns(conn, s, verbose):
+    columns = [s['stack_name'], s['stack_status']]
+    if verbose:
+        columns.append(get_stack_tag(conn, s['stack_name'], 'Env'))
+        columns.append(s['template_description'])
+    return columns
+
+
+def print_stacks(conn, name_filter='*', verbose=False, states=LIVE_STACK_STATES, limit=None):
+    """Print tabulated stacks page by page, stopping after limit stacks
+
+    Return the number of stacks printed.
+    """
+    count = 0
+    for page in stack_pages(conn, name_filter, states):
+        if limit is not None:
+            page = page[:limit - count]
+        if page:
+            rows = [_stack_columns(conn, _stack_dict(s), verbose) for s in page]
+            print(tabulate(rows, tablefmt='plain'), flush=True)
+            count += len(page)
+        if limit is not None and count >= limit:
+            break
+    return count
+
+
+def create_stack(conn, stack_name, tpl_file, config, update=False, dry=False, create_on_update=False,
+                 parallel_lookups=False, validate=False, split=False, use_cache=False, lint_first=False):
+    """Create or update CloudFormation stack from a jinja2 template
+
+    With split, templates exceeding CloudFormation limits are split into
+    nested stacks. With use_cache, rendered templates are cached, see
+    render_template(). With lint_first, templates failing lint_template()
+    are not deployed.
+
+    Return the stack name. With dry, nothing is deployed and a dict of the
+    stack name, rendered template, tags, template size and nested stack
+    templates is returned instead, see print_dry_run().
+    """
+    if lint_first:
+        problems = lint_template(tpl_file, config)
+        if lint.errors(problems):
+            raise TemplateError('Template {} failed linting:\n{}'.format(tpl_file.name, lint.format_problems(problems)))
+        tpl_file.seek(0)
+    artifact = render_template(tpl_file, config, parallel_lookups, use_cache)
+    tpl, metadata, md5 = artifact['template'], artifact['metadata'], artifact['md5']
+
+    tags, name_from_metadata, disable_rollback = stack_settings(metadata, config['env'], md5)
 
     if not stack_name:
         stack_name = name_from_metadata
     if not stack_name:
-        print('Stack name must be specified via command line argument or stack metadata.')
-        sys.exit(1)
+        raise StacksError('Stack name must be specified via command line argument or stack metadata.')
+
+    children = None
+    if split:
+        tpl, children = split_rendered(tpl)
+        if children:
+            md5 = None
 
     tpl_size = len(tpl)
+    metrics.histogram('stacks_template_size_bytes', 'Rendered template size in bytes',
+                      metrics.SIZE_BUCKETS).observe(tpl_size)
 
     if dry:
-        print(tpl, flush=True)
-        print('Name: {}'.format(stack_name), file=sys.stderr, flush=True)
-        print('Tags: ' + ', '.join(['{}={}'.format(k, v) for (k, v) in tags.items()]), file=sys.stderr, flush=True)
-        print('Template size:', tpl_size, file=sys.stderr, flush=True)
-        return True
-
-    if tpl_size > 51200:
-        tpl_url = upload_template(config, tpl, stack_name)
+        return {
+            'name': stack_name,
+            'template': tpl,
+            'tags': tags,
+            'size': tpl_size,
+            'children': children or {},
+        }
+
+    return deploy_template(conn, config, stack_name, tpl, tags, disable_rollback, children, md5, update,
+                           create_on_update, validate)
+
+
+def split_rendered(tpl):
+    """Return a tuple of a rendered template and its nested stack templates
+
+    Templates within CloudFormation limits are returned as is, without nested
+    stack templates.
+    """
+    template = json.loads(tpl)
+    if not needs_split(template, len(tpl)):
+        return tpl, None
+    parent, children = split_template(template)
+    return json.dumps(parent, indent=2, sort_keys=True), children
+
+
+def stack_settings(metadata, env, md5):
+    """Return a tuple of the tags, name and disable_rollback setting of a stack
+
+    Env and MD5Sum tags are always set and cannot be overwritten by tags from
+    the template metadata.
+    """
+    default_tags = {
+        'Env': env,
+        'MD5Sum': md5
+    }
+    if not metadata:
+        return default_tags, None, None
+    tags = _extract_tags(metadata)
+    tags.update(default_tags)
+    return tags, metadata.get('name'), metadata.get('disable_rollback')
+
+
+def deploy_template(conn, config, stack_name, tpl, tags, disable_rollback=None, children=None, md5=None,
+                    update=False, create_on_update=False, validate=False):
+    """Create or update a stack from a rendered template
+
+    children are the nested stack templates of a split template, they are
+    uploaded to S3 first. Templates exceeding MAX_TEMPLATE_BODY_SIZE are
+    uploaded to S3 as well. Return the stack name.
+    """
+    if children:
+        tpl = upload_nested_templates(config, json.loads(tpl), children, stack_name)
+    tpl_size = len(tpl)
+
+    if tpl_size > MAX_TEMPLATE_BODY_SIZE:
+        tpl_url = upload_template(config, tpl, stack_name, md5=md5)
         tpl_body = None
     else:
         tpl_url = None
         tpl_body = tpl
 
+    if validate:
+        result = validate_template(conn, tpl, tpl_url)
+        if not result['valid']:
+            raise TemplateError(result['error'])
+
     try:
         if update and create_on_update and not stack_exists(conn, stack_name):
             conn.create_stack(stack_name, template_url=tpl_url, template_body=tpl_body,
@@ -218,19 +593,100 @@ def create_stack(conn, stack_name, tpl_file, config, update=False, dry=False, cr
                               tags=tags, capabilities=['CAPABILITY_IAM'],
                               disable_rollback=disable_rollback)
     except BotoServerError as err:
-        # Do not exit with 1 when one of the below messages are returned
-        non_error_messages = [
-            'No updates are to be performed',
-            'already exists',
-        ]
-        if any(s in err.message for s in non_error_messages):
-            print(err.message)
-            sys.exit(0)
-        print(err.message)
-        sys.exit(1)
+        raise from_boto(err)
     return stack_name
 
 
+def validate_template(conn, tpl, tpl_url=None, upload=None):
+    """Validate a rendered template
+
+    Results are cached by the template MD5 sum, so unchanged templates are
+    validated only once. Templates larger than MAX_TEMPLATE_BODY_SIZE must be
+    passed as an S3 tpl_url, or are uploaded by calling upload(), which
+    returns the URL, only if there is no cached result. Return a dict with
+    the validation result.
+    """
+    h = _calc_md5(tpl)
+    cache_file = cache.cache_path('validate', h + '.json')
+    result = cache.load_json(cache_file)
+    if result:
+        result['cached'] = True
+        return result
+
+    if tpl_url is None and upload is not None and len(tpl) > MAX_TEMPLATE_BODY_SIZE:
+        tpl_url = upload()
+
+    result = {'md5': h, 'valid': True, 'error': None, 'description': None, 'parameters': [], 'capabilities': []}
+    try:
+        if tpl_url:
+            t = _validate_template(conn, template_url=tpl_url)
+        else:
+            t = _validate_template(conn, template_body=tpl)
+        result['description'] = t.description
+        result['parameters'] = [p.parameter_key for p in t.template_parameters or []]
+        result['capabilities'] = [c.value for c in t.capabilities or []]
+    except BotoServerError as err:
+        if err.code != 'ValidationError':
+            raise from_boto(err)
+        result['valid'] = False
+        result['error'] = err.message
+
+    cache.save_json(cache_file, result)
+    result['cached'] = False
+    return result
+
+
+@throttling_retry
+def _validate_template(conn, template_body=None, template_url=None):
+    return conn.validate_template(template_body=template_body, template_url=template_url)
+
+
+def validate_templates(conn, tpl_files, config, jobs=None):
+    """Render templates, then validate them concurrently
+
+    Templates too large to be validated inline are uploaded to S3 by the
+    validating thread, unless their validation result is cached. Return a
+    list of (template file name, validation result) tuples.
+    """
+    rendered = []
+    for tpl_file in tpl_files:
+        tpl, metadata = gen_template(tpl_file, config)
+        stack_name = metadata.get('name') if metadata else None
+        if not stack_name:
+            stack_name = path.splitext(path.basename(tpl_file.name))[0]
+        rendered.append((tpl_file.name, tpl, stack_name))
+
+    def validate(r):
+        _, tpl, stack_name = r
+        return validate_template(conn, tpl, upload=lambda: upload_template(config, tpl, stack_name))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(validate, rendered)
+        return [(r[0], result) for r, result in zip(rendered, results)]
+
+
+def print_dry_run(result):
+    """Print the template of a dry run of create_stack() and its settings to stderr"""
+    print(result['template'], flush=True)
+    print('Name: {}'.format(result['name']), file=sys.stderr, flush=True)
+    print('Tags: ' + ', '.join(['{}={}'.format(k, v) for (k, v) in result['tags'].items()]),
+          file=sys.stderr, flush=True)
+    print('Template size:', result['size'], file=sys.stderr, flush=True)
+    for child, child_tpl in result['children'].items():
+        print('Nested stack {}: {} resources, template size: {}'.format(
+            child, len(child_tpl['Resources']), len(json.dumps(child_tpl, indent=2, sort_keys=True))),
+            file=sys.stderr, flush=True)
+
+
+def print_validation(results):
+    """Print tabulated validation results"""
+    rows = []
+    for fname, r in results:
+        status = 'VALID' if r['valid'] else 'INVALID'
+        rows.append([fname, r['md5'], status, 'cached' if r['cached'] else '', r['error'] or ''])
+    print(tabulate(rows, tablefmt='plain'), flush=True)
+
+
 def _extract_tags(metadata):
     """Return tags from a metadata"""
     tags = {}
@@ -245,30 +701,105 @@ def _calc_md5(j):
     return hashlib.md5(j.encode()).hexdigest()
 
 
-def delete_stack(conn, stack_name, region, profile, confirm):
+def delete_stack(conn, stack_name):
     """Deletes stack given its name"""
-    msg = ('You are about to delete the following stack:\n'
-           'Name: {}\n'
-           'Region: {}\n'
-           'Profile: {}\n').format(stack_name, region, profile)
-    if not confirm:
-        print(msg)
-        response = input('Are you sure? [y/N] ')
-    else:
-        response = 'yes'
+    try:
+        conn.delete_stack(stack_name)
+    except BotoServerError as err:
+        raise from_boto(err)
+
+
+def deletion_plan(conn, pattern, jobs=None):
+    """Return waves of stacks matching a unix shell-style pattern to delete
+
+    Stacks depending on others come in earlier waves than the stacks they
+    reference.
+    """
+    names = sorted(s.stack_name for s in iter_stacks(conn, pattern))
+    if not names:
+        return []
+    return deletion_waves(stack_dependencies(conn, names, jobs))
 
-    if response in YES:
-        try:
-            conn.delete_stack(stack_name)
-        except BotoServerError as err:
-            if 'does not exist' in err.message:
-                print(err.message)
-                sys.exit(0)
-            else:
-                print(err.message)
-                sys.exit(1)
-    else:
-        sys.exit(0)
+
+def delete_stacks(conn, waves, jobs=None, interval=5, report=None):
+    """Delete stacks in waves
+
+    Every stack in a wave is deleted concurrently and the next wave starts
+    once all of them are deleted. Deletion stops after a wave in which a stack
+    failed to delete. report is passed on to wait_stacks(). Return a dict of
+    final statuses keyed by stack name.
+    """
+    results = {}
+    for wave in waves:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(lambda name: _delete(conn, name), wave))
+        results.update(wait_stacks(conn, wave, interval=interval,
+                                   terminal_states=DELETED_STACK_STATES + ['DELETE_FAILED'], report=report))
+        if any(results[name] not in DELETED_STACK_STATES + [None] for name in wave):
+            break
+    return results
+
+
+def _delete(conn, stack_name):
+    """Delete a stack, retrying when throttled"""
+    try:
+        _delete_stack(conn, stack_name)
+    except BotoServerError as err:
+        raise from_boto(err)
+
+
+@throttling_retry
+def _delete_stack(conn, stack_name):
+    return conn.delete_stack(stack_name)
+
+
+def stack_dependencies(conn, stack_names, jobs=None):
+    """Return a dict of sets of stacks each stack depends on
+
+    A stack depends on another one when it imports one of the other stack's
+    exports with Fn::ImportValue. Exports are listed once, the stacks
+    importing them concurrently.
+    """
+    names = set(stack_names)
+    try:
+        exports = [(export, stack) for export, (_, stack) in sorted(list_exports(conn).items()) if stack in names]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            importers = list(executor.map(lambda export: list_imports(conn, export[0]), exports))
+    except BotoServerError as err:
+        raise from_boto(err)
+
+    dependencies = dict((name, set()) for name in stack_names)
+    for (_, exporter), stacks in zip(exports, importers):
+        for importer in stacks:
+            if importer in dependencies and importer != exporter:
+                dependencies[importer].add(exporter)
+    return dependencies
+
+
+def deletion_waves(dependencies):
+    """Return a list of waves of stacks in a safe deletion order
+
+    A stack is deleted only after all stacks depending on it. Dependency
+    cycles raise StacksError.
+    """
+    found = lint.cycles(dependencies)
+    if found:
+        raise StacksError('Circular stack dependencies: {}'.format(
+            ', '.join(' -> '.join(cycle + cycle[:1]) for cycle in found)))
+    remaining = set(dependencies)
+    waves = []
+    while remaining:
+        referenced = set()
+        for name in remaining:
+            referenced |= dependencies[name] & remaining
+        wave = sorted(remaining - referenced)
+        waves.append(wave)
+        remaining -= set(wave)
+    return waves
+
+
+def wave_rows(waves):
+    return [['Wave {}:'.format(i + 1), ', '.join(wave)] for i, wave in enumerate(waves)]
 
 
 def get_events(conn, stack_name, next_token):
@@ -278,12 +809,7 @@ def get_events(conn, stack_name, next_token):
         next_token = events.next_token
         return sorted_events(events), next_token
     except BotoServerError as err:
-        if 'does not exist' in err.message:
-            print(err.message)
-            sys.exit(0)
-        else:
-            print(err.message)
-            sys.exit(1)
+        raise from_boto(err)
 
 
 def sorted_events(events):
@@ -291,55 +817,186 @@ def sorted_events(events):
     return sorted(events, key=attrgetter('timestamp'))
 
 
-def print_events(conn, stack_name, follow, lines=100, from_timestamp=0):
-    """Prints tabulated list of events"""
-    events_display = []
-    seen_ids = set()
-    next_token = None
-    from_timestamp = datetime.fromtimestamp(from_timestamp)
+def follow_events(conn, stack_name, report, from_timestamp=None, interval=5, nested=True):
+    """Poll stack events until the stack is no longer in progress
 
-    while True:
-        events, next_token = get_events(conn, stack_name, next_token)
-        status = get_stack_status(conn, stack_name)
-        if follow:
-            events_display = [(event.timestamp, event.resource_status, event.resource_type,
-                               event.logical_resource_id, event.resource_status_reason) for event in events
-                              if event.event_id not in seen_ids and event.timestamp >= from_timestamp]
-            if len(events_display) > 0:
-                print(tabulate(events_display, tablefmt='plain'), flush=True)
-                seen_ids |= set([event.event_id for event in events])
-            if status not in IN_PROGRESS_STACK_STATES and next_token is None:
-                break
-            if next_token is None:
-                time.sleep(5)
-        else:
-            events_display.extend([(event.timestamp, event.resource_status, event.resource_type,
-                                    event.logical_resource_id, event.resource_status_reason)
-                                   for event in events])
-            if len(events_display) >= lines or next_token is None:
+    report is called with every batch of new events since from_timestamp,
+    oldest first. With nested, nested stacks are discovered from the events
+    of their parents and their events are polled concurrently and merged into
+    the batches. Events have a depth attribute, 0 for events of the stack
+    itself. Return the final stack status, which is the status of the stack
+    itself.
+    """
+    from_timestamp = from_timestamp or datetime.fromtimestamp(0)
+    streams = OrderedDict([(stack_name, EventStream(stack_name, 0))])
+    limiter = RateLimiter(EVENTS_RATE)
+    start = time.time()
+
+    with ThreadPoolExecutor() as executor:
+        while True:
+            polling = list(streams.values())
+            polled = list(executor.map(lambda stream: stream.poll(conn, limiter, from_timestamp), polling))
+            status = get_stack_status(conn, stack_name)
+            new_events = sorted_events(e for events in polled for e in events)
+            if len(new_events) > 0:
+                report(new_events)
+            discovered = False
+            for stream, events in zip(polling, polled):
+                for stack_id in nested_stack_ids(events) if nested else ():
+                    if stack_id not in streams:
+                        streams[stack_id] = EventStream(stack_id, stream.depth + 1)
+                        discovered = True
+            paging = any(stream.next_token for stream in polling)
+            # Nested stacks discovered last are polled once more
+            if status not in IN_PROGRESS_STACK_STATES and not paging and not discovered:
                 break
+            if not paging:
+                pause(interval)
 
-    if not follow:
-        print(tabulate(events_display[:lines], tablefmt='plain'), flush=True)
-
+    metrics.histogram('stacks_deploy_seconds', 'Time from following stack events to a terminal state').observe(
+        time.time() - start, {'status': status})
     return status
 
 
-@throttling_retry
+class EventStream(object):
+    """Events of a stack or nested stack being followed"""
+
+    def __init__(self, stack_id, depth):
+        self.stack_id = stack_id
+        self.depth = depth
+        self.next_token = None
+        self.seen_ids = set()
+
+    def poll(self, conn, limiter, from_timestamp):
+        """Return new events of the next page since from_timestamp"""
+        limiter.wait()
+        events, self.next_token = get_events(conn, self.stack_id, self.next_token)
+        new_events = [event for event in events
+                      if event.event_id not in self.seen_ids and event.timestamp >= from_timestamp]
+        self.seen_ids |= set([event.event_id for event in events])
+        for event in new_events:
+            event.depth = self.depth
+        return new_events
+
+
+def nested_stack_ids(events):
+    """Return ids of the nested stacks of stack events, in order of appearance"""
+    ids = []
+    for event in events:
+        stack_id = event.physical_resource_id
+        # Events of the stack itself are AWS::CloudFormation::Stack events too
+        if event.resource_type == NESTED_STACK_TYPE and stack_id and stack_id != event.stack_id \
+                and stack_id not in ids:
+            ids.append(stack_id)
+    return ids
+
+
+def tail_events(conn, stack_name, lines=100, since=None, until=None):
+    """Return the last lines stack events between since and until, oldest first
+
+    Only the most recent events are kept in a bounded heap. CloudFormation
+    returns events newest first, so pagination stops as soon as a page is
+    older than since or than every event kept.
+    """
+    kept = []
+    seq = 0
+    next_token = None
+    while lines > 0:
+        events, next_token = get_events(conn, stack_name, next_token)
+        for event in events:
+            if (since and event.timestamp < since) or (until and event.timestamp > until):
+                continue
+            # Events sharing a timestamp keep their API order, newest first
+            seq += 1
+            item = (event.timestamp, -seq, event)
+            if len(kept) < lines:
+                heapq.heappush(kept, item)
+            elif item[:2] > kept[0][:2]:
+                heapq.heapreplace(kept, item)
+
+        if next_token is None or not events:
+            break
+        oldest = events[0].timestamp
+        if since and oldest < since:
+            break
+        if len(kept) >= lines and oldest < kept[0][0]:
+            break
+
+    return [event for _, _, event in sorted(kept, key=lambda item: item[:2])]
+
+
 def get_stack_status(conn, stack_name):
-    """Check stack status"""
-    stacks = []
-    resp = conn.list_stacks()
-    stacks.extend(resp)
-    while resp.next_token:
-        resp = conn.list_stacks(next_token=resp.next_token)
-        stacks.extend(resp)
-    for s in stacks:
-        if s.stack_name == stack_name and s.stack_status != 'DELETE_COMPLETE':
+    """Check stack status
+
+    Only live stacks are listed, so the listing stops at the first match.
+    """
+    for s in iter_stacks(conn, stack_name):
+        if s.stack_name == stack_name:
             return s.stack_status
     return None
 
 
+def get_stack_statuses(conn, names=None):
+    """Return a dict of live stack statuses keyed by stack name
+
+    Makes a single paginated list_stacks sweep, which leaves out the deleted
+    stacks CF keeps around. With names, only statuses of those stacks are
+    returned.
+    """
+    statuses = {}
+    for s in iter_stacks(conn):
+        if names is None or s.stack_name in names:
+            statuses[s.stack_name] = s.stack_status
+    return statuses
+
+
+def wait_stacks(conn, names, timeout=None, interval=5, terminal_states=TERMINAL_STACK_STATES, report=None):
+    """Wait for stacks to reach a terminal state
+
+    names can be stack names or unix shell-style patterns, which are matched
+    against live stacks. The stacks are polled with one sweep of live stack
+    statuses per interval, and report is called with a list of [name, status]
+    rows of stacks as soon as they are done. Return a dict of statuses keyed by
+    stack name; stacks which do not exist have a None status, stacks deleted
+    meanwhile a DELETE_COMPLETE status and stacks still in progress after
+    timeout keep their last status.
+    """
+    deadline = time.time() + timeout if timeout else None
+    statuses = get_stack_statuses(conn)
+
+    pending = set()
+    for name in names:
+        if any(c in name for c in '*?['):
+            pending |= set(n for n in statuses if fnmatch(n, name))
+        else:
+            pending.add(name)
+    existing = set(statuses) & pending
+
+    results = {}
+    while True:
+        done = []
+        for name in sorted(pending):
+            status = statuses.get(name)
+            if status is None and name in existing:
+                status = DELETED_STACK_STATES[0]
+            if status is None or status in terminal_states:
+                done.append([name, status or 'DOES_NOT_EXIST'])
+                results[name] = status
+        if done and report:
+            report(done)
+        pending -= set(results)
+
+        if not pending:
+            break
+        if deadline and time.time() >= deadline:
+            results.update((name, statuses.get(name)) for name in pending)
+            break
+        pause(interval)
+        statuses = get_stack_statuses(conn, pending)
+
+    return results
+
+
 def stack_exists(conn, stack_name):
     """Check whether stack_name exists
 
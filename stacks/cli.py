@@ -1,6 +1,9 @@
+import re
 import os.path
 import configargparse
 
+from datetime import datetime, timedelta
+
 from stacks import __about__
 
 
@@ -13,6 +16,17 @@ def parse_options():
     parser.add_argument('-p', '--profile', required=False)
     parser.add_argument('-r', '--region', required=False)
     parser.add_argument('--version', action='version', version=__about__.__version__)
+    parser.add_argument('--metrics-file', env_var='STACKS_METRICS_FILE', required=False,
+                        help='Write Prometheus metrics to a file at exit')
+    parser.add_argument('--metrics-push', env_var='STACKS_METRICS_PUSH', required=False,
+                        help='Push Prometheus metrics to a Pushgateway URL at exit')
+    parser.add_argument('--exports-ttl', env_var='STACKS_EXPORTS_TTL', type=int, default=0, metavar='SECONDS',
+                        help='Cache the CloudFormation exports index for this long across runs')
+    cassettes = parser.add_mutually_exclusive_group()
+    cassettes.add_argument('--record', metavar='DIR', dest='record_dir', required=False,
+                           help='Record AWS API responses to a directory')
+    cassettes.add_argument('--replay', metavar='DIR', dest='replay_dir', required=False,
+                           help='Replay AWS API responses recorded to a directory instead of calling AWS')
     subparsers = parser.add_subparsers(title='available subcommands', dest='subcommand')
 
     parser_resources = subparsers.add_parser('resources', help='List stack resources')
@@ -21,9 +35,13 @@ def parse_options():
                                   help='Logical resource id. Returns physical_resource_id.')
 
     parser_outputs = subparsers.add_parser('outputs', help='List stack outputs')
-    parser_outputs.add_argument('name', help='Stack name')
+    parser_outputs.add_argument('name', nargs='?', default=None, help='Stack name')
     parser_outputs.add_argument('output_name', nargs='?', default=None,
                                 help='Output name. Returns output value.')
+    parser_outputs.add_argument('--pattern', default=None,
+                                help='Export outputs of all stacks matching a unix shell-style pattern')
+    parser_outputs.add_argument('--format', default='text', choices=['text', 'env', 'json'],
+                                help='Output format of outputs of --pattern stacks')
 
     parser_config = subparsers.add_parser('config', help='Print config properties')
     parser_config.add_argument('-e', '--env', env_var='STACKS_ENV')
@@ -39,6 +57,11 @@ def parse_options():
 
     parser_list = subparsers.add_parser('list', help='List stacks')
     parser_list.add_argument('-v', '--verbose', action='store_true')
+    parser_list.add_argument('-s', '--status', action='append', type=str.upper, metavar='STATUS',
+                             help='Only list stacks in this status, can be given multiple times '
+                                  '(default: all but deleted stacks)')
+    parser_list.add_argument('-n', '--limit', type=int, default=None,
+                             help='Stop listing after this many stacks')
     parser_list.add_argument('name', default='*', nargs='?',
                              help='Stack name or unix shell-style pattern')
 
@@ -55,6 +78,16 @@ def parse_options():
     parser_create.add_argument('-P', '--property', required=False, action='append')
     parser_create.add_argument('-d', '--dry-run', action='store_true')
     parser_create.add_argument('-f', '--follow', dest='events_follow', help='Follow stack events', action='store_true')
+    parser_create.add_argument('--parallel-lookups', action='store_true',
+                               help='Resolve template lookups concurrently before rendering')
+    parser_create.add_argument('--validate', action='store_true',
+                               help='Validate template before creating or updating a stack')
+    parser_create.add_argument('--lint', dest='lint_first', action='store_true',
+                               help='Lint template before creating or updating a stack')
+    parser_create.add_argument('--split', action='store_true',
+                               help='Split templates exceeding CloudFormation limits into nested stacks')
+    parser_create.add_argument('--cache', dest='use_cache', action='store_true',
+                               help='Reuse the cached rendered template if it is up to date')
 
     parser_update = subparsers.add_parser('update', help='Update an existing stack')
     parser_update.add_argument('-t', '--template', required=True, type=configargparse.FileType())
@@ -72,17 +105,193 @@ def parse_options():
                                help='Create if stack does not exist.',
                                action='store_true')
     parser_update.add_argument('-f', '--follow', dest='events_follow', help='Follow stack events', action='store_true')
+    parser_update.add_argument('--parallel-lookups', action='store_true',
+                               help='Resolve template lookups concurrently before rendering')
+    parser_update.add_argument('--validate', action='store_true',
+                               help='Validate template before creating or updating a stack')
+    parser_update.add_argument('--lint', dest='lint_first', action='store_true',
+                               help='Lint template before creating or updating a stack')
+    parser_update.add_argument('--split', action='store_true',
+                               help='Split templates exceeding CloudFormation limits into nested stacks')
+    parser_update.add_argument('--cache', dest='use_cache', action='store_true',
+                               help='Reuse the cached rendered template if it is up to date')
+
+    parser_render = subparsers.add_parser('render', help='Render templates offline for one or more environments')
+    parser_render.add_argument('-t', '--template', required=True, action='append', dest='templates',
+                               help='Template file. Can be specified multiple times.')
+    parser_render.add_argument('-e', '--env', required=True, action='append', dest='envs',
+                               help='Environment name. Can be specified multiple times.')
+    parser_render.add_argument('-c', '--config', default='config.yaml',
+                               env_var='STACKS_CONFIG', required=False,
+                               type=_is_file)
+    parser_render.add_argument('--config-dir', default='config.d',
+                               env_var='STACKS_CONFIG_DIR', required=False,
+                               type=_is_dir)
+    parser_render.add_argument('-P', '--property', required=False, action='append')
+    parser_render.add_argument('-o', '--output-dir', default='rendered',
+                               help='Directory to write rendered templates to')
+    parser_render.add_argument('-j', '--jobs', type=int, default=None,
+                               help='Number of worker processes. Defaults to the number of CPUs.')
+    parser_render.add_argument('-w', '--watch', action='store_true',
+                               help='Re-render templates as they, their snippets or config files change')
+    parser_render.add_argument('--interval', type=float, default=0.5,
+                               help='Seconds between checks for changed files when watching')
+
+    parser_durations = subparsers.add_parser('durations', help='Show recorded resource deploy durations')
+    parser_durations.add_argument('name', default='*', nargs='?',
+                                  help='Stack name or unix shell-style pattern')
+    parser_durations.add_argument('-o', '--output', dest='output_format', default='text', choices=['text', 'json'],
+                                  help='Output format')
+
+    parser_lint = subparsers.add_parser('lint', help='Check rendered templates offline for common mistakes')
+    parser_lint.add_argument('-t', '--template', required=True, action='append', dest='templates',
+                             help='Template file. Can be specified multiple times.')
+    parser_lint.add_argument('-e', '--env', required=True, action='append', dest='envs',
+                             help='Environment name. Can be specified multiple times.')
+    parser_lint.add_argument('-c', '--config', default='config.yaml',
+                             env_var='STACKS_CONFIG', required=False,
+                             type=_is_file)
+    parser_lint.add_argument('--config-dir', default='config.d',
+                             env_var='STACKS_CONFIG_DIR', required=False,
+                             type=_is_dir)
+    parser_lint.add_argument('-P', '--property', required=False, action='append')
+    parser_lint.add_argument('-j', '--jobs', type=int, default=None,
+                             help='Number of worker processes. Defaults to the number of CPUs.')
+
+    parser_index = subparsers.add_parser('index', help='Map stack names to templates from template metadata')
+    parser_index.add_argument('-t', '--template', required=True, action='append', dest='templates',
+                              help='Template file or directory. Can be specified multiple times.')
+    parser_index.add_argument('-e', '--env', required=True,
+                              help='Environment name')
+    parser_index.add_argument('-c', '--config', default='config.yaml',
+                              env_var='STACKS_CONFIG', required=False,
+                              type=_is_file)
+    parser_index.add_argument('--config-dir', default='config.d',
+                              env_var='STACKS_CONFIG_DIR', required=False,
+                              type=_is_dir)
+    parser_index.add_argument('-P', '--property', required=False, action='append')
+    parser_index.add_argument('name', default='*', nargs='?',
+                              help='Stack name or unix shell-style pattern')
+    parser_index.add_argument('--changed', action='append',
+                              help='Only list stacks whose template depends on this file. '
+                                   'Can be specified multiple times.')
+    parser_index.add_argument('-j', '--jobs', type=int, default=None,
+                              help='Number of worker threads')
+    parser_index.add_argument('--no-cache', dest='use_cache', action='store_false',
+                              help='Render template metadata even if it is cached')
+    parser_index.add_argument('-o', '--output', dest='output_format', default='text', choices=['text', 'json'],
+                              help='Output format')
+
+    parser_rollout = subparsers.add_parser('rollout',
+                                           help='Deploy a template to many environments and regions in waves')
+    parser_rollout.add_argument('-t', '--template', required=True, help='Template file')
+    parser_rollout.add_argument('-c', '--config', default='config.yaml',
+                                env_var='STACKS_CONFIG', required=False,
+                                type=_is_file)
+    parser_rollout.add_argument('--config-dir', default='config.d',
+                                env_var='STACKS_CONFIG_DIR', required=False,
+                                type=_is_dir)
+    parser_rollout.add_argument('name', nargs='?', default=None)
+    parser_rollout.add_argument('-e', '--env', required=True, action='append', dest='envs',
+                                help='Environment name. Can be specified multiple times.')
+    parser_rollout.add_argument('--target-region', action='append', dest='regions',
+                                help='Region to deploy to. Can be specified multiple times. Defaults to --region.')
+    parser_rollout.add_argument('-P', '--property', required=False, action='append')
+    parser_rollout.add_argument('--canary', type=int, default=1,
+                                help='Number of targets deployed in the first wave')
+    parser_rollout.add_argument('-j', '--jobs', type=int, default=None,
+                                help='Number of targets deployed concurrently after the canary wave')
+    parser_rollout.add_argument('--failure-budget', type=int, default=0,
+                                help='Number of failed targets tolerated before the rollout stops')
+    parser_rollout.add_argument('--create', dest='create_on_update',
+                                help='Create stacks which do not exist.',
+                                action='store_true')
+    parser_rollout.add_argument('-y', '--yes', help='Confirm the rollout.', action='store_true')
+    parser_rollout.add_argument('-d', '--dry-run', action='store_true')
+    parser_rollout.add_argument('-f', '--follow', dest='events_follow', help='Follow stack events',
+                                action='store_true')
+    parser_rollout.add_argument('--parallel-lookups', action='store_true',
+                                help='Resolve template lookups concurrently before rendering')
+    parser_rollout.add_argument('--validate', action='store_true',
+                                help='Validate template before creating or updating a stack')
+    parser_rollout.add_argument('--lint', dest='lint_first', action='store_true',
+                                help='Lint template before creating or updating a stack')
+    parser_rollout.add_argument('--split', action='store_true',
+                                help='Split templates exceeding CloudFormation limits into nested stacks')
+    parser_rollout.add_argument('--cache', dest='use_cache', action='store_true',
+                                help='Reuse the cached rendered template if it is up to date')
+
+    parser_bundle = subparsers.add_parser('bundle', help='Render templates into a bundle deployed by deploy-bundle')
+    parser_bundle.add_argument('-t', '--template', required=True, action='append', dest='templates',
+                               help='Template file. Can be specified multiple times.')
+    parser_bundle.add_argument('-e', '--env', required=True)
+    parser_bundle.add_argument('-c', '--config', default='config.yaml',
+                               env_var='STACKS_CONFIG', required=False,
+                               type=_is_file)
+    parser_bundle.add_argument('--config-dir', default='config.d',
+                               env_var='STACKS_CONFIG_DIR', required=False,
+                               type=_is_dir)
+    parser_bundle.add_argument('-P', '--property', required=False, action='append')
+    parser_bundle.add_argument('-o', '--output-dir', default='bundle',
+                               help='Directory to write the bundle to')
+    parser_bundle.add_argument('-j', '--jobs', type=int, default=None,
+                               help='Number of templates rendered concurrently')
+    parser_bundle.add_argument('--split', action='store_true',
+                               help='Split templates exceeding CloudFormation limits into nested stacks')
+    parser_bundle.add_argument('--cache', dest='use_cache', action='store_true',
+                               help='Reuse cached rendered templates if they are up to date')
+
+    parser_deploy_bundle = subparsers.add_parser('deploy-bundle',
+                                                 help='Create or update the stacks of a bundle without rendering')
+    parser_deploy_bundle.add_argument('bundle_dir', help='Bundle directory written by stacks bundle')
+    parser_deploy_bundle.add_argument('-j', '--jobs', type=int, default=None,
+                                      help='Number of stacks deployed concurrently within a wave')
+    parser_deploy_bundle.add_argument('-y', '--yes', help='Confirm the deploy.', action='store_true')
+    parser_deploy_bundle.add_argument('-d', '--dry-run', action='store_true',
+                                      help='Only print the deploy plan')
+    parser_deploy_bundle.add_argument('--validate', action='store_true',
+                                      help='Validate templates before creating or updating stacks')
+
+    parser_validate = subparsers.add_parser('validate', help='Validate templates')
+    parser_validate.add_argument('-t', '--template', required=True, action='append', dest='templates',
+                                 type=configargparse.FileType(),
+                                 help='Template file. Can be specified multiple times.')
+    parser_validate.add_argument('-c', '--config', default='config.yaml',
+                                 env_var='STACKS_CONFIG', required=False,
+                                 type=_is_file)
+    parser_validate.add_argument('--config-dir', default='config.d',
+                                 env_var='STACKS_CONFIG_DIR', required=False,
+                                 type=_is_dir)
+    parser_validate.add_argument('-e', '--env', env_var='STACKS_ENV', required=True)
+    parser_validate.add_argument('-P', '--property', required=False, action='append')
+    parser_validate.add_argument('-j', '--jobs', type=int, default=None,
+                                 help='Number of concurrent validations')
 
     parser_delete = subparsers.add_parser('delete', help='Delete an existing stack')
     parser_delete.add_argument('-f', '--follow', dest='events_follow', help='Follow stack events', action='store_true')
     parser_delete.add_argument('-y', '--yes', help='Confirm stack deletion.', action='store_true')
-    parser_delete.add_argument('name')
+    parser_delete.add_argument('--pattern', default=None,
+                               help='Delete all stacks matching a unix shell-style pattern')
+    parser_delete.add_argument('-j', '--jobs', type=int, default=None,
+                               help='Number of stacks deleted concurrently with --pattern')
+    parser_delete.add_argument('name', nargs='?', default=None)
 
     parser_events = subparsers.add_parser('events', help='List events from a stack')
     parser_events.add_argument('name')
     parser_events.add_argument('-f', '--follow', dest='events_follow', action='store_true',
                                help='Poll for new events until stopped (overrides -n)')
     parser_events.add_argument('-n', '--lines', default='10', type=int)
+    parser_events.add_argument('--since', type=_timestamp, default=None,
+                               help='Show events newer than a UTC timestamp (2017-01-31T12:00) '
+                                    'or a relative time (30m, 2h, 7d)')
+    parser_events.add_argument('--until', type=_timestamp, default=None,
+                               help='Show events older than a timestamp or a relative time')
+
+    parser_wait = subparsers.add_parser('wait', help='Wait for stacks to finish updating')
+    parser_wait.add_argument('names', nargs='+', metavar='name',
+                             help='Stack name or unix shell-style pattern')
+    parser_wait.add_argument('--timeout', type=int, default=None, help='Give up after this many seconds')
+    parser_wait.add_argument('--interval', type=int, default=5, help='Seconds between status checks')
 
     return parser, parser.parse_args()
 
@@ -101,3 +310,20 @@ def _is_dir(dirname):
     To be used as a type argument in add_argument()
     """
     return dirname if os.path.isdir(dirname) else None
+
+
+def _timestamp(value):
+    """Parse an absolute UTC or relative (e.g. 30m, 2h, 7d) time
+
+    To be used as a type argument in add_argument()
+    """
+    units = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days', 'w': 'weeks'}
+    m = re.match(r'^(\d+)([smhdw])$', value)
+    if m:
+        return datetime.utcnow() - timedelta(**{units[m.group(2)]: int(m.group(1))})
+    for fmt in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d']:
+        try:
+            return datetime.strptime(value.rstrip('Z'), fmt)
+        except ValueError:
+            pass
+    raise configargparse.ArgumentTypeError('invalid time: {}'.format(value))
@@ -0,0 +1,238 @@
+"""
+Python API to stacks
+
+StacksClient holds the config, AWS connections and caches of an environment.
+Its methods return structured results and raise stacks.exceptions errors
+rather than printing and exiting, so it can be driven from long running
+processes. The stacks command line is a thin layer on top of it.
+"""
+from contextlib import contextmanager
+
+from stacks import aws
+from stacks import bundle
+from stacks import cf
+from stacks.backend import Backend
+from stacks.config import config_load, get_profile, get_region, validate_properties, MEMO_KEY
+from stacks.exceptions import ConfigError
+from stacks.states import LIVE_STACK_STATES
+
+# Config keys of AWS clients mapped to their service
+CONNECTIONS = [
+    ('ec2_conn', 'ec2'),
+    ('vpc_conn', 'vpc'),
+    ('cf_conn', 'cloudformation'),
+    ('r53_conn', 'route53'),
+    ('s3_conn', 's3'),
+]
+
+
+def connect(backend, region, profile=None):
+    """Return a dict of pooled AWS clients keyed by their config key"""
+    return dict((key, backend.client(service, region, profile)) for key, service in CONNECTIONS)
+
+
+def lookup_helpers():
+    """Return a dict of template lookup helpers keyed by their name"""
+    return {
+        'get_ami_id': aws.get_ami_id,
+        'get_vpc_id': aws.get_vpc_id,
+        'get_zone_id': aws.get_zone_id,
+        'get_stack_output': aws.get_stack_output,
+        'get_stack_resource': aws.get_stack_resource,
+        'get_export': aws.get_export,
+    }
+
+
+class StacksClient(object):
+    """Manage stacks of an environment in a region
+
+    Config is loaded from config_file and config_dir for env, unless a config
+    dict is given, which is copied. properties is either a dict or a list of 'key=value'
+    strings overriding config properties. Profile and region are figured out
+    the same way as on the command line. Connections are set up right away
+    unless connect is False, see connect().
+
+    AWS clients come from a stacks.backend.Backend pool, which can be shared
+    by clients. Unless a backend is given, a new one is created, recording AWS
+    responses to record_dir or replaying them from replay_dir, see
+    stacks.cassette.
+
+    Templates can be given as file names or open file objects.
+    """
+
+    def __init__(self, env=None, region=None, profile=None, config_file=None, config_dir=None,
+                 properties=None, config=None, connect=True, record_dir=None, replay_dir=None, backend=None):
+        self.config = dict(config) if config is not None else config_load(env, config_file, config_dir)
+        if properties:
+            if not isinstance(properties, dict):
+                properties = validate_properties(properties)
+            self.config.update(properties)
+        # Lazy values are evaluated once per client
+        self.config[MEMO_KEY] = {}
+        self.profile = get_profile(profile)
+        self.region = get_region(region, self.profile)
+        self.backend = backend or Backend(record_dir, replay_dir)
+        self.config.update(lookup_helpers())
+        if connect:
+            self.connect()
+
+    def connect(self):
+        """Set up AWS clients, connections are made on first use"""
+        if not self.region:
+            raise ConfigError('Region is not specified.')
+        self.config['region'] = self.region
+        self.config.update(connect(self.backend, self.region, self.profile))
+
+    def close(self):
+        """Close AWS connections"""
+        self.backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def conn(self):
+        """CloudFormation connection"""
+        if not self.config.get('cf_conn'):
+            self.connect()
+        return self.config['cf_conn']
+
+    def render(self, template, parallel_lookups=False):
+        """Return a tuple of rendered json template and its metadata"""
+        with _open(template) as tpl_file:
+            return cf.gen_template(tpl_file, self.config, parallel_lookups)
+
+    def create(self, template, stack_name=None, dry=False, parallel_lookups=False, validate=False, split=False,
+               use_cache=False, lint_first=False):
+        """Create a stack, return its name
+
+        With dry, nothing is created and a dict of the rendered template and
+        stack settings is returned, see cf.create_stack().
+        """
+        with _open(template) as tpl_file:
+            return cf.create_stack(self.conn, stack_name, tpl_file, self.config, dry=dry,
+                                   parallel_lookups=parallel_lookups, validate=validate, split=split,
+                                   use_cache=use_cache, lint_first=lint_first)
+
+    def update(self, template, stack_name=None, create=False, dry=False, parallel_lookups=False, validate=False,
+               split=False, use_cache=False, lint_first=False):
+        """Update a stack, or create it if it does not exist and create is True
+
+        Return the stack name, or with dry a dict of the rendered template and
+        stack settings, see cf.create_stack().
+        """
+        with _open(template) as tpl_file:
+            return cf.create_stack(self.conn, stack_name, tpl_file, self.config, update=True, dry=dry,
+                                   create_on_update=create, parallel_lookups=parallel_lookups,
+                                   validate=validate, split=split, use_cache=use_cache, lint_first=lint_first)
+
+    def lint(self, template):
+        """Return a list of lint problem dicts of a template, see stacks.lint"""
+        with _open(template) as tpl_file:
+            return cf.lint_template(tpl_file, self.config)
+
+    def bundle(self, templates, output_dir, split=False, jobs=None, use_cache=False):
+        """Render template files into a bundle, return its manifest, see stacks.bundle"""
+        return bundle.create(templates, self.config, output_dir, split, jobs, use_cache)
+
+    def deploy_bundle(self, manifest, jobs=None, interval=5, validate=False, report=None):
+        """Deploy the stacks of a loaded bundle, return a list of result dicts"""
+        return bundle.deploy(self.conn, manifest, self.config, jobs, interval, validate, report)
+
+    def validate(self, templates, jobs=None):
+        """Validate templates, return a list of (file name, result) tuples"""
+        tpl_files = [_file(t) for t in templates]
+        try:
+            return cf.validate_templates(self.conn, tpl_files, self.config, jobs)
+        finally:
+            for t, tpl_file in zip(templates, tpl_files):
+                if tpl_file is not t:
+                    tpl_file.close()
+
+    def delete(self, stack_name):
+        """Delete a stack"""
+        cf.delete_stack(self.conn, stack_name)
+
+    def deletion_plan(self, pattern, jobs=None):
+        """Return waves of stacks matching pattern in a safe deletion order"""
+        return cf.deletion_plan(self.conn, pattern, jobs)
+
+    def delete_waves(self, waves, jobs=None, interval=5, report=None):
+        """Delete stacks wave by wave, return a dict of final statuses"""
+        return cf.delete_stacks(self.conn, waves, jobs, interval, report)
+
+    def resources(self, stack_name, logical_id=None):
+        """Return a list of stack resources dicts"""
+        return cf.get_resources(self.conn, stack_name, logical_id)
+
+    def outputs(self, stack_name):
+        """Return a dict of stack outputs"""
+        return cf.get_outputs(self.conn, stack_name)
+
+    def all_outputs(self, name_filter='*'):
+        """Return a dict of output dicts keyed by names of stacks matching a unix shell-style pattern"""
+        return cf.get_all_outputs(self.conn, name_filter)
+
+    def list(self, name_filter='*', states=LIVE_STACK_STATES, limit=None):
+        """Return a list of at most limit stack dicts matching a unix shell-style pattern
+
+        states lists the stack statuses to list, by default all but deleted.
+        """
+        return cf.get_stacks(self.conn, name_filter, states, limit)
+
+    def status(self, stack_name):
+        """Return stack status or None if it does not exist"""
+        return cf.get_stack_status(self.conn, stack_name)
+
+    def statuses(self):
+        """Return a dict of live stack statuses keyed by stack name"""
+        return cf.get_stack_statuses(self.conn)
+
+    def events(self, stack_name, lines=100, since=None, until=None):
+        """Return a list of the last lines stack event dicts, oldest first"""
+        return [event_dict(e) for e in cf.tail_events(self.conn, stack_name, lines, since, until)]
+
+    def follow(self, stack_name, report, from_timestamp=None, interval=5):
+        """Call report with new stack event dicts until the stack is done
+
+        Return the final stack status.
+        """
+        def report_events(events):
+            report([event_dict(e) for e in events])
+        return cf.follow_events(self.conn, stack_name, report_events, from_timestamp, interval)
+
+    def wait(self, names, timeout=None, interval=5, report=None):
+        """Wait for stacks to finish, return a dict of their statuses"""
+        return cf.wait_stacks(self.conn, names, timeout, interval, report=report)
+
+
+def event_dict(event):
+    """Return a dict of a stack event"""
+    return {
+        'event_id': event.event_id,
+        'stack_name': event.stack_name,
+        'depth': getattr(event, 'depth', 0),
+        'timestamp': event.timestamp,
+        'resource_status': event.resource_status,
+        'resource_type': event.resource_type,
+        'logical_resource_id': event.logical_resource_id,
+        'physical_resource_id': event.physical_resource_id,
+        'resource_status_reason': event.resource_status_reason,
+    }
+
+
+def _file(template):
+    return open(template) if isinstance(template, str) else template
+
+
+@contextmanager
+def _open(template):
+    """Open template if it is a file name"""
+    if isinstance(template, str):
+        with open(template) as tpl_file:
+            yield tpl_file
+    else:
+        yield template
@@ -1,12 +1,167 @@
-import sys
 import os
 import yaml
 import json
 import boto
+import threading
+
+from stacks.exceptions import ConfigError
 
 AWS_CONFIG_FILE = os.environ.get('HOME', '') + '/.aws/config'
 AWS_CREDENTIALS_FILE = os.environ.get('HOME', '') + '/.aws/credentials'
 RESERVED_PROPERTIES = ['region', 'profile', 'env']
+# Config key of the memo of lazy values evaluated in a run
+MEMO_KEY = '_lazy_values'
+
+# Lazy lookup tags mapped to a (helper, connection) pair of config keys
+LOOKUP_TAGS = {
+    '!ami_id': ('get_ami_id', 'ec2_conn'),
+    '!vpc_id': ('get_vpc_id', 'vpc_conn'),
+    '!zone_id': ('get_zone_id', 'r53_conn'),
+    '!stack_output': ('get_stack_output', 'cf_conn'),
+    '!stack_resource': ('get_stack_resource', 'cf_conn'),
+    '!export': ('get_export', 'cf_conn'),
+}
+
+_local = threading.local()
+
+
+class LazyValue(object):
+    """Config value which is evaluated only when it is used
+
+    Lazy values are written in config files as YAML tags:
+
+      !ref key                     value of another config key
+      !env VAR or !env [VAR, default]
+                                   value of an environment variable
+      !ami_id name                 AMI ID looked up by name, likewise
+                                   !vpc_id, !zone_id, !stack_output [stack, key]
+                                   !stack_resource [stack, logical_id]
+                                   and !export name
+
+    Arguments may be lazy values themselves, as may values nested in dicts and
+    lists. Values are evaluated at most once per run, see render_context().
+    """
+    def __init__(self, tag, args):
+        self.tag = tag
+        self.args = args
+        self._lock = threading.Lock()
+
+    def resolve(self, config):
+        """Evaluate the value against config
+
+        The result is memoized in the memo of config, if it has one.
+        A value evaluated while it is being evaluated by the same thread is
+        a circular reference, other threads evaluating it are fine.
+        """
+        memo = config.get(MEMO_KEY)
+        if memo is not None:
+            with self._lock:
+                if self in memo:
+                    return memo[self]
+        evaluating = _evaluating()
+        if self in evaluating:
+            raise ConfigError('Circular reference in config value {}'.format(self))
+        evaluating.add(self)
+        try:
+            value = self._evaluate(config)
+        finally:
+            evaluating.discard(self)
+        if memo is not None:
+            with self._lock:
+                value = memo.setdefault(self, value)
+        return value
+
+    def _evaluate(self, config):
+        args = [resolve(config, a) for a in self.args]
+        if self.tag == '!ref':
+            if args[0] not in config:
+                raise ConfigError('Config value {} references undefined key'.format(self))
+            return resolve(config, config[args[0]])
+        if self.tag == '!env':
+            default = args[1] if len(args) > 1 else None
+            return os.environ.get(args[0], default)
+        helper, conn = LOOKUP_TAGS[self.tag]
+        if not callable(config.get(helper)):
+            raise ConfigError('Config value {} requires AWS lookups'.format(self))
+        return config[helper](config.get(conn), *args)
+
+    def __getstate__(self):
+        # Configs are shipped to render worker processes, locks do not pickle
+        state = dict(self.__dict__)
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return '{} {}'.format(self.tag, ' '.join(str(a) for a in self.args))
+
+    def __repr__(self):
+        return '<LazyValue {}>'.format(self)
+
+
+def _evaluating():
+    """Return the set of lazy values being evaluated by the current thread"""
+    if not hasattr(_local, 'evaluating'):
+        _local.evaluating = set()
+    return _local.evaluating
+
+
+def resolve(config, value):
+    """Return value evaluated against config if it is lazy
+
+    Lazy values nested in dicts and lists are evaluated as well, containers
+    without any are returned as they are.
+    """
+    if isinstance(value, LazyValue):
+        return value.resolve(config)
+    if isinstance(value, dict):
+        items = [(k, resolve(config, v)) for k, v in value.items()]
+        if any(v is not value[k] for k, v in items):
+            return dict(items)
+    elif isinstance(value, list):
+        items = [resolve(config, v) for v in value]
+        if any(v is not orig for v, orig in zip(items, value)):
+            return items
+    return value
+
+
+def render_context(config, fresh=False):
+    """Return a copy of config to render a template with
+
+    Lazy values are memoized in the memo of config, which lasts for a run,
+    e.g. of a StacksClient. Without one, or if fresh is true, they are
+    memoized for this render only.
+    """
+    context = dict(config)
+    if fresh or MEMO_KEY not in config:
+        context[MEMO_KEY] = {}
+    return context
+
+
+class ConfigLoader(yaml.SafeLoader):
+    """YAML loader constructing lazy values from tags"""
+
+
+def _construct_lazy(loader, node):
+    if isinstance(node, yaml.SequenceNode):
+        args = loader.construct_sequence(node, deep=True)
+    else:
+        args = [loader.construct_scalar(node)]
+    return LazyValue(node.tag, args)
+
+
+def _represent_lazy(dumper, value):
+    if len(value.args) == 1:
+        return dumper.represent_scalar(value.tag, str(value.args[0]))
+    return dumper.represent_sequence(value.tag, value.args)
+
+
+for tag in ['!ref', '!env'] + list(LOOKUP_TAGS):
+    ConfigLoader.add_constructor(tag, _construct_lazy)
+yaml.add_representer(LazyValue, _represent_lazy)
 
 
 def config_load(env, config_file=None, config_dir=None):
@@ -74,7 +229,7 @@ def _merge(config, env):
 def _load_yaml(fname):
     try:
         with open(fname) as f:
-            y = yaml.load(f)
+            y = yaml.load(f, Loader=ConfigLoader)
             return y
     except:
         return None
@@ -110,6 +265,36 @@ def get_default_region_name():
     return None
 
 
+def get_profile(profile=None):
+    """Figure out profile value in the following order
+
+    - profile argument
+    - env variable
+    - default profile if exists
+    """
+    if profile:
+        return profile
+    if os.environ.get('AWS_DEFAULT_PROFILE'):
+        return os.environ.get('AWS_DEFAULT_PROFILE')
+    if profile_exists('default'):
+        return 'default'
+    return None
+
+
+def get_region(region=None, profile=None):
+    """Figure out region value in the following order
+
+    - region argument
+    - env variable
+    - region from config
+    """
+    if region:
+        return region
+    if os.environ.get('AWS_DEFAULT_REGION'):
+        return os.environ.get('AWS_DEFAULT_REGION')
+    return get_region_name(profile) or get_default_region_name()
+
+
 def profile_exists(profile):
     """Return True if profile exists in AWS_CREDENTIALS_FILE"""
     if os.path.isfile(AWS_CREDENTIALS_FILE):
@@ -125,8 +310,7 @@ def validate_properties(props_arg):
     properties = dict(p.split('=') for p in props_arg)
     reserved = [i for i in RESERVED_PROPERTIES if i in properties.keys()]
     if len(reserved):
-        print('Unable to override reserved properties: {}'.format(','.join(reserved)))
-        sys.exit(1)
+        raise ConfigError('Unable to override reserved properties: {}'.format(','.join(reserved)))
     return properties
 
 
@@ -134,7 +318,7 @@ def print_config(config, property_name=None, output_format=None):
     if property_name is not None:
         if config.get(property_name):
             if output_format == 'json':
-                print(json.dumps(config[property_name], indent=2))
+                print(json.dumps(config[property_name], indent=2, default=str))
             elif output_format == 'yaml':
                 print(yaml.dump(config[property_name]))
             else:
@@ -144,7 +328,7 @@ def print_config(config, property_name=None, output_format=None):
     elif output_format == 'yaml':
         print(yaml.dump(config))
     elif output_format == 'json':
-        print(json.dumps(config, indent=2))
+        print(json.dumps(config, indent=2, default=str))
     else:
         for k, v in config.items():
             print('{}={}'.format(k, v))
@@ -0,0 +1,157 @@
+"""
+History of resource deploy durations
+
+Durations of resources, from their first IN_PROGRESS event to their COMPLETE
+event, are derived from the stack events followed during deploys. They are
+kept per stack, resource type and action (CREATE, UPDATE or DELETE) in a json
+file per region in the cache, as running count, mean and max. The history is
+used to estimate the remaining time of deploys, flag resources taking
+unusually long and tell which resource types dominate deploy times.
+"""
+import json
+import threading
+
+from fnmatch import fnmatch
+from datetime import datetime
+from tabulate import tabulate
+
+from stacks import cache
+
+ACTIONS = ['CREATE', 'UPDATE', 'DELETE']
+# A resource is slow once it takes SLOW_FACTOR times longer than usual, with
+# at least MIN_SAMPLES past durations to go by
+SLOW_FACTOR = 2
+MIN_SAMPLES = 2
+
+_lock = threading.Lock()
+
+
+def history_path(region):
+    """Return path of the durations history file of a region"""
+    return cache.cache_path('durations', '{}.json'.format(region or 'default'))
+
+
+def load(region):
+    """Return the durations history of a region
+
+    A dict of stats dicts keyed by stack name, resource type and action.
+    """
+    return cache.load_json(history_path(region)) or {}
+
+
+def record(region, stack_name, durations):
+    """Merge a list of (resource type, action, seconds) tuples into the history"""
+    if not durations:
+        return
+    with _lock:
+        history = load(region)
+        stack = history.setdefault(stack_name, {})
+        for rtype, action, seconds in durations:
+            s = stack.setdefault(rtype, {}).setdefault(action, {'count': 0, 'mean': 0, 'max': 0})
+            s['count'] += 1
+            s['mean'] = round(s['mean'] + (seconds - s['mean']) / s['count'], 1)
+            s['max'] = round(max(s['max'], seconds), 1)
+        cache.save_json(history_path(region), history)
+
+
+def expected(history, stack_name, rtype, action):
+    """Return a tuple of the usual duration of a resource and the number of samples
+
+    Durations of the same stack are preferred, durations of the resource type
+    in all stacks are used otherwise. Return (None, 0) without history.
+    """
+    s = history.get(stack_name, {}).get(rtype, {}).get(action)
+    if s:
+        return s['mean'], s['count']
+    samples = [h[rtype][action] for h in history.values() if action in h.get(rtype, {})]
+    count = sum(s['count'] for s in samples)
+    if not count:
+        return None, 0
+    return sum(s['mean'] * s['count'] for s in samples) / count, count
+
+
+class Tracker(object):
+    """Track resource durations of a deploy from its stack event dicts"""
+
+    def __init__(self, stack_name, history=None):
+        self.stack_name = stack_name
+        self.history = history or {}
+        self.started = {}
+        self.durations = []
+
+    def observe(self, events):
+        """Update resources in progress and durations with new events"""
+        for e in events:
+            action, _, state = e['resource_status'].partition('_')
+            if action not in ACTIONS:
+                continue
+            # Logical ids are unique per stack only, nested stacks are followed too
+            key = (e.get('stack_name'), e['logical_resource_id'])
+            if state == 'IN_PROGRESS':
+                self.started.setdefault(key, (e['resource_type'], action, e['timestamp']))
+            elif key in self.started and self.started[key][1] == action:
+                rtype, _, start = self.started.pop(key)
+                # Stack updates complete with UPDATE_COMPLETE_CLEANUP_IN_PROGRESS
+                if state.startswith('COMPLETE'):
+                    self.durations.append((rtype, action, (e['timestamp'] - start).total_seconds()))
+
+    def remaining(self, now=None):
+        """Return the estimated seconds until the deploy is done or None"""
+        now = now or datetime.utcnow()
+        estimates = []
+        for rtype, action, start in self.started.values():
+            mean, _ = expected(self.history, self.stack_name, rtype, action)
+            if mean is not None:
+                estimates.append(mean - (now - start).total_seconds())
+        return max(0, max(estimates)) if estimates else None
+
+    def slow(self, now=None):
+        """Return a list of (logical id, resource type, elapsed, usual) tuples of slow resources"""
+        now = now or datetime.utcnow()
+        slow = []
+        for (_, logical_id), (rtype, action, start) in sorted(self.started.items(), key=lambda i: i[0][1]):
+            mean, count = expected(self.history, self.stack_name, rtype, action)
+            elapsed = (now - start).total_seconds()
+            if count >= MIN_SAMPLES and elapsed > SLOW_FACTOR * mean:
+                slow.append((logical_id, rtype, elapsed, mean))
+        return slow
+
+    def save(self, region):
+        """Record the durations of completed resources in the history"""
+        record(region, self.stack_name, self.durations)
+
+
+def rows(history, name_filter='*'):
+    """Return rows of stack, resource type, action, count, mean, max and total seconds
+
+    Only stacks matching a unix shell-style pattern are included. Rows are
+    sorted by total time spent, longest first.
+    """
+    result = []
+    for stack_name, types in history.items():
+        if not fnmatch(stack_name, name_filter):
+            continue
+        for rtype, actions in types.items():
+            for action, s in actions.items():
+                result.append([stack_name, rtype, action, s['count'], s['mean'], s['max'],
+                               round(s['count'] * s['mean'], 1)])
+    return sorted(result, key=lambda r: -r[-1])
+
+
+def format_rows(history, name_filter='*', output_format='text'):
+    """Return the durations history as a table or json"""
+    header = ['stack', 'resource_type', 'action', 'count', 'mean', 'max', 'total']
+    result = rows(history, name_filter)
+    if output_format == 'json':
+        return json.dumps([dict(zip(header, r)) for r in result], indent=2)
+    return tabulate(result, headers=header, tablefmt='plain')
+
+
+def format_seconds(seconds):
+    """Return seconds as e.g. 1h02m, 4m05s or 12s"""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return '{}h{:02d}m'.format(seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return '{}m{:02d}s'.format(seconds // 60, seconds % 60)
+    return '{}s'.format(seconds)
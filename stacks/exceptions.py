@@ -0,0 +1,47 @@
+"""
+Exceptions raised by stacks
+"""
+
+
+class StacksError(Exception):
+    """Base class of all stacks errors"""
+
+
+class ConfigError(StacksError):
+    """Invalid configuration or properties"""
+
+
+class TemplateError(StacksError):
+    """Template cannot be rendered, parsed or validated"""
+
+
+class LookupFailedError(StacksError, RuntimeError):
+    """Template lookup did not find what it was looking for"""
+
+
+class AWSError(StacksError):
+    """AWS API call failed"""
+
+
+class StackNotFoundError(AWSError):
+    """Stack does not exist"""
+
+
+class StackExistsError(AWSError):
+    """Stack to be created already exists"""
+
+
+class NoUpdatesError(AWSError):
+    """Stack update has no changes to perform"""
+
+
+def from_boto(err):
+    """Return a stacks exception from a BotoServerError"""
+    message = err.message or str(err)
+    if 'does not exist' in message:
+        return StackNotFoundError(message)
+    if 'already exists' in message:
+        return StackExistsError(message)
+    if 'No updates are to be performed' in message:
+        return NoUpdatesError(message)
+    return AWSError(message)
@@ -0,0 +1,182 @@
+"""
+Index of template metadata
+
+Stack names and tags live in the metadata document heading a template. The
+index renders that header alone rather than the whole template, and caches
+the result under a hash of the header source, the templates it includes and
+the config values it uses. Mapping stack names to templates across a
+template repository takes a cache lookup per file once the index is warm.
+"""
+import os
+import re
+import json
+import yaml
+import hashlib
+import builtins
+import jinja2
+
+from os import path
+from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from jinja2 import meta
+from tabulate import tabulate
+
+from stacks import artifacts
+from stacks import cache
+from stacks import cf
+from stacks import lookups
+from stacks import __about__
+from stacks.config import render_context, resolve
+from stacks.render import template_dependencies
+from stacks.exceptions import ConfigError, TemplateError
+
+INDEX_DIR = 'index'
+TEMPLATE_EXTENSIONS = ('.yaml', '.yml')
+
+DOCUMENT_SEPARATOR = re.compile(r'^---[ \t]*$', re.MULTILINE)
+JINJA_TAGS = re.compile(r'\{%.*?%\}|\{#.*?#\}', re.DOTALL)
+
+
+def header_source(source):
+    """Return the source of the metadata document of a template or None
+
+    Jinja2 statements ahead of the metadata document, e.g. imports, are kept.
+    Templates without a metadata document have a single YAML document.
+    """
+    docs = DOCUMENT_SEPARATOR.split(source)
+    preamble = ''
+    while len(docs) > 1 and not JINJA_TAGS.sub('', docs[0]).strip():
+        preamble += docs.pop(0)
+    if len(docs) < 2:
+        return None
+    return preamble + docs[0]
+
+
+def template_metadata(tpl_path, config, use_cache=True):
+    """Return the metadata dict of a template or None
+
+    Only the metadata document is rendered. Templates whose metadata cannot
+    be rendered on its own, e.g. because a jinja2 block spans documents, are
+    rendered in full.
+    """
+    with open(tpl_path) as f:
+        source = f.read()
+    header = header_source(source)
+    if header is None:
+        return None
+
+    tpl_dir = path.dirname(tpl_path)
+    env = cf.get_jinja_env(tpl_dir, cf.snippets_path(config))
+    try:
+        ast = env.parse(header)
+    except jinja2.TemplateSyntaxError:
+        return _full_render(tpl_path, config)
+
+    missing = meta.find_undeclared_variables(ast) - config.keys() - set(dir(builtins))
+    if missing:
+        raise TemplateError('Required properties not set: {}'.format(','.join(sorted(missing))))
+
+    key = _header_key(env, header, ast, config) if use_cache else None
+    if key:
+        cached = cache.load_json(cache.cache_path(INDEX_DIR, key + '.json'))
+        if cached is not None:
+            return cached['metadata']
+
+    try:
+        metadata = yaml.safe_load(env.from_string(header).render(render_context(config)))
+    except (jinja2.TemplateError, yaml.YAMLError):
+        return _full_render(tpl_path, config)
+
+    if key:
+        cache.save_json(cache.cache_path(INDEX_DIR, key + '.json'), {'metadata': metadata})
+    return metadata
+
+
+def build_index(templates, config, jobs=None, use_cache=True):
+    """Return a list of index entry dicts of templates, indexed concurrently
+
+    Entries hold the template file, its stack name and metadata, or the
+    error indexing it.
+    """
+    def entry(tpl_path):
+        result = {'template': tpl_path, 'name': None, 'metadata': None, 'error': None}
+        try:
+            result['metadata'] = template_metadata(tpl_path, config, use_cache)
+        except Exception as err:
+            result['error'] = str(err)
+        if result['metadata']:
+            result['name'] = result['metadata'].get('name')
+        return result
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(entry, templates))
+
+
+def find(index, name_filter='*', changed=None, snippets=()):
+    """Return index entries of stacks matching a unix shell-style pattern
+
+    With changed, a list of files, only entries of templates depending on
+    any of them are returned.
+    """
+    entries = [e for e in index if e['name'] and fnmatch(e['name'], name_filter)]
+    if changed:
+        changed = set(path.abspath(f) for f in changed)
+        entries = [e for e in entries if template_dependencies(e['template'], snippets) & changed]
+    return entries
+
+
+def template_files(paths):
+    """Return a sorted list of template files, directories are searched recursively"""
+    files = set()
+    for p in paths:
+        if path.isdir(p):
+            for dirpath, _, filenames in os.walk(p):
+                files |= set(path.join(dirpath, f) for f in filenames if f.endswith(TEMPLATE_EXTENSIONS))
+        else:
+            files.add(p)
+    return sorted(files)
+
+
+def _header_key(env, header, ast, config):
+    """Return a hash of a header, the templates it includes and the config values it uses
+
+    Config values are hashed as they evaluate. Return None if the header can
+    not be cached, i.e. it includes templates by a dynamic name or depends on
+    AWS lookups, directly or through lazy values.
+    """
+    sources = {}
+    names = meta.find_undeclared_variables(ast)
+    for ref in meta.find_referenced_templates(ast):
+        try:
+            included = artifacts._sources(env, ref) if ref is not None else None
+        except jinja2.TemplateError:
+            return None
+        if included is None:
+            return None
+        sources.update(included)
+    # Included templates see the config values of the header
+    for source in sources.values():
+        names |= meta.find_undeclared_variables(env.parse(source))
+    offline = lookups.offline_context(config)
+    if any(callable(v) and not isinstance(v, lookups.Placeholder) for v in map(config.get, names)):
+        return None
+    try:
+        values = {name: resolve(offline, config.get(name)) for name in names}
+    except ConfigError:
+        return None
+    values = json.dumps(values, sort_keys=True, default=artifacts._fingerprint)
+    key = json.dumps([__about__.__version__, header, sources, values], sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def _full_render(tpl_path, config):
+    with open(tpl_path) as tpl_file:
+        return cf.gen_template(tpl_file, config)[1]
+
+
+def format_index(entries, output_format='text'):
+    """Return index entries as a table or json"""
+    if output_format == 'json':
+        return json.dumps(entries, indent=2, sort_keys=True)
+    rows = [[e['name'] or '', e['template'], e['error'] or ''] for e in entries]
+    return tabulate(rows, tablefmt='plain')
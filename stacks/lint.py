@@ -0,0 +1,188 @@
+"""
+Offline static analysis of rendered templates
+
+Rendered templates are checked for problems CloudFormation would otherwise
+only report mid-deploy, or not at all:
+
+- Ref, Fn::GetAtt, Fn::Sub and DependsOn targets which are not defined
+- parameters which are never referenced
+- keys defined more than once, e.g. logical ids produced by jinja2 loops,
+  which YAML silently collapses to the last one
+- resources depending on each other in a cycle
+"""
+import re
+import yaml
+
+from awscli.customizations.cloudformation.yamlhelper import intrinsics_multi_constructor
+
+ERROR = 'error'
+WARNING = 'warning'
+
+# ${Name} and ${Name.Attribute} references in Fn::Sub strings, ${!Literal} is
+# not a reference
+SUB_REFERENCE = re.compile(r'\$\{([^!}][^}]*)\}')
+
+
+class DuplicateKeyLoader(yaml.SafeLoader):
+    """YAML loader recording keys defined more than once in a mapping"""
+
+    def __init__(self, stream):
+        super(DuplicateKeyLoader, self).__init__(stream)
+        self.duplicates = []
+
+    def construct_mapping(self, node, deep=False):
+        keys = set()
+        for key_node, _ in node.value:
+            key = self.construct_object(key_node, deep=deep)
+            if not _hashable(key):
+                continue
+            if key in keys:
+                self.duplicates.append((key, key_node.start_mark.line + 1))
+            keys.add(key)
+        return super(DuplicateKeyLoader, self).construct_mapping(node, deep)
+
+
+DuplicateKeyLoader.add_multi_constructor('!', intrinsics_multi_constructor)
+
+
+def load_template(rendered):
+    """Return a tuple of the documents of a rendered template and its duplicate keys
+
+    Duplicate keys are (key, line number in the rendered template) tuples.
+    """
+    loader = DuplicateKeyLoader(rendered)
+    try:
+        docs = []
+        while loader.check_data():
+            docs.append(loader.get_data())
+    finally:
+        loader.dispose()
+    return docs, loader.duplicates
+
+
+def lint(template, duplicates=()):
+    """Return a list of problem dicts of a template dict
+
+    Problems have a severity, ERROR or WARNING, a location and a message.
+    """
+    problems = []
+    for key, line in duplicates:
+        problems.append(_problem(ERROR, 'rendered line {}'.format(line), '{} is defined more than once'.format(key)))
+
+    parameters = template.get('Parameters') or {}
+    resources = template.get('Resources') or {}
+    defined = set(parameters) | set(resources)
+
+    referenced = set()
+    graph = {}
+    for section in ['Conditions', 'Resources', 'Outputs']:
+        for name, body in (template.get(section) or {}).items():
+            location = '{}/{}'.format(section, name)
+            deps = set()
+            for kind, target, attr in references(body):
+                referenced.add(target)
+                if target.startswith('AWS::'):
+                    continue
+                if kind == 'Fn::GetAtt' and target not in resources:
+                    problems.append(_problem(ERROR, location, 'Fn::GetAtt of undefined resource {}'.format(target)))
+                elif target not in defined:
+                    problems.append(_problem(ERROR, location, '{} of undefined {}'.format(kind, target)))
+                elif target in resources:
+                    deps.add(target)
+            if section == 'Resources':
+                depends_on = body.get('DependsOn', []) if isinstance(body, dict) else []
+                for target in [depends_on] if isinstance(depends_on, str) else depends_on:
+                    if target not in resources:
+                        problems.append(_problem(ERROR, location, 'DependsOn undefined resource {}'.format(target)))
+                    else:
+                        deps.add(target)
+                graph[name] = deps
+
+    for name in sorted(set(parameters) - referenced):
+        problems.append(_problem(WARNING, 'Parameters/{}'.format(name), 'Parameter is never referenced'))
+
+    for cycle in cycles(graph):
+        problems.append(_problem(ERROR, 'Resources/{}'.format(cycle[0]),
+                                 'Circular dependency: {}'.format(' -> '.join(cycle + cycle[:1]))))
+    return problems
+
+
+def references(value):
+    """Yield (intrinsic, target, attribute) tuples of references in a template value"""
+    if isinstance(value, list):
+        for v in value:
+            for ref in references(v):
+                yield ref
+    elif isinstance(value, dict):
+        for key, v in value.items():
+            if key == 'Ref' and isinstance(v, str):
+                yield 'Ref', v, None
+            elif key == 'Fn::GetAtt':
+                target = v.split('.', 1) if isinstance(v, str) else v
+                if isinstance(target, list) and target and isinstance(target[0], str):
+                    yield 'Fn::GetAtt', target[0], target[1] if len(target) > 1 else None
+            elif key == 'Fn::Sub':
+                for ref in _sub_references(v):
+                    yield ref
+                continue
+            for ref in references(v):
+                yield ref
+
+
+def _sub_references(value):
+    variables = {}
+    if isinstance(value, list) and value:
+        value, variables = value[0], (value[1] if len(value) > 1 and isinstance(value[1], dict) else {})
+        for ref in references(variables):
+            yield ref
+    if not isinstance(value, str):
+        return
+    for ref in SUB_REFERENCE.findall(value):
+        target, _, attr = ref.strip().partition('.')
+        if target in variables:
+            continue
+        yield ('Fn::GetAtt' if attr else 'Fn::Sub'), target, attr or None
+
+
+def cycles(graph):
+    """Return a list of dependency cycles of a dict of sets of dependencies"""
+    found = []
+    state = {}
+
+    def visit(node, stack):
+        state[node] = 'visiting'
+        stack.append(node)
+        for dep in sorted(graph.get(node, ())):
+            if state.get(dep) == 'visiting':
+                found.append(stack[stack.index(dep):])
+            elif dep not in state:
+                visit(dep, stack)
+        stack.pop()
+        state[node] = 'done'
+
+    for node in sorted(graph):
+        if node not in state:
+            visit(node, [])
+    return found
+
+
+def errors(problems):
+    """Return the problems of ERROR severity"""
+    return [p for p in problems if p['severity'] == ERROR]
+
+
+def format_problems(problems):
+    """Return problems as lines of text"""
+    return '\n'.join('{}: {}: {}'.format(p['severity'], p['location'], p['message']) for p in problems)
+
+
+def _problem(severity, location, message):
+    return {'severity': severity, 'location': location, 'message': message}
+
+
+def _hashable(key):
+    try:
+        hash(key)
+    except TypeError:
+        return False
+    return True
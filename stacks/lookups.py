@@ -0,0 +1,180 @@
+"""
+Two-pass template rendering with concurrently resolved AWS lookups
+
+The first pass renders a template with recording stand-ins for the lookup
+helpers, which return placeholders. The recorded calls are then resolved on a
+thread pool, with calls against the same stack grouped into a single API
+request, and the second pass renders the template with the resolved values.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from stacks import aws
+from stacks.config import render_context
+
+LOOKUP_HELPERS = [
+    'get_ami_id',
+    'get_vpc_id',
+    'get_zone_id',
+    'get_stack_output',
+    'get_stack_resource',
+    'get_export',
+]
+DEFAULT_WORKERS = 8
+PLACEHOLDER = '__stacks_lookup_{}__'
+
+# Helpers whose calls against the same stack can share a single API request,
+# mapped to a (fetch, extract) pair: fetch(conn, stack_name) is called once per
+# stack and extract(fetched, key) once per call.
+GROUPED_HELPERS = {
+    aws.get_stack_output: (aws.describe_stack, aws.output_value),
+    aws.get_stack_resource: (aws.describe_stack_resources, aws.resource_id),
+}
+
+
+class Placeholder(object):
+    """Offline stand-in for a lookup helper
+
+    Renders a descriptive placeholder instead of calling AWS. Unlike a closure
+    it can be pickled, so it can be shipped to worker processes.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    def __call__(self, conn, *args):
+        return ':'.join([self.name] + [str(a) for a in args])
+
+
+def placeholder_helpers():
+    """Return a dict of offline lookup helpers keyed by helper name"""
+    return {name: Placeholder(name) for name in LOOKUP_HELPERS}
+
+
+def render(tpl, config, workers=DEFAULT_WORKERS):
+    """Render a jinja2 template resolving all of its lookups concurrently"""
+    calls = collect_lookups(tpl, config)
+    results = resolve_lookups(calls, workers)
+    return tpl.render(lookup_context(config, results))
+
+
+def collect_lookups(tpl, config):
+    """Render a template with recording lookup helpers
+
+    Return a dict of lookup calls, keyed by (helper_name, *args), with the
+    helper function as a value.
+    """
+    calls = {}
+
+    def recorder(name, func):
+        def record(*args):
+            key = _call_key(name, args)
+            if key is None:
+                return func(*args)
+            calls.setdefault(key, func)
+            return PLACEHOLDER.format(list(calls).index(key))
+        return record
+
+    # Lazy values evaluate to placeholders here, they must not be memoized
+    # for the second pass or the rest of the run
+    context = render_context(config, fresh=True)
+    for name in _helpers(config):
+        context[name] = recorder(name, config[name])
+
+    try:
+        tpl.render(context)
+    except Exception:
+        # Template logic may depend on the actual lookup values and choke on
+        # placeholders. Calls recorded so far are still worth resolving, the
+        # second pass reports any genuine error.
+        pass
+    return calls
+
+
+def resolve_lookups(calls, workers=DEFAULT_WORKERS):
+    """Resolve lookup calls on a thread pool
+
+    Return a dict of (value, error) tuples keyed like calls.
+    """
+    groups = {}
+    singles = []
+    for key, func in calls.items():
+        # Helpers wrapped by another stand-in, e.g. one recording their calls,
+        # are grouped like the helper they wrap
+        func = getattr(func, '__wrapped__', func)
+        if func in GROUPED_HELPERS and len(key) == 4:
+            groups.setdefault((func, key[1], key[2]), []).append(key)
+        else:
+            singles.append(key)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for (func, conn, stack_name), keys in groups.items():
+            fetch, extract = GROUPED_HELPERS[func]
+            futures.append((executor.submit(fetch, conn, stack_name), extract, keys))
+        for key in singles:
+            futures.append((executor.submit(calls[key], *key[1:]), None, [key]))
+
+        for future, extract, keys in futures:
+            for key in keys:
+                try:
+                    value = future.result()
+                    if extract:
+                        value = extract(value, key[3])
+                    results[key] = (value, None)
+                except Exception as err:
+                    results[key] = (None, err)
+    return results
+
+
+def lookup_context(config, results):
+    """Return a copy of config with lookup helpers answering from results
+
+    Calls that were not resolved beforehand fall back to the original helper.
+    Helpers with a record(conn, args, value) attribute are told the values
+    answered from results.
+    """
+    def cached(name, func):
+        def lookup(*args):
+            key = _call_key(name, args)
+            if key is None or key not in results:
+                return func(*args)
+            value, err = results[key]
+            if err:
+                raise err
+            if hasattr(func, 'record'):
+                func.record(args[0], args[1:], value)
+            return value
+        return lookup
+
+    context = dict(config)
+    for name in _helpers(config):
+        context[name] = cached(name, config[name])
+    return context
+
+
+def offline_context(config):
+    """Return a render context of config without lookup helpers calling AWS
+
+    Lazy lookups evaluated against it raise ConfigError, unless config has
+    offline placeholder helpers.
+    """
+    context = render_context(config)
+    for name in _helpers(config):
+        if not isinstance(config[name], Placeholder):
+            del context[name]
+    return context
+
+
+def _helpers(config):
+    """Return names of lookup helpers available in config"""
+    return [name for name in LOOKUP_HELPERS if callable(config.get(name))]
+
+
+def _call_key(name, args):
+    """Return a hashable key of a lookup call or None if args are unhashable"""
+    key = (name,) + tuple(args)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
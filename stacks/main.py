@@ -2,31 +2,40 @@
 from __future__ import print_function
 
 import sys
-import os
+import atexit
 import signal
+import logging
 from time import time
+from collections import OrderedDict
 
-import boto.ec2
-import boto.vpc
-import boto.route53
-import boto.cloudformation
-import boto.s3
+from tabulate import tabulate
 
-from stacks import cli
 from stacks import aws
+from stacks import bundle
+from stacks import cli
 from stacks import cf
+from stacks import durations
+from stacks import index
+from stacks import lint
+from stacks import render
+from stacks import rollout
+from stacks import metrics
+from stacks.client import StacksClient
 from stacks.config import config_load
-from stacks.config import get_region_name
-from stacks.config import get_default_region_name
-from stacks.config import profile_exists
 from stacks.config import validate_properties
 from stacks.config import print_config
-from stacks.states import FAILED_STACK_STATES, ROLLBACK_STACK_STATES
+from stacks.config import get_profile, get_region
+from stacks.exceptions import StacksError, StackNotFoundError, StackExistsError, NoUpdatesError
+from stacks.states import FAILED_STACK_STATES, ROLLBACK_STACK_STATES, COMPLETE_STACK_STATES, DELETED_STACK_STATES
+from stacks.states import TERMINAL_STACK_STATES, LIVE_STACK_STATES
+
+YES = ['y', 'Y', 'yes', 'YES', 'Yes']
 
 
 def main():
     for sig in [signal.SIGTERM, signal.SIGINT, signal.SIGHUP, signal.SIGQUIT]:
         signal.signal(sig, handler)
+    logging.basicConfig(format='%(message)s')
 
     parser, args = cli.parse_options()
 
@@ -34,8 +43,104 @@ def main():
         parser.print_help()
         sys.exit(0)
 
+    if args.metrics_file or args.metrics_push:
+        atexit.register(export_metrics, args, time())
+    aws.EXPORTS_TTL = args.exports_ttl
+
+    try:
+        run(args)
+    except (NoUpdatesError, StackExistsError) as err:
+        # Do not exit with 1 when there is nothing to do
+        print(err)
+        sys.exit(0)
+    except StacksError as err:
+        print(err)
+        sys.exit(1)
+
+
+def run(args):
     config_file = vars(args).get('config', None)
     config_dir = vars(args).get('config_dir', None)
+    properties = validate_properties(args.property) if vars(args).get('property') else None
+
+    if args.subcommand == 'render' and args.watch:
+        watcher = render.Watcher(args.templates, args.envs, args.output_dir, config_file, config_dir, properties,
+                                 args.region)
+        watcher.run(print_renders, args.interval)
+
+    if args.subcommand == 'render':
+        results = render.render_matrix(args.templates, args.envs, args.output_dir, config_file, config_dir,
+                                       properties, args.region, args.jobs)
+        render.print_results(results)
+        if any(r['error'] for r in results):
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.subcommand == 'lint':
+        results = render.lint_matrix(args.templates, args.envs, config_file, config_dir, properties, args.region,
+                                     args.jobs)
+        render.print_lint_results(results)
+        if any(r['error'] or lint.errors(r['problems']) for r in results):
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.subcommand == 'index':
+        config = render.offline_config(args.env, config_file, config_dir, properties, args.region)
+        entries = index.build_index(index.template_files(args.templates), config, args.jobs, args.use_cache)
+        for e in entries:
+            if e['error']:
+                print('{}: {}'.format(e['template'], e['error']), file=sys.stderr)
+        matches = index.find(entries, args.name, args.changed, cf.snippets_path(config))
+        print(index.format_index(matches, args.output_format))
+        sys.exit(0)
+
+    if args.subcommand == 'rollout':
+        regions = args.regions or [get_region(args.region, get_profile(args.profile))]
+        waves = rollout.plan(rollout.matrix(args.envs, regions), args.canary, args.jobs)
+        rows = cf.wave_rows([['{}/{}'.format(*t) for t in wave] for wave in waves])
+        msg = 'You are about to roll {} out in the following waves:\n{}\n'.format(
+            args.template, tabulate(rows, tablefmt='plain'))
+        confirm(msg, args.yes or args.dry_run)
+        results = rollout.run(args.template, args.envs, regions, args.canary, args.jobs, args.failure_budget,
+                              report=print_rows, events=print_target_events if args.events_follow else None,
+                              record_dir=args.record_dir, replay_dir=args.replay_dir, stack_name=args.name,
+                              create=args.create_on_update, dry=args.dry_run, profile=args.profile,
+                              config_file=config_file, config_dir=config_dir, properties=properties,
+                              parallel_lookups=args.parallel_lookups, validate=args.validate, split=args.split,
+                              use_cache=args.use_cache, lint_first=args.lint_first)
+        print('Rollout summary:')
+        print_rows(rollout.result_rows(results))
+        if any(rollout.failed(r) for r in results):
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.subcommand == 'durations':
+        history = durations.load(get_region(args.region, get_profile(args.profile)))
+        print(durations.format_rows(history, args.name, args.output_format))
+        sys.exit(0)
+
+    if args.subcommand == 'deploy-bundle':
+        manifest = bundle.load(args.bundle_dir)
+        msg = ('You are about to deploy the following stacks:\n'
+               '{}\n'
+               'Env: {}\n'
+               'Region: {}\n'
+               'Created: {}\n').format(tabulate(bundle.stack_rows(manifest), tablefmt='plain'), manifest['env'],
+                                       manifest['region'], manifest['created'])
+        if args.dry_run:
+            print(msg)
+            sys.exit(0)
+        confirm(msg, args.yes)
+        client = StacksClient(region=manifest['region'], profile=args.profile,
+                              config=bundle.deploy_config(manifest, args.region),
+                              record_dir=args.record_dir, replay_dir=args.replay_dir)
+        results = client.deploy_bundle(manifest, args.jobs, validate=args.validate, report=print_rows)
+        print('Deploy summary:')
+        print_rows(bundle.result_rows(results))
+        if any(bundle.failed(r) for r in results):
+            sys.exit(1)
+        sys.exit(0)
+
     env = vars(args).get('env', None)
     config = config_load(env, config_file, config_dir)
 
@@ -43,113 +148,196 @@ def main():
         print_config(config, args.property_name, output_format=args.output_format)
         sys.exit(0)
 
-    config['get_ami_id'] = aws.get_ami_id
-    config['get_vpc_id'] = aws.get_vpc_id
-    config['get_zone_id'] = aws.get_zone_id
-    config['get_stack_output'] = aws.get_stack_output
-    config['get_stack_resource'] = aws.get_stack_resource
-
-    # Figure out profile value in the following order
-    # - cli arg
-    # - env variable
-    # - default profile if exists
-    if args.profile:
-        profile = args.profile
-    elif os.environ.get('AWS_DEFAULT_PROFILE'):
-        profile = os.environ.get('AWS_DEFAULT_PROFILE')
-    elif profile_exists('default'):
-        profile = 'default'
-    elif args.profile and not profile_exists(args.profile):
-        print('Profile "{}" does not exist.'.format(args.profile))
-        sys.exit(1)
-    else:
-        profile = None
-
-    # Figure out region value in the following order
-    # - cli arg
-    # - env variable
-    # - region from config
-    if args.region:
-        region = args.region
-    elif os.environ.get('AWS_DEFAULT_REGION'):
-        region = os.environ.get('AWS_DEFAULT_REGION')
-    elif get_region_name(profile):
-        region = get_region_name(profile)
-    else:
-        region = get_default_region_name()
+    client = StacksClient(region=args.region, profile=args.profile, config=config, properties=properties,
+                          record_dir=args.record_dir, replay_dir=args.replay_dir)
 
-    if not region:
-        print('Region is not specified.')
-        sys.exit(1)
-
-    config['region'] = region
-
-    # Not great, but try to catch everything. Above should be refactored in a
-    # function which handles setting up connections to different aws services
-    try:
-        ec2_conn = boto.ec2.connect_to_region(region, profile_name=profile)
-        vpc_conn = boto.vpc.connect_to_region(region, profile_name=profile)
-        cf_conn = boto.cloudformation.connect_to_region(region, profile_name=profile)
-        r53_conn = boto.route53.connect_to_region(region, profile_name=profile)
-        s3_conn = boto.s3.connect_to_region(region, profile_name=profile)
-        config['ec2_conn'] = ec2_conn
-        config['vpc_conn'] = vpc_conn
-        config['cf_conn'] = cf_conn
-        config['r53_conn'] = r53_conn
-        config['s3_conn'] = s3_conn
-    # TODO(alekna): Fix too broad exception
-    except:
-        print(sys.exc_info()[1])
-        sys.exit(1)
+    if args.subcommand == 'bundle':
+        manifest = client.bundle(args.templates, args.output_dir, args.split, args.jobs, args.use_cache)
+        print_rows(bundle.stack_rows(manifest))
+        print('Bundle written to {}'.format(args.output_dir))
 
     if args.subcommand == 'resources':
-        output = cf.stack_resources(cf_conn, args.name, args.logical_id)
+        output = cf.stack_resources(client.conn, args.name, args.logical_id)
         if output:
             print(output)
-        cf_conn.close()
 
-    if args.subcommand == 'outputs':
-        output = cf.stack_outputs(cf_conn, args.name, args.output_name)
+    if args.subcommand == 'outputs' and args.pattern:
+        # With --pattern, a single positional argument is the output name
+        output_name = args.output_name or args.name
+        outputs = cf.get_all_outputs(client.conn, args.pattern)
+        output = cf.format_outputs(outputs, args.format, output_name)
         if output:
             print(output)
-        cf_conn.close()
-
-    if args.subcommand == 'list':
-        output = cf.list_stacks(cf_conn, args.name, args.verbose)
+    elif args.subcommand == 'outputs':
+        if not args.name:
+            print('Stack name or --pattern must be specified.')
+            sys.exit(1)
+        if args.format == 'text':
+            output = cf.stack_outputs(client.conn, args.name, args.output_name)
+        else:
+            outputs = OrderedDict([(args.name, cf.get_outputs(client.conn, args.name))])
+            output = cf.format_outputs(outputs, args.format, args.output_name)
         if output:
             print(output)
-        cf_conn.close()
 
-    if args.subcommand == 'create' or args.subcommand == 'update':
-        if args.property:
-            properties = validate_properties(args.property)
-            config.update(properties)
+    if args.subcommand == 'list':
+        cf.print_stacks(client.conn, args.name, args.verbose, args.status or LIVE_STACK_STATES, args.limit)
 
+    if args.subcommand == 'create' or args.subcommand == 'update':
+        from_timestamp = client.backend.now('update')
         if args.subcommand == 'create':
-            stack_name = cf.create_stack(cf_conn, args.name, args.template, config, dry=args.dry_run)
-            if args.events_follow and not args.dry_run:
-                stack_status = cf.print_events(cf_conn, stack_name, args.events_follow)
-                if stack_status in FAILED_STACK_STATES + ROLLBACK_STACK_STATES:
-                    sys.exit(1)
+            result = client.create(args.template, args.name, dry=args.dry_run,
+                                   parallel_lookups=args.parallel_lookups, validate=args.validate,
+                                   split=args.split, use_cache=args.use_cache, lint_first=args.lint_first)
+            from_timestamp = None
         else:
-            from_timestamp = time()
-            stack_name = cf.create_stack(cf_conn, args.name, args.template, config, update=True, dry=args.dry_run,
-                                         create_on_update=args.create_on_update)
-            if args.events_follow and not args.dry_run:
-                stack_status = cf.print_events(cf_conn, stack_name, args.events_follow, from_timestamp=from_timestamp)
-                if stack_status in FAILED_STACK_STATES + ROLLBACK_STACK_STATES:
-                    sys.exit(1)
-
-    if args.subcommand == 'delete':
-        from_timestamp = time()
-        cf.delete_stack(cf_conn, args.name, region, profile, args.yes)
-        if args.events_follow:
-            stack_status = cf.print_events(cf_conn, args.name, args.events_follow, from_timestamp=from_timestamp)
-            if stack_status in FAILED_STACK_STATES:
+            result = client.update(args.template, args.name, create=args.create_on_update, dry=args.dry_run,
+                                   parallel_lookups=args.parallel_lookups, validate=args.validate,
+                                   split=args.split, use_cache=args.use_cache, lint_first=args.lint_first)
+        if args.dry_run:
+            cf.print_dry_run(result)
+        elif args.events_follow:
+            stack_status = follow(client, result, from_timestamp)
+            if stack_status in FAILED_STACK_STATES + ROLLBACK_STACK_STATES:
                 sys.exit(1)
 
+    if args.subcommand == 'validate':
+        results = client.validate(args.templates, args.jobs)
+        cf.print_validation(results)
+        if not all(r['valid'] for _, r in results):
+            sys.exit(1)
+
+    if args.subcommand == 'delete' and args.pattern:
+        waves = client.deletion_plan(args.pattern, args.jobs)
+        if not waves:
+            print('No stacks match {}'.format(args.pattern))
+            sys.exit(0)
+        msg = ('You are about to delete the following stacks:\n'
+               '{}\n'
+               'Region: {}\n'
+               'Profile: {}\n').format(tabulate(cf.wave_rows(waves), tablefmt='plain'), client.region, client.profile)
+        confirm(msg, args.yes)
+        results = client.delete_waves(waves, args.jobs, report=print_rows)
+        if any(s not in DELETED_STACK_STATES + [None] for s in results.values()):
+            print('Not all stacks were deleted, stopping.')
+            sys.exit(1)
+    elif args.subcommand == 'delete':
+        if not args.name:
+            print('Stack name or --pattern must be specified.')
+            sys.exit(1)
+        msg = ('You are about to delete the following stack:\n'
+               'Name: {}\n'
+               'Region: {}\n'
+               'Profile: {}\n').format(args.name, client.region, client.profile)
+        confirm(msg, args.yes)
+        from_timestamp = client.backend.now('delete')
+        try:
+            client.delete(args.name)
+            if args.events_follow:
+                stack_status = follow(client, args.name, from_timestamp)
+                if stack_status in FAILED_STACK_STATES:
+                    sys.exit(1)
+        except StackNotFoundError as err:
+            print(err)
+            sys.exit(0)
+
     if args.subcommand == 'events':
-        cf.print_events(cf_conn, args.name, args.events_follow, args.lines)
+        try:
+            if args.events_follow:
+                follow(client, args.name, args.since)
+            else:
+                print_events(client.events(args.name, args.lines, since=args.since, until=args.until))
+        except StackNotFoundError as err:
+            print(err)
+            sys.exit(0)
+
+    if args.subcommand == 'wait':
+        results = client.wait(args.names, args.timeout, args.interval, report=print_rows)
+        pending = sorted(n for n, s in results.items() if s is not None and s not in TERMINAL_STACK_STATES)
+        if pending:
+            print('Timed out waiting for: {}'.format(', '.join(pending)))
+        if any(s not in COMPLETE_STACK_STATES + DELETED_STACK_STATES for s in results.values()):
+            sys.exit(1)
+
+    client.close()
+
+
+def export_metrics(args, start):
+    """Record the operation duration and write out or push metrics"""
+    metrics.histogram('stacks_operation_seconds', 'Duration of stacks subcommands in seconds').observe(
+        time() - start, {'operation': args.subcommand})
+    try:
+        if args.metrics_file:
+            metrics.write_textfile(args.metrics_file)
+        if args.metrics_push:
+            metrics.push(args.metrics_push, grouping={'operation': args.subcommand})
+    except Exception as err:
+        print('Unable to export metrics: {}'.format(err), file=sys.stderr)
+
+
+def confirm(msg, yes):
+    """Ask for confirmation unless yes is set, exit if not confirmed"""
+    if not yes:
+        print(msg)
+        response = input('Are you sure? [y/N] ')
+    else:
+        response = 'yes'
+    if response not in YES:
+        sys.exit(0)
+
+
+def print_events(events):
+    """Print tabulated list of stack event dicts"""
+    rows = [(e['timestamp'], e['resource_status'], e['resource_type'], indent(e),
+             e['resource_status_reason']) for e in events]
+    print(tabulate(rows, tablefmt='plain'), flush=True)
+
+
+def follow(client, stack_name, from_timestamp=None):
+    """Print stack events and the estimated remaining time until the stack is done
+
+    Resource durations are recorded for later estimates, see stacks.durations.
+    Return the final stack status.
+    """
+    tracker = durations.Tracker(stack_name, durations.load(client.region))
+
+    def report(events):
+        print_events(events)
+        tracker.observe(events)
+        for logical_id, rtype, elapsed, usual in tracker.slow():
+            print('Slow: {} ({}) running for {}, usually takes {}'.format(
+                logical_id, rtype, durations.format_seconds(elapsed), durations.format_seconds(usual)), flush=True)
+        remaining = tracker.remaining()
+        if remaining is not None and tracker.started:
+            print('ETA: {} remaining'.format(durations.format_seconds(remaining)), flush=True)
+
+    status = client.follow(stack_name, report, from_timestamp)
+    tracker.save(client.region)
+    return status
+
+
+def print_target_events(target, events):
+    """Print tabulated list of stack event dicts of a rollout target"""
+    rows = [('{}/{}'.format(*target), e['timestamp'], e['resource_status'], e['resource_type'],
+             indent(e), e['resource_status_reason']) for e in events]
+    print(tabulate(rows, tablefmt='plain'), flush=True)
+
+
+def indent(event):
+    """Return the logical id of a stack event dict indented by its nesting depth"""
+    return '  ' * event.get('depth', 0) + event['logical_resource_id']
+
+
+def print_renders(results):
+    """Print tabulated render results followed by diffs to previous renders"""
+    render.print_results(results)
+    for r in results:
+        if r['diff']:
+            print(r['diff'], flush=True)
+
+
+def print_rows(rows):
+    print(tabulate(rows, tablefmt='plain'), flush=True)
 
 
 def handler(signum, _):
@@ -0,0 +1,179 @@
+"""
+Operational metrics
+
+Counters and histograms are collected in a process wide registry and can be
+written out in the Prometheus text exposition format, either to a file picked
+up by the node exporter textfile collector or pushed to a Pushgateway.
+"""
+import os
+import time
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+
+from contextlib import contextmanager
+
+# Prometheus default buckets, in seconds
+TIME_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+SIZE_BUCKETS = tuple(1024 * 4**n for n in range(9))
+
+PUSH_TIMEOUT = 5
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+class Counter(object):
+    """Monotonically increasing values keyed by label values"""
+    kind = 'counter'
+
+    def __init__(self, name, doc):
+        self.name = name
+        self.doc = doc
+        self.values = {}
+
+    def inc(self, labels=None, value=1):
+        key = _label_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name + '_total', key, value
+
+
+class Histogram(object):
+    """Observations counted in cumulative buckets keyed by label values"""
+    kind = 'histogram'
+
+    def __init__(self, name, doc, buckets=TIME_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.buckets = tuple(buckets)
+        self.values = {}
+
+    def observe(self, value, labels=None):
+        key = _label_key(labels)
+        with _lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            counts = [c + 1 if value <= b else c for c, b in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            for bound, n in zip(self.buckets, counts):
+                yield self.name + '_bucket', key + (('le', _format(bound)),), n
+            yield self.name + '_bucket', key + (('le', '+Inf'),), count
+            yield self.name + '_sum', key, total
+            yield self.name + '_count', key, count
+
+
+def counter(name, doc):
+    """Return a registered counter, creating it on first use"""
+    return _register(name, lambda: Counter(name, doc))
+
+
+def histogram(name, doc, buckets=TIME_BUCKETS):
+    """Return a registered histogram, creating it on first use"""
+    return _register(name, lambda: Histogram(name, doc, buckets))
+
+
+@contextmanager
+def timer(name, doc, labels=None):
+    """Observe the duration of a block in a histogram
+
+    labels can be updated inside the block, e.g. with the outcome.
+    """
+    labels = labels if labels is not None else {}
+    start = time.time()
+    try:
+        yield labels
+    finally:
+        histogram(name, doc).observe(time.time() - start, labels)
+
+
+def render():
+    """Return all metrics in the Prometheus text exposition format"""
+    lines = []
+    with _lock:
+        metrics = sorted(_metrics.values(), key=lambda m: m.name)
+        for m in metrics:
+            lines.append('# HELP {} {}'.format(m.name, m.doc))
+            lines.append('# TYPE {} {}'.format(m.name, m.kind))
+            for name, key, value in m.samples():
+                lines.append('{}{} {}'.format(name, _format_labels(key), _format(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def write_textfile(path):
+    """Atomically write metrics to a file"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(render())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def push(url, job='stacks', grouping=None):
+    """Push metrics to a Pushgateway, replacing earlier metrics of the group
+
+    grouping is a dict of extra grouping key labels.
+    """
+    group = ''.join('/{}/{}'.format(k, urllib.parse.quote(str(v), safe=''))
+                    for k, v in sorted((grouping or {}).items()))
+    req = urllib.request.Request('{}/metrics/job/{}{}'.format(url.rstrip('/'), job, group), data=render().encode(),
+                                 method='PUT', headers={'Content-Type': 'text/plain; version=0.0.4'})
+    with urllib.request.urlopen(req, timeout=PUSH_TIMEOUT) as resp:
+        return resp.status
+
+
+def instrument(conn, service):
+    """Count HTTP requests made by a boto connection
+
+    Requests are counted per service and API action, including the ones
+    retried by boto itself.
+    """
+    mexe = conn._mexe
+
+    def counted_mexe(request, *args, **kwargs):
+        action = request.params.get('Action') or request.method
+        # Looked up on every request, so counting goes on after a reset()
+        counter('stacks_aws_requests', 'AWS API requests').inc({'service': service, 'action': action})
+        return mexe(request, *args, **kwargs)
+    conn._mexe = counted_mexe
+    return conn
+
+
+def reset():
+    """Drop all collected metrics"""
+    with _lock:
+        _metrics.clear()
+
+
+def _register(name, factory):
+    with _lock:
+        if name not in _metrics:
+            _metrics[name] = factory()
+        return _metrics[name]
+
+
+def _label_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+    pairs = ['{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+             for k, v in key]
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format(value):
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,337 @@
+"""
+Offline rendering of template and environment matrices
+
+Templates can also be watched and re-rendered as they change.
+"""
+# An attempt to support python 2.7.x
+from __future__ import print_function
+
+import os
+import json
+import time
+import difflib
+import jinja2
+
+from os import path
+from concurrent.futures import ProcessPoolExecutor
+from jinja2 import meta
+from tabulate import tabulate
+
+from stacks import cf
+from stacks import lookups
+from stacks.config import config_load
+from stacks.config import MEMO_KEY
+from stacks.config import list_files
+
+# Connections referenced by templates as arguments to lookup helpers. They are
+# not needed offline, but have to be defined for templates to render.
+CONNECTIONS = ['ec2_conn', 'vpc_conn', 'cf_conn', 'r53_conn', 's3_conn']
+MANIFEST = 'manifest.json'
+
+
+def offline_config(env, config_file=None, config_dir=None, properties=None, region=None):
+    """Return config of env with offline lookup helpers and no connections"""
+    config = config_load(env, config_file, config_dir)
+    if properties:
+        config.update(properties)
+    if region:
+        config['region'] = region
+    config.update(lookups.placeholder_helpers())
+    for conn in CONNECTIONS:
+        config[conn] = None
+    config[MEMO_KEY] = {}
+    return config
+
+
+def render_matrix(templates, envs, output_dir, config_file=None, config_dir=None, properties=None, region=None,
+                  jobs=None):
+    """Render every template for every env on a process pool
+
+    Rendered templates are written to output_dir/<env>/<template>.json together
+    with a manifest of their names, sizes and MD5 sums. Templates in
+    subdirectories keep their path relative to the common directory of all
+    templates. Return a list of result dicts, one per template and env pair.
+    """
+    configs = {env: offline_config(env, config_file, config_dir, properties, region) for env in envs}
+
+    # Compile templates and snippets upfront, so forked workers inherit them
+    # rather than compiling them once per process
+    for snippets in set(cf.snippets_path(c) for c in configs.values()):
+        cf.compile_snippets(snippets)
+        for tpl_path in templates:
+            tpl_dir, tpl_fname = path.split(tpl_path)
+            try:
+                cf.get_jinja_env(tpl_dir, snippets).get_template(tpl_fname)
+            except Exception:
+                # Reported by the worker rendering the template
+                pass
+
+    root = templates_root(templates)
+    tasks = [(tpl_path, env, output_dir, root, configs[env]) for env in envs for tpl_path in templates]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(_render_one, tasks))
+
+    write_manifest(output_dir, results)
+    return results
+
+
+def lint_matrix(templates, envs, config_file=None, config_dir=None, properties=None, region=None, jobs=None):
+    """Lint every template for every env on a process pool
+
+    Return a list of result dicts, one per template and env pair, listing
+    lint problems, see stacks.lint.
+    """
+    configs = {env: offline_config(env, config_file, config_dir, properties, region) for env in envs}
+    tasks = [(tpl_path, env, configs[env]) for env in envs for tpl_path in templates]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_lint_one, tasks))
+
+
+def print_lint_results(results):
+    """Print tabulated lint problems and render errors"""
+    rows = []
+    for r in results:
+        if r['error']:
+            rows.append([r['env'], r['template'], 'error', '', r['error']])
+        for p in r['problems']:
+            rows.append([r['env'], r['template'], p['severity'], p['location'], p['message']])
+    if rows:
+        print(tabulate(rows, tablefmt='plain'), flush=True)
+
+
+def write_manifest(output_dir, results):
+    """Write rendered templates manifest to output_dir"""
+    os.makedirs(output_dir, exist_ok=True)
+    with open(path.join(output_dir, MANIFEST), 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def print_results(results):
+    """Print tabulated render results"""
+    rows = []
+    for r in results:
+        rows.append([r['env'], r['template'], r['name'], r['size'], r['md5'] or r['error']])
+    print(tabulate(rows, tablefmt='plain'), flush=True)
+
+
+def templates_root(templates):
+    """Return the deepest directory containing all templates"""
+    dirs = [path.dirname(path.abspath(t)) + path.sep for t in templates]
+    prefix = path.commonprefix(dirs) if dirs else path.sep
+    return prefix[:prefix.rindex(path.sep)] or path.sep
+
+
+def output_path(output_dir, env, tpl_path, root=None):
+    """Return path of a rendered template
+
+    The path of the template relative to root is kept, so templates of the
+    same name in different directories do not overwrite each other.
+    """
+    if root is None:
+        tpl_name = path.basename(tpl_path)
+    else:
+        tpl_name = path.relpath(path.abspath(tpl_path), root)
+    return path.join(output_dir, env, path.splitext(tpl_name)[0] + '.json')
+
+
+def _render_one(task):
+    """Render a single template for a single env
+
+    Runs in a worker process.
+    """
+    tpl_path, env, output_dir, root, config = task
+    return render_file(tpl_path, env, output_dir, config, root)[0]
+
+
+def _lint_one(task):
+    """Lint a single template for a single env
+
+    Runs in a worker process.
+    """
+    tpl_path, env, config = task
+    result = {'template': tpl_path, 'env': env, 'problems': [], 'error': None}
+    try:
+        with open(tpl_path) as tpl_file:
+            result['problems'] = cf.lint_template(tpl_file, config)
+    except Exception as err:
+        result['error'] = str(err)
+    return result
+
+
+def render_file(tpl_path, env, output_dir, config, root=None):
+    """Render a template for an env to output_dir, see output_path()
+
+    Return a tuple of a result dict and the rendered template, which is None
+    if rendering failed.
+    """
+    result = {
+        'template': tpl_path,
+        'env': env,
+        'name': None,
+        'file': None,
+        'size': None,
+        'md5': None,
+        'error': None,
+    }
+    try:
+        with open(tpl_path) as tpl_file:
+            tpl, metadata = cf.gen_template(tpl_file, config)
+    except Exception as err:
+        result['error'] = str(err)
+        return result, None
+
+    out = output_path(output_dir, env, tpl_path, root)
+    os.makedirs(path.dirname(out), exist_ok=True)
+    with open(out, 'w') as f:
+        f.write(tpl)
+
+    result['name'] = metadata.get('name') if metadata else None
+    result['file'] = out
+    result['size'] = len(tpl)
+    result['md5'] = cf._calc_md5(tpl)
+    return result, tpl
+
+
+class Watcher(object):
+    """Re-render templates when they, their includes or config files change
+
+    Each template's include and import graph is tracked, so a change only
+    re-renders the templates depending on the changed file. A change to a
+    config file re-renders everything. Templates are rendered in-process, so
+    compiled templates and snippets are reused across renders.
+    """
+
+    def __init__(self, templates, envs, output_dir, config_file=None, config_dir=None, properties=None,
+                 region=None):
+        self.templates = templates
+        self.envs = envs
+        self.output_dir = output_dir
+        self.config_file = config_file
+        self.config_dir = config_dir
+        self.properties = properties
+        self.region = region
+        self.root = templates_root(templates)
+        self.configs = {}
+        self.dependencies = {}
+        self.rendered = {}
+        self.mtimes = {}
+
+    def config_files(self):
+        files = []
+        if self.config_dir and path.isdir(self.config_dir):
+            files = list_files(self.config_dir)
+        if self.config_file:
+            files.insert(0, self.config_file)
+        return [path.abspath(f) for f in files]
+
+    def render(self, templates, mtimes=None):
+        """Render templates for all envs, return a list of result dicts
+
+        Results of templates rendered before have a unified diff against the
+        previous render. mtimes are modification times of files taken before
+        rendering, so changes made while rendering are picked up by the next
+        poll.
+        """
+        results = []
+        for tpl_path in templates:
+            for env in self.envs:
+                result, tpl = render_file(tpl_path, env, self.output_dir, self.configs[env], self.root)
+                previous = self.rendered.get((tpl_path, env))
+                result['diff'] = None
+                if previous is not None and tpl is not None:
+                    result['diff'] = '\n'.join(difflib.unified_diff(
+                        previous.splitlines(), tpl.splitlines(), result['file'] + ' (previous)', result['file'],
+                        lineterm=''))
+                if tpl is not None:
+                    self.rendered[(tpl_path, env)] = tpl
+                results.append(result)
+            self.dependencies[tpl_path] = template_dependencies(tpl_path, self._snippets())
+        snapshot = self._snapshot()
+        snapshot.update((f, m) for f, m in (mtimes or {}).items() if f in snapshot)
+        self.mtimes = snapshot
+        return results
+
+    def render_all(self, mtimes=None):
+        """Load configs and render all templates"""
+        self.configs = {env: offline_config(env, self.config_file, self.config_dir, self.properties, self.region)
+                        for env in self.envs}
+        return self.render(self.templates, mtimes)
+
+    def poll(self):
+        """Re-render templates affected by files changed since the last render
+
+        Return a list of result dicts, empty if nothing changed.
+        """
+        mtimes = self._snapshot()
+        changed = set(f for f in set(mtimes) | set(self.mtimes) if mtimes.get(f) != self.mtimes.get(f))
+        if not changed:
+            return []
+        self.mtimes = mtimes
+        # Watched files other than template dependencies are config files
+        if changed - self._template_files():
+            return self.render_all(mtimes)
+        return self.render([t for t in self.templates if self.dependencies.get(t, set()) & changed], mtimes)
+
+    def run(self, report, interval=0.5):
+        """Render all templates, then poll for changes forever
+
+        report is called with a list of result dicts after every render.
+        """
+        report(self.render_all())
+        while True:
+            time.sleep(interval)
+            try:
+                results = self.poll()
+            except Exception as err:
+                # Most likely a broken config file, wait for it to be fixed
+                results = [{'template': None, 'env': None, 'name': None, 'size': None, 'md5': None,
+                            'error': str(err), 'diff': None}]
+            if results:
+                report(results)
+
+    def _snippets(self):
+        return set(s for c in self.configs.values() for s in cf.snippets_path(c))
+
+    def _template_files(self):
+        return set(f for deps in self.dependencies.values() for f in deps)
+
+    def _snapshot(self):
+        """Return modification times of all watched files"""
+        mtimes = {}
+        for f in self._template_files() | set(self.config_files()):
+            try:
+                mtimes[f] = path.getmtime(f)
+            except OSError:
+                mtimes[f] = None
+        return mtimes
+
+
+def template_dependencies(tpl_path, snippets=()):
+    """Return a set of files a template depends on, including itself
+
+    Templates included by a dynamic name could be any file of the template
+    directory or the snippets library, so all of them are dependencies then.
+    """
+    tpl_dir, tpl_fname = path.split(tpl_path)
+    env = cf.get_jinja_env(tpl_dir, tuple(snippets))
+    files = set([path.abspath(tpl_path)])
+    pending = [tpl_fname]
+    seen = set()
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        try:
+            source, filename, _ = env.loader.get_source(env, name)
+            refs = list(meta.find_referenced_templates(env.parse(source)))
+        except jinja2.TemplateError:
+            continue
+        files.add(path.abspath(filename))
+        if None in refs:
+            for d in [tpl_dir or '.'] + list(snippets):
+                for dirpath, _, filenames in os.walk(d):
+                    files |= set(path.abspath(path.join(dirpath, f)) for f in filenames)
+            break
+        pending.extend(refs)
+    return files
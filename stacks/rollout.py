@@ -0,0 +1,135 @@
+"""
+Rollouts of a template to a matrix of environments and regions
+
+Targets, (env, region) pairs, are deployed in waves: a canary wave first,
+then waves of up to batch_size targets deployed concurrently. A wave starts
+once every stack of the previous wave reached a terminal state, so a rollout
+takes as long as its number of waves rather than its number of targets. The
+rollout stops after a wave in which more targets failed than the failure
+budget allows.
+"""
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from stacks.backend import Backend
+from stacks.client import StacksClient
+from stacks.exceptions import NoUpdatesError
+from stacks.states import COMPLETE_STACK_STATES
+
+NO_UPDATES = 'NO_UPDATES'
+DRY_RUN = 'DRY_RUN'
+SKIPPED = 'SKIPPED'
+
+
+def matrix(envs, regions):
+    """Return a list of (env, region) targets of every env in every region"""
+    return [(env, region) for env in envs for region in regions]
+
+
+def plan(targets, canary=1, batch_size=None):
+    """Return a list of waves of targets
+
+    The first wave holds canary targets, the following ones up to batch_size
+    targets each, all remaining targets if batch_size is not set.
+    """
+    waves = []
+    if canary > 0:
+        waves.append(targets[:canary])
+        targets = targets[canary:]
+    batch_size = batch_size or len(targets)
+    for i in range(0, len(targets), batch_size):
+        waves.append(targets[i:i + batch_size])
+    return waves
+
+
+def deploy(target, template, stack_name=None, create=False, dry=False, profile=None, config_file=None,
+           config_dir=None, properties=None, backend=None, events=None, interval=5, **options):
+    """Create or update the stack of a target and wait until it is done
+
+    events, if given, is called with the target and every batch of new stack
+    event dicts. options are passed on to StacksClient.update(). Return a
+    result dict, errors are reported in it rather than raised.
+    """
+    env, region = target
+    result = {'env': env, 'region': region, 'stack_name': stack_name, 'status': None, 'error': None,
+              'duration': None}
+    start = time.time()
+    try:
+        client = StacksClient(env, region, profile, config_file, config_dir, properties, backend=backend)
+        from_timestamp = client.backend.now('update {} {} {}'.format(env, region, stack_name or template))
+        try:
+            updated = client.update(template, stack_name, create=create, dry=dry, **options)
+        except NoUpdatesError:
+            result['status'] = NO_UPDATES
+        else:
+            if dry:
+                result['stack_name'] = updated['name']
+                result['status'] = DRY_RUN
+            else:
+                result['stack_name'] = updated
+                report = (lambda e: events(target, e)) if events else (lambda e: None)
+                result['status'] = client.follow(result['stack_name'], report, from_timestamp, interval)
+    except Exception as err:
+        # A target failing must not stop the other targets of its wave
+        result['error'] = str(err)
+    result['duration'] = round(time.time() - start, 1)
+    return result
+
+
+def failed(result):
+    """Return True if a target failed to deploy"""
+    return result['error'] is not None or result['status'] not in COMPLETE_STACK_STATES + [NO_UPDATES, DRY_RUN]
+
+
+def rollout(waves, deploy_target, failure_budget=0, report=None):
+    """Deploy waves of targets, every target of a wave concurrently
+
+    deploy_target is called with a target and returns a result dict, see
+    deploy(). report, if given, is called with rows of progress. Targets of
+    waves after the failure budget was exceeded are skipped. Return a list of
+    result dicts of all targets.
+    """
+    results = []
+    failures = 0
+    for i, wave in enumerate(waves):
+        if failures > failure_budget:
+            results.extend(_skipped(target) for target in wave)
+            continue
+        if report:
+            report([['Wave {}/{}:'.format(i + 1, len(waves)), ', '.join('{}/{}'.format(*t) for t in wave)]])
+        with ThreadPoolExecutor(max_workers=len(wave)) as executor:
+            wave_results = list(executor.map(deploy_target, wave))
+        failures += len([r for r in wave_results if failed(r)])
+        results.extend(wave_results)
+        if report:
+            report(result_rows(wave_results))
+    return results
+
+
+def result_rows(results):
+    """Return tabulated rows of rollout results"""
+    return [[r['env'], r['region'], r['stack_name'] or '', r['status'] or '', r['duration'] or '', r['error'] or '']
+            for r in results]
+
+
+def _skipped(target):
+    return {'env': target[0], 'region': target[1], 'stack_name': None, 'status': SKIPPED, 'error': None,
+            'duration': None}
+
+
+def run(template, envs, regions, canary=1, batch_size=None, failure_budget=0, report=None, events=None,
+        record_dir=None, replay_dir=None, **options):
+    """Roll a template out to every env in every region
+
+    options are passed on to deploy(). Return a list of result dicts.
+    """
+    backend = Backend(record_dir, replay_dir)
+
+    def deploy_target(target):
+        return deploy(target, template, backend=backend, events=events, **options)
+
+    try:
+        return rollout(plan(matrix(envs, regions), canary, batch_size), deploy_target, failure_budget, report)
+    finally:
+        backend.close()
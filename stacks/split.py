@@ -0,0 +1,335 @@
+"""
+Splitting of oversized templates into nested stacks
+
+Resources are partitioned by dependency clusters into child stacks deployed
+from a parent stack. References crossing partitions are rewritten into child
+stack outputs, which the parent passes on as child stack parameters.
+"""
+import re
+import json
+
+from collections import OrderedDict
+
+from stacks.exceptions import TemplateError
+
+# CloudFormation limits
+MAX_TEMPLATE_SIZE = 1048576
+MAX_RESOURCES = 500
+
+# Child templates are kept well below the limits to leave room for the
+# parameters and outputs added when rewriting references
+CHILD_MAX_RESOURCES = 400
+CHILD_MAX_SIZE = MAX_TEMPLATE_SIZE // 2
+
+CHILD_NAME = 'Child{}'
+SUB_VARIABLE = re.compile(r'\$\{([^!][^}]*)\}')
+
+
+def needs_split(template, tpl_size):
+    """Return True if a template exceeds CloudFormation limits"""
+    return tpl_size > MAX_TEMPLATE_SIZE or len(template.get('Resources', {})) > MAX_RESOURCES
+
+
+def split_template(template, max_resources=CHILD_MAX_RESOURCES, max_size=CHILD_MAX_SIZE):
+    """Split a template dict into a parent template and child templates
+
+    Return a tuple of the parent template and an ordered dict of child
+    templates keyed by their logical id in the parent. Child stack resources in
+    the parent have no TemplateURL set, it has to be filled in once the child
+    templates are uploaded.
+    """
+    if 'Transform' in template:
+        raise TemplateError('Templates with a Transform cannot be split')
+
+    resources = template.get('Resources', {})
+    parameters = template.get('Parameters', {})
+    partitions = partition(resources, max_resources, max_size)
+    owner = {}
+    for n, names in enumerate(partitions):
+        for name in names:
+            owner[name] = CHILD_NAME.format(n + 1)
+
+    children = OrderedDict((CHILD_NAME.format(n + 1), _new_child(template)) for n in range(len(partitions)))
+    child_params = {child: {} for child in children}
+    child_depends = {child: set() for child in children}
+
+    def export(name, attr):
+        """Add an output to the child owning a resource, return its name"""
+        output = _output_name(name, attr)
+        value = {'Ref': name} if attr is None else {'Fn::GetAtt': [name, attr]}
+        children[owner[name]]['Outputs'][output] = {'Value': value}
+        return output
+
+    for (child, child_tpl), names in zip(children.items(), partitions):
+        def resolve(name, attr, child=child, child_tpl=child_tpl):
+            if name in parameters:
+                child_params[child][name] = _pass_parameter(name, parameters[name])
+                child_tpl['Parameters'][name] = parameters[name]
+                return None
+            if name not in owner or owner[name] == child:
+                return None
+            output = export(name, attr)
+            child_params[child][output] = {'Fn::GetAtt': [owner[name], 'Outputs.' + output]}
+            child_tpl['Parameters'][output] = {'Type': 'String'}
+            return ('ref', output)
+
+        for name in names:
+            resource = OrderedDict(resources[name])
+            depends_on = resource.pop('DependsOn', [])
+            if isinstance(depends_on, str):
+                depends_on = [depends_on]
+            local = [d for d in depends_on if owner.get(d) == child]
+            child_depends[child] |= set(owner[d] for d in depends_on if d in owner and owner[d] != child)
+            if local:
+                resource['DependsOn'] = local
+            child_tpl['Resources'][name] = _rewrite(resource, resolve)
+
+        for name in _used_conditions(child_tpl, template.get('Conditions', {})):
+            condition = template['Conditions'][name]
+            child_tpl['Conditions'][name] = condition
+            for param in _references(condition):
+                if param in parameters:
+                    resolve(param, None)
+
+    parent = OrderedDict()
+    for key in ['AWSTemplateFormatVersion', 'Description', 'Metadata', 'Parameters', 'Mappings', 'Conditions']:
+        if key in template:
+            parent[key] = template[key]
+    parent['Resources'] = OrderedDict()
+    for child in children:
+        props = OrderedDict([('TemplateURL', None)])
+        if child_params[child]:
+            props['Parameters'] = child_params[child]
+        parent['Resources'][child] = OrderedDict([('Type', 'AWS::CloudFormation::Stack'), ('Properties', props)])
+        if child_depends[child]:
+            parent['Resources'][child]['DependsOn'] = sorted(child_depends[child])
+
+    if 'Outputs' in template:
+        def resolve_output(name, attr):
+            if name not in owner:
+                return None
+            return ('getatt', owner[name], 'Outputs.' + export(name, attr))
+        parent['Outputs'] = _rewrite(template['Outputs'], resolve_output)
+
+    for child_tpl in children.values():
+        for key in ['Parameters', 'Conditions', 'Outputs']:
+            if not child_tpl[key]:
+                del child_tpl[key]
+
+    return parent, children
+
+
+def partition(resources, max_resources=CHILD_MAX_RESOURCES, max_size=CHILD_MAX_SIZE):
+    """Partition resources by dependency clusters
+
+    Connected resources are kept together and clusters are packed into as few
+    partitions as the limits allow. Clusters too large for a single partition
+    are cut in dependency order, so references between partitions always point
+    to an earlier partition. Return a list of lists of logical ids.
+    """
+    deps = {name: _references(body) & set(resources) - {name} for name, body in resources.items()}
+    sizes = {name: len(json.dumps(body)) for name, body in resources.items()}
+
+    # Each group is a list of chunks of a cluster, clusters too large for a
+    # single partition are cut in dependency order
+    groups = []
+    for cluster in _clusters(deps):
+        cluster = _topological(cluster, deps)
+        if len(cluster) > max_resources or sum(sizes[n] for n in cluster) > max_size:
+            groups.append(_chunks(cluster, sizes, max_resources, max_size))
+        else:
+            groups.append([cluster])
+    groups.sort(key=lambda chunks: -sum(len(c) for c in chunks))
+
+    # First fit decreasing. A chunk never goes to a partition before the ones
+    # holding its dependencies, so partitions only reference earlier ones.
+    bins = []
+    placed = {}
+    for chunks in groups:
+        for chunk in chunks:
+            size = sum(sizes[n] for n in chunk)
+            lowest = max([placed[d] for n in chunk for d in deps[n] if d in placed] or [0])
+            for b in range(lowest, len(bins)):
+                if len(bins[b][0]) + len(chunk) <= max_resources and bins[b][1] + size <= max_size:
+                    break
+            else:
+                bins.append([[], 0])
+                b = len(bins) - 1
+            bins[b][0].extend(chunk)
+            bins[b][1] += size
+            for n in chunk:
+                placed[n] = b
+    return [names for names, _ in bins]
+
+
+def _clusters(deps):
+    """Return connected components of the dependency graph"""
+    parent = {name: name for name in deps}
+
+    def find(name):
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    for name, targets in deps.items():
+        for target in targets:
+            parent[find(name)] = find(target)
+
+    clusters = OrderedDict()
+    for name in deps:
+        clusters.setdefault(find(name), []).append(name)
+    return list(clusters.values())
+
+
+def _topological(names, deps):
+    """Return names ordered so dependencies come first
+
+    Names in a dependency cycle are appended in their original order.
+    """
+    ordered = []
+    done = set()
+    remaining = list(names)
+    while remaining:
+        ready = [n for n in remaining if deps[n] <= done]
+        if not ready:
+            ready = remaining
+        ordered.extend(ready)
+        done |= set(ready)
+        remaining = [n for n in remaining if n not in done]
+    return ordered
+
+
+def _chunks(names, sizes, max_resources, max_size):
+    chunks = [[]]
+    size = 0
+    for name in names:
+        if chunks[-1] and (len(chunks[-1]) >= max_resources or size + sizes[name] > max_size):
+            chunks.append([])
+            size = 0
+        chunks[-1].append(name)
+        size += sizes[name]
+    return chunks
+
+
+def _new_child(template):
+    child = OrderedDict()
+    child['AWSTemplateFormatVersion'] = template.get('AWSTemplateFormatVersion', '2010-09-09')
+    if 'Mappings' in template:
+        child['Mappings'] = template['Mappings']
+    child['Parameters'] = OrderedDict()
+    child['Conditions'] = OrderedDict()
+    child['Resources'] = OrderedDict()
+    child['Outputs'] = OrderedDict()
+    return child
+
+
+def _pass_parameter(name, definition):
+    """Return the value passing a parent parameter to a child stack"""
+    param_type = definition.get('Type', 'String')
+    if param_type.startswith('List<') or param_type == 'CommaDelimitedList':
+        return {'Fn::Join': [',', {'Ref': name}]}
+    return {'Ref': name}
+
+
+def _output_name(name, attr):
+    if attr is None:
+        return name + 'Ref'
+    return name + re.sub(r'[^A-Za-z0-9]', '', attr)
+
+
+def _references(node):
+    """Return names referenced by Ref, Fn::GetAtt, Fn::Sub and DependsOn"""
+    found = set()
+    _rewrite(node, lambda name, attr: found.add(name))
+    if isinstance(node, dict):
+        depends_on = node.get('DependsOn', [])
+        found |= set([depends_on] if isinstance(depends_on, str) else depends_on)
+        if 'Condition' in node and isinstance(node['Condition'], str):
+            found.add(node['Condition'])
+    return found
+
+
+def _used_conditions(child, conditions):
+    """Return names of conditions used by a child template, transitively"""
+    used = set()
+    pending = set()
+    for resource in child['Resources'].values():
+        pending |= _condition_names(resource)
+    while pending:
+        name = pending.pop()
+        if name in conditions and name not in used:
+            used.add(name)
+            pending |= _condition_names(conditions[name])
+    return sorted(used)
+
+
+def _condition_names(node):
+    found = set()
+    if isinstance(node, dict):
+        for key, value in node.items():
+            if key == 'Condition' and isinstance(value, str):
+                found.add(value)
+            elif key == 'Fn::If' and isinstance(value, list) and value:
+                found.add(value[0])
+                for v in value[1:]:
+                    found |= _condition_names(v)
+            else:
+                found |= _condition_names(value)
+    elif isinstance(node, list):
+        for value in node:
+            found |= _condition_names(value)
+    return found
+
+
+def _rewrite(node, resolve):
+    """Return a copy of node with references rewritten
+
+    resolve(name, attr) is called for each Ref (attr is None), Fn::GetAtt and
+    Fn::Sub variable. It returns None to keep the reference, ('ref', name) or
+    ('getatt', name, attr) to replace it.
+    """
+    if isinstance(node, list):
+        return [_rewrite(v, resolve) for v in node]
+    if not isinstance(node, dict):
+        return node
+
+    if len(node) == 1 and 'Ref' in node and isinstance(node['Ref'], str):
+        return _expression(resolve(node['Ref'], None)) or node
+    if len(node) == 1 and 'Fn::GetAtt' in node:
+        target = node['Fn::GetAtt']
+        if isinstance(target, str):
+            target = target.split('.', 1)
+        if isinstance(target, list) and len(target) == 2 and isinstance(target[1], str):
+            return _expression(resolve(target[0], target[1])) or node
+    if len(node) == 1 and 'Fn::Sub' in node:
+        value = node['Fn::Sub']
+        if isinstance(value, list):
+            variables = value[1] if len(value) > 1 else {}
+            body = _rewrite_sub(value[0], resolve, variables)
+            return {'Fn::Sub': [body] + [_rewrite(v, resolve) for v in value[1:]]}
+        return {'Fn::Sub': _rewrite_sub(value, resolve, {})}
+
+    return OrderedDict((k, _rewrite(v, resolve)) for k, v in node.items())
+
+
+def _rewrite_sub(body, resolve, variables):
+    def replace(m):
+        name, _, attr = m.group(1).partition('.')
+        if name in variables or name.startswith('AWS::'):
+            return m.group(0)
+        replacement = resolve(name, attr or None)
+        if not replacement:
+            return m.group(0)
+        return '${' + '.'.join(replacement[1:]) + '}'
+    if not isinstance(body, str):
+        return body
+    return SUB_VARIABLE.sub(replace, body)
+
+
+def _expression(replacement):
+    if not replacement:
+        return None
+    if replacement[0] == 'ref':
+        return {'Ref': replacement[1]}
+    return {'Fn::GetAtt': [replacement[1], replacement[2]]}
@@ -21,3 +21,8 @@ IN_PROGRESS_STACK_STATES = [
     'UPDATE_ROLLBACK_IN_PROGRESS',
     'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS',
 ]
+DELETED_STACK_STATES = [
+    'DELETE_COMPLETE',
+]
+TERMINAL_STACK_STATES = FAILED_STACK_STATES + COMPLETE_STACK_STATES + ROLLBACK_STACK_STATES + DELETED_STACK_STATES
+LIVE_STACK_STATES = FAILED_STACK_STATES + COMPLETE_STACK_STATES + IN_PROGRESS_STACK_STATES + ROLLBACK_STACK_STATES
@@ -0,0 +1,53 @@
+"""
+Fakes and fixtures shared by tests
+"""
+import shutil
+import tempfile
+
+from stacks import cache
+
+
+class FakePage(list):
+    next_token = None
+
+
+class FakeOutput(object):
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+
+class FakeStack(object):
+    def __init__(self, name=None, status='CREATE_COMPLETE', outputs=None):
+        self.stack_name = name
+        self.stack_id = name
+        self.stack_status = status
+        self.outputs = [FakeOutput(k, v) for k, v in (outputs or {}).items()]
+
+
+class FakeCFConnection(object):
+    """Serves describe_stacks of stacks given as dicts of outputs keyed by stack name"""
+
+    def __init__(self, stacks):
+        self.stacks = stacks
+        self.calls = 0
+        self.closed = False
+
+    def describe_stacks(self, stack_name_or_id=None, next_token=None):
+        self.calls += 1
+        if stack_name_or_id is None:
+            return FakePage(FakeStack(name, outputs=outputs) for name, outputs in sorted(self.stacks.items()))
+        if stack_name_or_id in self.stacks:
+            return FakePage([FakeStack(stack_name_or_id, outputs=self.stacks[stack_name_or_id])])
+        return FakePage()
+
+    def close(self):
+        self.closed = True
+
+
+def isolate_cache(test):
+    """Point the stacks cache at a temporary directory until a test is done"""
+    cache_dir = cache.CACHE_DIR
+    cache.CACHE_DIR = tempfile.mkdtemp()
+    test.addCleanup(shutil.rmtree, cache.CACHE_DIR, True)
+    test.addCleanup(setattr, cache, 'CACHE_DIR', cache_dir)
@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from datetime import date
+
+from stacks import aws
+from stacks import cf
+from stacks.config import LazyValue, MEMO_KEY
+from tests.helpers import FakeCFConnection, isolate_cache
+
+
+class TestRenderTemplate(unittest.TestCase):
+
+    def setUp(self):
+        isolate_cache(self)
+        self.tpl_dir = tempfile.mkdtemp()
+        self.ami_calls = []
+
+        def get_ami_id(conn, name):
+            self.ami_calls.append(name)
+            return 'ami-123'
+
+        self.cf_conn = FakeCFConnection({'infra': {'SubnetAZ0': 'subnet-123', 'SecurityGroup': 'sg-123'}})
+        self.config = {
+            'env': 'dev',
+            'cf_conn': self.cf_conn,
+            'ec2_conn': None,
+            'get_ami_id': get_ami_id,
+            'get_stack_output': aws.get_stack_output,
+        }
+        patcher = mock.patch.object(cf, 'gen_template', wraps=cf.gen_template)
+        self.gen_template = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tpl_dir)
+
+    def render(self, fname='tests/fixtures/lookups_template.yaml', **kwargs):
+        kwargs.setdefault('use_cache', True)
+        with open(fname) as tpl_file:
+            return cf.render_template(tpl_file, self.config, **kwargs)
+
+    def test_cache_hit(self):
+        first = self.render()
+        second = self.render()
+        self.assertFalse(first['cached'])
+        self.assertTrue(second['cached'])
+        self.assertEqual(self.gen_template.call_count, 1)
+        for key in ['template', 'metadata', 'size', 'md5']:
+            self.assertEqual(first[key], second[key])
+        # Lookups are made again to check the cached artifact is still valid
+        self.assertEqual(self.ami_calls, ['coreos', 'coreos'])
+
+    def test_lookup_value_changed(self):
+        self.render()
+        self.cf_conn.stacks['infra']['SubnetAZ0'] = 'subnet-456'
+        artifact = self.render()
+        self.assertFalse(artifact['cached'])
+        self.assertIn('subnet-456', artifact['template'])
+        self.cf_conn.stacks['infra']['SubnetAZ0'] = 'subnet-123'
+        self.assertTrue(self.render()['cached'])
+
+    def test_config_changed(self):
+        self.render()
+        self.config['env'] = 'prod'
+        self.assertFalse(self.render()['cached'])
+
+    def test_non_json_value_changed(self):
+        for first, second in [(date(2026, 1, 1), date(2026, 2, 1)), (b'dev', b'prod'), ({'dev'}, {'prod'})]:
+            self.config['release'] = first
+            self.render()
+            self.assertTrue(self.render()['cached'])
+            self.config['release'] = second
+            self.assertFalse(self.render()['cached'])
+
+    def test_referenced_value_changed(self):
+        self.config['env'] = LazyValue('!ref', ['stage'])
+        self.config['stage'] = 'dev'
+        self.render()
+        self.config['stage'] = 'prod'
+        artifact = self.render()
+        self.assertFalse(artifact['cached'])
+        self.assertEqual(artifact['metadata']['name'], 'prod-lookups')
+
+    def test_lazy_lookup_memoized_per_run(self):
+        amis = {'coreos': 'ami-123'}
+        self.config['get_ami_id'] = lambda conn, name: amis[name]
+        self.config['ami'] = LazyValue('!ami_id', ['coreos'])
+        self.config[MEMO_KEY] = {}
+        for name in ['a.yaml', 'b.yaml']:
+            with open(os.path.join(self.tpl_dir, name), 'w') as f:
+                f.write("Description: {{ ami }}\n")
+        self.render(os.path.join(self.tpl_dir, 'a.yaml'))
+        # The lookup is recorded for b.yaml although a.yaml evaluated it first
+        self.render(os.path.join(self.tpl_dir, 'b.yaml'))
+        self.assertTrue(self.render(os.path.join(self.tpl_dir, 'b.yaml'))['cached'])
+        amis['coreos'] = 'ami-456'
+        self.config[MEMO_KEY] = {}
+        artifact = self.render(os.path.join(self.tpl_dir, 'b.yaml'))
+        self.assertFalse(artifact['cached'])
+        self.assertIn('ami-456', artifact['template'])
+
+    def test_include_changed(self):
+        with open(os.path.join(self.tpl_dir, 'main.yaml'), 'w') as f:
+            f.write("{% include 'vpc.yaml' %}\n")
+        for cidr in ['10.0.0.0/16', '10.1.0.0/16']:
+            with open(os.path.join(self.tpl_dir, 'vpc.yaml'), 'w') as f:
+                f.write('Resources:\n  VPC:\n    Type: AWS::EC2::VPC\n    Properties:\n'
+                        '      CidrBlock: {}\n'.format(cidr))
+            artifact = self.render(os.path.join(self.tpl_dir, 'main.yaml'))
+            self.assertFalse(artifact['cached'])
+            self.assertIn(cidr, artifact['template'])
+
+    def test_parallel_lookups_grouped(self):
+        for use_cache in [False, True]:
+            self.cf_conn.calls = 0
+            artifact = self.render(parallel_lookups=True, use_cache=use_cache)
+            self.assertFalse(artifact['cached'])
+            # Both outputs of the infra stack come from a single request
+            self.assertEqual(self.cf_conn.calls, 1)
+            self.assertIn('subnet-123', artifact['template'])
+        # Lookups answered by the grouped request are recorded
+        self.cf_conn.stacks['infra']['SecurityGroup'] = 'sg-456'
+        self.assertFalse(self.render(parallel_lookups=True)['cached'])
+
+    def test_no_cache(self):
+        self.render(use_cache=False)
+        self.assertFalse(self.render(use_cache=False)['cached'])
+        self.assertEqual(self.gen_template.call_count, 2)
@@ -0,0 +1,161 @@
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from moto import mock_s3_deprecated
+
+from stacks import cf
+from stacks.backend import Backend, SERVICES
+from stacks.exceptions import AWSError
+
+
+class FakeConnection(object):
+    def __init__(self, service, region, profile):
+        self.key = (service, region, profile)
+        self.closed = False
+        self.in_use = False
+
+    def describe_stacks(self, wait=None):
+        """Return whether the connection was in use by another call meanwhile"""
+        shared = self.in_use
+        self.in_use = True
+        if wait:
+            wait()
+        self.in_use = False
+        return shared
+
+    def close(self):
+        self.closed = True
+
+
+class FakeBackend(Backend):
+    def __init__(self):
+        super(FakeBackend, self).__init__()
+        self.created = []
+
+    def new_connection(self, service, region, profile=None):
+        if region == 'nowhere':
+            return None
+        conn = FakeConnection(service, region, profile)
+        self.created.append(conn)
+        return conn
+
+
+class MotoBackend(Backend):
+    """Connections to moto's mocked AWS, recording requests made on connections not checked out"""
+
+    def __init__(self):
+        super(MotoBackend, self).__init__()
+        self.checked_out = set()
+        self.stray_requests = []
+
+    def new_connection(self, service, region, profile=None):
+        conn = SERVICES[service].connect_to_region(region, aws_access_key_id='test', aws_secret_access_key='test')
+        make_request = conn.make_request
+
+        def checked_make_request(*args, **kwargs):
+            if conn not in self.checked_out:
+                self.stray_requests.append(args)
+            return make_request(*args, **kwargs)
+        conn.make_request = checked_make_request
+        return conn
+
+    def checkout(self, key):
+        conn = super(MotoBackend, self).checkout(key)
+        self.checked_out.add(conn)
+        return conn
+
+    def checkin(self, key, conn):
+        self.checked_out.discard(conn)
+        super(MotoBackend, self).checkin(key, conn)
+
+
+class TestBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = FakeBackend()
+
+    def test_connections_are_reused(self):
+        client = self.backend.client('cloudformation', 'eu-west-1')
+        for _ in range(3):
+            client.describe_stacks()
+        self.backend.client('cloudformation', 'eu-west-1').describe_stacks()
+        self.assertEqual(len(self.backend.created), 1)
+
+    def test_connections_per_key(self):
+        self.backend.client('cloudformation', 'eu-west-1').describe_stacks()
+        self.backend.client('cloudformation', 'us-east-1').describe_stacks()
+        self.backend.client('cloudformation', 'eu-west-1', 'prod').describe_stacks()
+        self.backend.client('ec2', 'eu-west-1').describe_stacks()
+        self.assertEqual(len(self.backend.created), 4)
+
+    def test_connections_not_shared(self):
+        client = self.backend.client('cloudformation', 'eu-west-1')
+        barrier = threading.Barrier(4)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            shared = list(executor.map(lambda _: client.describe_stacks(barrier.wait), range(4)))
+        self.assertEqual(shared, [False] * 4)
+        self.assertEqual(len(self.backend.created), 4)
+
+    def test_connections_reused_across_executors(self):
+        client = self.backend.client('cloudformation', 'eu-west-1')
+        for _ in range(2):
+            barrier = threading.Barrier(2)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                list(executor.map(lambda _: client.describe_stacks(barrier.wait), range(2)))
+        self.assertEqual(len(self.backend.created), 2)
+
+    def test_pool_size(self):
+        self.backend.pool_size = 2
+        client = self.backend.client('cloudformation', 'eu-west-1')
+        barrier = threading.Barrier(4)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(lambda _: client.describe_stacks(barrier.wait), range(4)))
+        self.assertEqual(sorted(c.closed for c in self.backend.created), [False, False, True, True])
+        self.backend.close()
+        self.assertTrue(all(c.closed for c in self.backend.created))
+
+    def test_close(self):
+        client = self.backend.client('cloudformation', 'eu-west-1')
+        client.describe_stacks()
+        client.close()
+        self.assertFalse(self.backend.created[0].closed)
+        self.backend.close()
+        self.assertTrue(self.backend.created[0].closed)
+        client.describe_stacks()
+        self.assertEqual(len(self.backend.created), 2)
+
+    def test_unknown_region(self):
+        with self.assertRaises(AWSError):
+            self.backend.client('cloudformation', 'nowhere').describe_stacks()
+
+    def test_unknown_service(self):
+        with self.assertRaises(AWSError):
+            self.backend.client('sqs', 'eu-west-1')
+
+
+@mock_s3_deprecated
+class TestMotoBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = MotoBackend()
+        self.addCleanup(self.backend.close)
+        self.s3_conn = self.backend.client('s3', 'us-east-1')
+        self.s3_conn.create_bucket('dev-stacks-us-east-1')
+        self.config = {'env': 'dev', 'region': 'us-east-1', 's3_conn': self.s3_conn}
+
+    def test_upload_holds_connection(self):
+        url = cf.upload_template(self.config, '{}', 'vpc')
+        self.assertIn('dev/vpc/', url)
+        self.assertEqual(self.backend.stray_requests, [])
+
+    def test_upload_nested_templates(self):
+        children = dict(('Child{}'.format(n), {'Resources': {}}) for n in range(4))
+        parent = {'Resources': dict((c, {'Properties': {}}) for c in children)}
+        cf.upload_nested_templates(self.config, parent, children, 'vpc')
+        self.assertEqual(self.backend.stray_requests, [])
+        with self.s3_conn.connection() as conn:
+            keys = [k.key for k in conn.get_bucket('dev-stacks-us-east-1').list('dev/vpc-')]
+        self.assertEqual(sorted(k.split('/')[1] for k in keys), ['vpc-' + c for c in sorted(children)])
+        self.assertEqual(parent['Resources']['Child0']['Properties']['TemplateURL'].split('?')[0].split('/')[-3:],
+                         keys[0].split('/'))
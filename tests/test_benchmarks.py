@@ -0,0 +1,25 @@
+import unittest
+
+from benchmarks import api
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_run(self):
+        results = api.run(stacks=5, events=20, resources=3, repeat=1)
+        self.assertEqual(len(results), len(api.benchmarks(5)))
+        self.assertTrue(all(r['requests'] >= 1 for r in results))
+
+    def test_regressions(self):
+        previous = {'results': [{'benchmark': 'list', 'seconds': 0.1, 'requests': 1},
+                                {'benchmark': 'status', 'seconds': 0.1, 'requests': 1}]}
+        results = [{'benchmark': 'list', 'seconds': 0.12, 'requests': 3},
+                   {'benchmark': 'status', 'seconds': 0.2, 'requests': 1},
+                   {'benchmark': 'new', 'seconds': 1, 'requests': 1}]
+        self.assertEqual(api.regressions(results, previous),
+                         [('list', 'requests 1 -> 3'), ('status', 'seconds 0.1 -> 0.2')])
+        self.assertEqual(api.regressions(results, None), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+from boto.exception import BotoServerError
+
+from stacks import bundle
+from stacks.exceptions import StacksError
+from tests.helpers import FakePage, FakeStack, isolate_cache
+
+
+class FakeBundleConnection(object):
+    """Creates and updates stacks, which complete right away unless they are meant to fail"""
+    def __init__(self, stacks, fail=(), unchanged=()):
+        self.stacks = stacks
+        self.fail = fail
+        self.unchanged = unchanged
+        self.calls = []
+
+    def describe_stacks(self, stack_name_or_id=None, next_token=None):
+        return FakePage(self.stacks.values())
+
+    def list_stacks(self, stack_status_filters=None, next_token=None):
+        return FakePage(s for s in self.stacks.values()
+                        if not stack_status_filters or s.stack_status in stack_status_filters)
+
+    def create_stack(self, stack_name, **kwargs):
+        self.deploy('create', stack_name, 'CREATE', kwargs)
+
+    def update_stack(self, stack_name, **kwargs):
+        if stack_name in self.unchanged:
+            err = BotoServerError(400, 'Bad Request')
+            err.message = 'No updates are to be performed.'
+            raise err
+        self.deploy('update', stack_name, 'UPDATE', kwargs)
+
+    def deploy(self, action, stack_name, status, kwargs):
+        self.calls.append((action, stack_name, kwargs))
+        state = 'ROLLBACK_COMPLETE' if stack_name in self.fail else status + '_COMPLETE'
+        self.stacks[stack_name] = FakeStack(stack_name, state)
+
+
+class TestBundle(unittest.TestCase):
+
+    def setUp(self):
+        isolate_cache(self)
+        self.tpl_dir = tempfile.mkdtemp()
+        self.bundle_dir = tempfile.mkdtemp()
+        self.write('vpc.yaml', "---\nname: {{ env }}-vpc\ntags:\n- key: Team\n  value: net\n---\n"
+                               "Resources:\n  VPC:\n    Type: AWS::EC2::VPC\n"
+                               "Outputs:\n  VpcId:\n    Value: {Ref: VPC}\n"
+                               "    Export: {Name: {'Fn::Sub': '${AWS::StackName}-VpcId'}}\n")
+        self.write('app.yaml', "---\nname: {{ env }}-app\n---\n"
+                               "Resources:\n  SG:\n    Type: AWS::EC2::SecurityGroup\n    Properties:\n"
+                               "      VpcId: {{ get_stack_output(cf_conn, env + '-vpc', 'VpcId') }}\n"
+                               "      GroupDescription: {'Fn::ImportValue': {{ env }}-vpc-VpcId}\n")
+        self.templates = [os.path.join(self.tpl_dir, t) for t in ['app.yaml', 'vpc.yaml']]
+        vpc = FakeStack('dev-vpc', outputs={'VpcId': 'vpc-1234abcd'})
+        self.conn = FakeBundleConnection({'dev-vpc': vpc})
+        self.config = {
+            'env': 'dev',
+            'region': 'eu-west-1',
+            'cf_conn': self.conn,
+            'get_stack_output': lambda conn, name, key: 'vpc-1234abcd',
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tpl_dir)
+        shutil.rmtree(self.bundle_dir)
+
+    def write(self, fname, content):
+        with open(os.path.join(self.tpl_dir, fname), 'w') as f:
+            f.write(content)
+
+    def test_create(self):
+        manifest = bundle.create(self.templates, self.config, self.bundle_dir)
+        self.assertEqual(manifest['waves'], [['dev-vpc'], ['dev-app']])
+        self.assertEqual(manifest['dependencies'], {'dev-app': ['dev-vpc'], 'dev-vpc': []})
+
+        loaded = bundle.load(self.bundle_dir)
+        vpc = [s for s in loaded['stacks'] if s['name'] == 'dev-vpc'][0]
+        self.assertEqual(vpc['tags'], {'Team': 'net', 'Env': 'dev', 'MD5Sum': vpc['md5']})
+        self.assertIn('AWS::EC2::VPC', vpc['body'])
+
+    def test_import_dependencies(self):
+        bodies = {
+            'vpc': json.dumps({'Outputs': {'Id': {'Value': 'x', 'Export': {'Name': 'vpc-id'}}}}),
+            'db': json.dumps({'Outputs': {'Host': {'Value': 'x',
+                                                   'Export': {'Name': {'Fn::Sub': '${AWS::StackName}-host'}}}},
+                              'Resources': {'A': {'Properties': {'VpcId': {'Fn::ImportValue': 'vpc-id'}}}}}),
+            'app': json.dumps({'Resources': {'A': {'Properties': {'Hosts': [{'Fn::ImportValue': 'db-host'}],
+                                                                  'Zone': {'Fn::ImportValue': 'deployed-zone'}}}}}),
+        }
+        self.assertEqual(bundle.import_dependencies(bodies), {'vpc': set(), 'db': {'vpc'}, 'app': {'db'}})
+
+    def test_load_modified_bundle(self):
+        manifest = bundle.create(self.templates, self.config, self.bundle_dir)
+        with open(os.path.join(self.bundle_dir, manifest['stacks'][0]['template']), 'a') as f:
+            f.write(' ')
+        with self.assertRaises(StacksError):
+            bundle.load(self.bundle_dir)
+
+    def test_create_duplicate_names(self):
+        with self.assertRaises(StacksError):
+            bundle.create(self.templates + self.templates[:1], self.config, self.bundle_dir)
+
+    def test_deploy(self):
+        bundle.create(self.templates, self.config, self.bundle_dir)
+        manifest = bundle.load(self.bundle_dir)
+        conn = FakeBundleConnection({'dev-vpc': FakeStack('dev-vpc', 'CREATE_COMPLETE')}, unchanged=['dev-vpc'])
+        results = bundle.deploy(conn, manifest, bundle.deploy_config(manifest), interval=0)
+        self.assertEqual(results, [
+            {'name': 'dev-app', 'status': 'CREATE_COMPLETE', 'error': None},
+            {'name': 'dev-vpc', 'status': bundle.NO_UPDATES, 'error': None},
+        ])
+        self.assertEqual(conn.calls[0][0:2], ('create', 'dev-app'))
+        body = json.loads(conn.calls[0][2]['template_body'])
+        self.assertEqual(body['Resources']['SG']['Properties']['VpcId'], 'vpc-1234abcd')
+
+    def test_deploy_stops_after_failed_wave(self):
+        bundle.create(self.templates, self.config, self.bundle_dir)
+        manifest = bundle.load(self.bundle_dir)
+        conn = FakeBundleConnection({}, fail=['dev-vpc'])
+        results = bundle.deploy(conn, manifest, bundle.deploy_config(manifest), interval=0)
+        self.assertEqual([(r['name'], r['status']) for r in results],
+                         [('dev-app', bundle.SKIPPED), ('dev-vpc', 'ROLLBACK_COMPLETE')])
+        self.assertTrue(all(bundle.failed(r) for r in results))
+
+    def test_deploy_config_region(self):
+        manifest = {'env': 'dev', 'region': 'eu-west-1'}
+        self.assertEqual(bundle.deploy_config(manifest, 'eu-west-1'), {'env': 'dev', 'region': 'eu-west-1'})
+        with self.assertRaises(StacksError):
+            bundle.deploy_config(manifest, 'us-east-1')
+
+
+if __name__ == '__main__':
+    unittest.main()
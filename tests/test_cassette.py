@@ -0,0 +1,78 @@
+import shutil
+import tempfile
+import unittest
+
+from stacks import cassette
+from stacks.exceptions import AWSError
+
+
+class FakeRequest(object):
+    def __init__(self, action, body=b''):
+        self.method = 'POST'
+        self.host = 'cloudformation.us-east-1.amazonaws.com'
+        self.path = '/'
+        self.params = {'Action': action}
+        self.body = body
+
+
+class FakeConnection(object):
+    """Answers every request with a numbered body"""
+    def __init__(self):
+        self.calls = 0
+
+    def _mexe(self, request):
+        self.calls += 1
+        body = request.body or '{} {}'.format(request.params['Action'], self.calls).encode()
+        return cassette.RecordedResponse(200, 'OK', [('Content-Type', 'text/xml')], body)
+
+
+class TestCassette(unittest.TestCase):
+
+    def setUp(self):
+        self.cassette_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cassette_dir)
+
+    def record(self, requests):
+        recording = cassette.Cassette(self.cassette_dir, 'cloudformation', cassette.RECORD)
+        conn = recording.wrap(FakeConnection())
+        bodies = [conn._mexe(r).read() for r in requests]
+        recording.save()
+        return bodies
+
+    def replay(self):
+        conn = FakeConnection()
+        cassette.Cassette(self.cassette_dir, 'cloudformation', cassette.REPLAY).wrap(conn)
+        return conn
+
+    def test_replay_in_recorded_order(self):
+        recorded = self.record([FakeRequest('DescribeStacks'), FakeRequest('DescribeStacks')])
+        conn = self.replay()
+        replayed = [conn._mexe(FakeRequest('DescribeStacks')).read() for _ in range(3)]
+        self.assertEqual(replayed, recorded + recorded[-1:])
+        self.assertEqual(conn.calls, 0)
+
+    def test_replay_binary_body(self):
+        self.record([FakeRequest('GetObject', body=b'\xff\x00')])
+        response = self.replay()._mexe(FakeRequest('GetObject', body=b'\xff\x00'))
+        self.assertEqual(response.read(), b'\xff\x00')
+        self.assertEqual(response.getheader('content-type'), 'text/xml')
+
+    def test_replay_unrecorded_request(self):
+        self.record([FakeRequest('DescribeStacks')])
+        with self.assertRaises(AWSError):
+            self.replay()._mexe(FakeRequest('ListStacks'))
+
+    def test_replay_clock(self):
+        self.addCleanup(cassette._cassettes.clear)
+        recorded = [cassette.now(self.cassette_dir, cassette.RECORD, 'update') for _ in range(2)]
+        cassette._cassette(self.cassette_dir, cassette.CLOCK, cassette.RECORD).save()
+        replayed = [cassette.now(self.cassette_dir, cassette.REPLAY, 'update') for _ in range(3)]
+        self.assertEqual(replayed, recorded + recorded[-1:])
+        with self.assertRaises(AWSError):
+            cassette.now(self.cassette_dir, cassette.REPLAY, 'delete')
+
+    def test_replay_missing_cassette(self):
+        with self.assertRaises(AWSError):
+            cassette.Cassette(self.cassette_dir, 'ec2', cassette.REPLAY)
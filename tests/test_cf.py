@@ -1,8 +1,17 @@
+import json
 import unittest
+from unittest import mock
+from datetime import datetime, timedelta
 import boto
+import jinja2
+from boto.exception import BotoServerError
 from moto import mock_cloudformation
 
+from stacks import aws
 from stacks import cf
+from stacks import config as stacks_config
+from stacks.exceptions import StacksError, TemplateError
+from tests.helpers import FakeCFConnection, FakePage, isolate_cache
 
 
 class TestTemplate(unittest.TestCase):
@@ -18,17 +27,433 @@ class TestTemplate(unittest.TestCase):
         config = {'env': 'dev', 'test_tag': 'testing'}
         tpl_file = open('tests/fixtures/invalid_template.yaml')
 
-        with self.assertRaises(SystemExit) as err:
+        with self.assertRaises(TemplateError):
             tpl, options = cf.gen_template(tpl_file, config)
-        self.assertEqual(err.exception.code, 1)
 
     def test_gen_template_missing_properties(self):
         config = {'env': 'unittest'}
         tpl_file = open('tests/fixtures/valid_template.yaml')
 
-        with self.assertRaises(SystemExit) as err:
+        with self.assertRaises(TemplateError):
             tpl, options = cf.gen_template(tpl_file, config)
-        self.assertEqual(err.exception.code, 1)
+
+    def test_gen_template_lazy_values(self):
+        lookups = []
+
+        def lookup(conn, *args):
+            lookups.append(args)
+            return '-'.join(args)
+
+        config = stacks_config.config_load('dev', 'tests/fixtures/config_lazy.yaml')
+        config.update({'get_ami_id': lookup, 'get_stack_output': lookup, 'ec2_conn': None, 'cf_conn': None})
+        for parallel_lookups in [False, True]:
+            del lookups[:]
+            with open('tests/fixtures/lazy_template.yaml') as tpl_file:
+                tpl, options = cf.gen_template(tpl_file, config, parallel_lookups)
+            self.assertIn('"ImageId": "CoreOS-stable"', tpl)
+            self.assertIn('"SubnetId": "infra-SubnetAZ0"', tpl)
+            self.assertIn('infra in /nonexistent', tpl)
+            # Lazy values nested in dicts are evaluated too
+            self.assertIn('"Stack": "infra"', tpl)
+            self.assertEqual(sorted(lookups), [('CoreOS-stable',), ('infra', 'SubnetAZ0')])
+
+
+class TestSnippets(unittest.TestCase):
+
+    def test_snippets_compiled_once(self):
+        config = {'env': 'dev', 'snippets_path': 'tests/fixtures/snippets'}
+        cf._snippets_code.clear()
+        compiled = []
+        compile = jinja2.Environment.compile
+
+        def counting_compile(env, source, name=None, filename=None, *args, **kwargs):
+            compiled.append(name)
+            return compile(env, source, name, filename, *args, **kwargs)
+
+        with mock.patch.object(jinja2.Environment, 'compile', counting_compile):
+            for name in ['a', 'b']:
+                # Templates in different directories get their own environment
+                cf._jinja_envs.clear()
+                with open('tests/fixtures/snippet_templates/{}.yaml'.format(name)) as tpl_file:
+                    tpl, options = cf.gen_template(tpl_file, config)
+                self.assertIn('dev-vpc-{}'.format(name), tpl)
+        self.assertEqual(compiled.count('tags.yaml'), 1)
+
+    def test_snippets_path_missing(self):
+        config = {'env': 'dev'}
+        with open('tests/fixtures/snippet_templates/a.yaml') as tpl_file:
+            with self.assertRaises(jinja2.TemplateNotFound):
+                cf.gen_template(tpl_file, config)
+
+
+class FakeValidationConnection(object):
+    def __init__(self):
+        self.calls = 0
+
+    def validate_template(self, template_body=None, template_url=None):
+        self.calls += 1
+        if template_body and 'Invalid' in template_body:
+            raise BotoServerError(400, 'Bad Request',
+                                  body={'Error': {'Code': 'ValidationError', 'Message': 'Invalid template'}})
+        return boto.cloudformation.template.Template()
+
+
+class TestValidateTemplate(unittest.TestCase):
+
+    def setUp(self):
+        isolate_cache(self)
+        self.conn = FakeValidationConnection()
+
+    def test_validate_template_cached(self):
+        tpl = '{"Resources": {}}'
+        result = cf.validate_template(self.conn, tpl)
+        self.assertTrue(result['valid'])
+        self.assertFalse(result['cached'])
+        result = cf.validate_template(self.conn, tpl)
+        self.assertTrue(result['valid'])
+        self.assertTrue(result['cached'])
+        self.assertEqual(self.conn.calls, 1)
+
+    def test_validate_invalid_template(self):
+        tpl = '{"Invalid": {}}'
+        result = cf.validate_template(self.conn, tpl)
+        self.assertFalse(result['valid'])
+        result = cf.validate_template(self.conn, tpl)
+        self.assertFalse(result['valid'])
+        self.assertEqual(self.conn.calls, 1)
+
+    def test_validate_templates(self):
+        config = {'env': 'dev', 'test_tag': 'testing'}
+        tpl_files = [open('tests/fixtures/valid_template.yaml'), open('tests/fixtures/create_stack_template.yaml')]
+        config['custom_tag'] = 'custom'
+        results = cf.validate_templates(self.conn, tpl_files, config, jobs=2)
+        self.assertEqual([r[0] for r in results], [f.name for f in tpl_files])
+        self.assertTrue(all(r['valid'] for _, r in results))
+        for f in tpl_files:
+            f.close()
+
+    @mock.patch('stacks.cf.MAX_TEMPLATE_BODY_SIZE', 10)
+    @mock.patch('stacks.cf.upload_template', return_value='https://s3/tpl')
+    def test_validate_templates_upload_on_cache_miss(self, upload_template):
+        config = {'env': 'dev', 'test_tag': 'testing'}
+        for _ in range(2):
+            with open('tests/fixtures/valid_template.yaml') as f:
+                results = cf.validate_templates(self.conn, [f], config)
+            self.assertTrue(results[0][1]['valid'])
+        self.assertEqual(upload_template.call_count, 1)
+        self.assertEqual(self.conn.calls, 1)
+        self.assertTrue(results[0][1]['cached'])
+
+
+class FakeEvent(object):
+    def __init__(self, n, timestamp):
+        self.event_id = str(n)
+        self.timestamp = timestamp
+
+
+class FakeEventsConnection(object):
+    """Serves events newest first, page_size events per page"""
+    def __init__(self, count, page_size):
+        start = datetime(2017, 1, 1)
+        events = [FakeEvent(n, start + timedelta(minutes=n)) for n in range(count)]
+        events.reverse()
+        self.pages = [events[i:i + page_size] for i in range(0, count, page_size)]
+        self.fetched = 0
+
+    def describe_stack_events(self, stack_name, next_token=None):
+        n = int(next_token or 0)
+        self.fetched += 1
+        page = FakePage(self.pages[n])
+        if n + 1 < len(self.pages):
+            page.next_token = str(n + 1)
+        return page
+
+
+class TestTailEvents(unittest.TestCase):
+
+    def test_tail_events_last_lines(self):
+        conn = FakeEventsConnection(100, 30)
+        events = cf.tail_events(conn, 'stack', 40)
+        self.assertEqual([e.event_id for e in events], [str(n) for n in range(60, 100)])
+        self.assertEqual(conn.fetched, 2)
+
+    def test_tail_events_since_until(self):
+        conn = FakeEventsConnection(100, 10)
+        since = datetime(2017, 1, 1) + timedelta(minutes=50)
+        until = datetime(2017, 1, 1) + timedelta(minutes=79)
+        events = cf.tail_events(conn, 'stack', 1000, since, until)
+        self.assertEqual([e.event_id for e in events], [str(n) for n in range(50, 80)])
+        self.assertEqual(conn.fetched, 6)
+
+    def test_tail_events_fewer_than_lines(self):
+        conn = FakeEventsConnection(5, 2)
+        events = cf.tail_events(conn, 'stack', 10)
+        self.assertEqual([e.event_id for e in events], [str(n) for n in range(5)])
+
+
+class FakeStackSummary(object):
+    def __init__(self, stack_name, stack_status):
+        self.stack_name = stack_name
+        self.stack_status = stack_status
+        self.template_description = None
+
+
+class FakeStatusConnection(object):
+    """Serves a sequence of list_stacks sweeps, two stacks per page"""
+    def __init__(self, sweeps):
+        self.sweeps = sweeps
+        self.sweep = -1
+        self.calls = 0
+
+    def list_stacks(self, stack_status_filters=None, next_token=None):
+        self.calls += 1
+        if next_token is None:
+            self.sweep = min(self.sweep + 1, len(self.sweeps) - 1)
+        stacks = sorted(s for s in self.sweeps[self.sweep].items()
+                        if not stack_status_filters or s[1] in stack_status_filters)
+        n = int(next_token or 0)
+        page = FakePage(FakeStackSummary(*s) for s in stacks[n:n + 2])
+        if n + 2 < len(stacks):
+            page.next_token = str(n + 2)
+        return page
+
+
+class TestListStacks(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeStatusConnection([{
+            'dev-app': 'CREATE_COMPLETE', 'dev-db': 'ROLLBACK_COMPLETE', 'dev-old': 'DELETE_COMPLETE',
+            'dev-vpc': 'UPDATE_COMPLETE', 'prod-app': 'CREATE_COMPLETE', 'prod-vpc': 'UPDATE_IN_PROGRESS',
+        }])
+
+    def test_get_stacks_pages(self):
+        stacks = cf.get_stacks(self.conn, 'dev-*')
+        self.assertEqual([s['stack_name'] for s in stacks], ['dev-app', 'dev-db', 'dev-vpc'])
+        self.assertEqual(self.conn.calls, 3)
+
+    def test_get_stacks_status_filter(self):
+        stacks = cf.get_stacks(self.conn, states=['CREATE_COMPLETE', 'DELETE_COMPLETE'])
+        self.assertEqual([s['stack_name'] for s in stacks], ['dev-app', 'dev-old', 'prod-app'])
+
+    def test_get_stacks_limit(self):
+        stacks = cf.get_stacks(self.conn, 'dev-*', limit=2)
+        self.assertEqual([s['stack_name'] for s in stacks], ['dev-app', 'dev-db'])
+        self.assertEqual(self.conn.calls, 1)
+
+    def test_print_stacks_limit(self):
+        with mock.patch('builtins.print') as fake_print:
+            count = cf.print_stacks(self.conn, limit=3)
+        self.assertEqual(count, 3)
+        self.assertEqual(fake_print.call_count, 2)
+        self.assertEqual(self.conn.calls, 2)
+
+    def test_get_stack_status_early_exit(self):
+        self.assertEqual(cf.get_stack_status(self.conn, 'dev-db'), 'ROLLBACK_COMPLETE')
+        self.assertEqual(self.conn.calls, 1)
+
+
+class TestWaitStacks(unittest.TestCase):
+
+    def test_get_stack_statuses(self):
+        conn = FakeStatusConnection([{'a': 'CREATE_COMPLETE', 'b': 'DELETE_COMPLETE', 'c': 'UPDATE_IN_PROGRESS'}])
+        # Deleted stacks are left out
+        self.assertEqual(cf.get_stack_statuses(conn), {'a': 'CREATE_COMPLETE', 'c': 'UPDATE_IN_PROGRESS'})
+        self.assertEqual(conn.calls, 1)
+        self.assertEqual(cf.get_stack_statuses(conn, ['c']), {'c': 'UPDATE_IN_PROGRESS'})
+        self.assertIsNone(cf.get_stack_status(conn, 'b'))
+
+    def test_wait_stacks(self):
+        conn = FakeStatusConnection([
+            {'pr-1-a': 'CREATE_IN_PROGRESS', 'pr-1-b': 'UPDATE_IN_PROGRESS', 'other': 'CREATE_IN_PROGRESS'},
+            {'pr-1-a': 'CREATE_COMPLETE', 'pr-1-b': 'UPDATE_IN_PROGRESS', 'other': 'CREATE_IN_PROGRESS'},
+            {'pr-1-a': 'CREATE_COMPLETE', 'pr-1-b': 'UPDATE_ROLLBACK_COMPLETE', 'other': 'CREATE_IN_PROGRESS'},
+        ])
+        results = cf.wait_stacks(conn, ['pr-1-*', 'missing'], interval=0)
+        self.assertEqual(results, {
+            'pr-1-a': 'CREATE_COMPLETE',
+            'pr-1-b': 'UPDATE_ROLLBACK_COMPLETE',
+            'missing': None,
+        })
+        self.assertEqual(conn.sweep, 2)
+
+    def test_wait_stacks_deleted(self):
+        conn = FakeStatusConnection([
+            {'a': 'DELETE_IN_PROGRESS', 'b': 'DELETE_IN_PROGRESS'},
+            {'a': 'DELETE_COMPLETE', 'b': 'DELETE_FAILED'},
+        ])
+        results = cf.wait_stacks(conn, ['a', 'b'], interval=0, terminal_states=['DELETE_COMPLETE', 'DELETE_FAILED'])
+        self.assertEqual(results, {'a': 'DELETE_COMPLETE', 'b': 'DELETE_FAILED'})
+
+    def test_wait_stacks_timeout(self):
+        conn = FakeStatusConnection([{'a': 'CREATE_IN_PROGRESS'}])
+        results = cf.wait_stacks(conn, ['a'], timeout=0.01, interval=0.01)
+        self.assertEqual(results, {'a': 'CREATE_IN_PROGRESS'})
+
+
+class FakeNestedEvent(object):
+    def __init__(self, stack_id, minute, logical_id, status, rtype='AWS::EC2::Instance', physical_id=None):
+        self.stack_id = stack_id
+        self.stack_name = stack_id
+        self.event_id = '{}-{}-{}'.format(stack_id, logical_id, status)
+        self.timestamp = datetime(2017, 1, 1) + timedelta(minutes=minute)
+        self.logical_resource_id = logical_id
+        self.physical_resource_id = physical_id
+        self.resource_type = rtype
+        self.resource_status = status
+        self.resource_status_reason = None
+
+
+class FakeNestedConnection(object):
+    """Serves events of a parent and a nested stack, revealing one more minute per poll"""
+    def __init__(self):
+        nested = cf.NESTED_STACK_TYPE
+        self.events = {
+            'parent': [
+                FakeNestedEvent('parent', 0, 'parent', 'CREATE_IN_PROGRESS', nested, 'parent'),
+                FakeNestedEvent('parent', 1, 'Child', 'CREATE_IN_PROGRESS', nested, 'child'),
+                FakeNestedEvent('parent', 4, 'Child', 'CREATE_FAILED', nested, 'child'),
+                FakeNestedEvent('parent', 5, 'parent', 'ROLLBACK_COMPLETE', nested, 'parent'),
+            ],
+            'child': [
+                FakeNestedEvent('child', 2, 'child', 'CREATE_IN_PROGRESS', nested, 'child'),
+                FakeNestedEvent('child', 3, 'Instance', 'CREATE_FAILED'),
+            ],
+        }
+        self.minute = -1
+        self.described = []
+
+    def list_stacks(self, stack_status_filters=None, next_token=None):
+        self.minute += 1
+        status = 'ROLLBACK_COMPLETE' if self.minute >= 5 else 'CREATE_IN_PROGRESS'
+        return FakePage([FakeStackSummary('parent', status)])
+
+    def describe_stack_events(self, stack_name, next_token=None):
+        self.described.append(stack_name)
+        # Newest first
+        return FakePage(reversed([e for e in self.events[stack_name] if e.timestamp.minute <= self.minute + 1]))
+
+
+class TestFollowEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.rate = cf.EVENTS_RATE
+        cf.EVENTS_RATE = 0
+
+    def tearDown(self):
+        cf.EVENTS_RATE = self.rate
+
+    def test_follow_nested_events(self):
+        conn = FakeNestedConnection()
+        batches = []
+        status = cf.follow_events(conn, 'parent', batches.append, interval=0)
+        self.assertEqual(status, 'ROLLBACK_COMPLETE')
+
+        events = [e for batch in batches for e in batch]
+        self.assertEqual([(e.logical_resource_id, e.depth) for e in events], [
+            ('parent', 0), ('Child', 0), ('child', 1), ('Instance', 1), ('Child', 0), ('parent', 0)])
+        for batch in batches:
+            self.assertEqual(batch, sorted(batch, key=lambda e: e.timestamp))
+        self.assertIn('child', conn.described)
+
+    def test_follow_without_nested(self):
+        conn = FakeNestedConnection()
+        batches = []
+        cf.follow_events(conn, 'parent', batches.append, interval=0, nested=False)
+        self.assertEqual(set(e.stack_id for batch in batches for e in batch), set(['parent']))
+        self.assertNotIn('child', conn.described)
+
+
+class TestAllOutputs(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeCFConnection({
+            'prod-vpc': {'VpcId': 'vpc-12345678', 'SubnetIds': 'subnet-1,subnet-2'},
+            'prod-db': {'Endpoint': "db's.example.com"},
+            'dev-vpc': {'VpcId': 'vpc-87654321'},
+        })
+
+    def test_get_all_outputs(self):
+        outputs = cf.get_all_outputs(self.conn, 'prod-*')
+        self.assertEqual(list(outputs), ['prod-db', 'prod-vpc'])
+        self.assertEqual(outputs['prod-vpc']['VpcId'], 'vpc-12345678')
+
+    def test_format_outputs(self):
+        outputs = cf.get_all_outputs(self.conn, 'prod-*')
+        self.assertEqual(cf.format_outputs(outputs, 'env').splitlines(), [
+            'PROD_DB_ENDPOINT=\'db\'"\'"\'s.example.com\'',
+            'PROD_VPC_VPCID=vpc-12345678',
+            'PROD_VPC_SUBNETIDS=subnet-1,subnet-2',
+        ])
+        self.assertEqual(json.loads(cf.format_outputs(outputs, 'json', 'VpcId')),
+                         {'prod-db': {}, 'prod-vpc': {'VpcId': 'vpc-12345678'}})
+
+
+class FakeImportsConnection(object):
+    """Serves ListExports and ListImports of exports given as (exporting stack, importing stacks) tuples"""
+    def __init__(self, exports):
+        self.exports = exports
+
+    def get_list(self, action, params, markers):
+        page = FakePage()
+        if action == 'ListExports':
+            for name, (stack_name, _) in sorted(self.exports.items()):
+                export = aws.Export()
+                export.endElement('ExportingStackId', 'arn:aws:cloudformation:eu-west-1:123:stack/{}/1'.format(
+                    stack_name), None)
+                export.endElement('Name', name, None)
+                page.append(export)
+            return page
+        importers = self.exports[params['ExportName']][1]
+        if not importers:
+            err = BotoServerError(400, 'Bad Request')
+            err.message = "Export '{}' is not imported by any stack.".format(params['ExportName'])
+            raise err
+        for stack_name in importers:
+            imported = aws.Import()
+            imported.endElement('member', stack_name, None)
+            page.append(imported)
+        return page
+
+
+class TestDeleteStacks(unittest.TestCase):
+
+    def test_stack_dependencies(self):
+        conn = FakeImportsConnection({
+            'pr-1-vpc-VpcId': ('pr-1-vpc', ['pr-1-db', 'pr-1-app', 'pr-2-app']),
+            'pr-1-vpc-Unused': ('pr-1-vpc', []),
+            'pr-1-db-Endpoint': ('pr-1-db', ['pr-1-app']),
+            'pr-2-vpc-VpcId': ('pr-2-vpc', ['pr-1-app']),
+        })
+        deps = cf.stack_dependencies(conn, ['pr-1-app', 'pr-1-db', 'pr-1-vpc'])
+        self.assertEqual(deps, {
+            'pr-1-vpc': set(),
+            'pr-1-db': {'pr-1-vpc'},
+            'pr-1-app': {'pr-1-vpc', 'pr-1-db'},
+        })
+
+    def test_delete_stacks_error(self):
+        class FakeDeleteConnection(object):
+            def delete_stack(self, stack_name):
+                err = BotoServerError(400, 'Bad Request')
+                err.message = 'Stack pr-1-vpc is in use by an import'
+                raise err
+
+        with self.assertRaises(StacksError):
+            cf.delete_stacks(FakeDeleteConnection(), [['pr-1-vpc']], interval=0)
+
+    def test_deletion_waves(self):
+        deps = {
+            'vpc': set(),
+            'db': {'vpc'},
+            'cache': {'vpc'},
+            'app': {'vpc', 'db', 'cache'},
+        }
+        self.assertEqual(cf.deletion_waves(deps), [['app'], ['cache', 'db'], ['vpc']])
+
+    def test_deletion_waves_cycle(self):
+        deps = {'a': {'b'}, 'b': {'a'}, 'c': {'a'}}
+        with self.assertRaises(StacksError):
+            cf.deletion_waves(deps)
 
 
 @mock_cloudformation
@@ -40,6 +465,7 @@ class TestStackActions(unittest.TestCase):
             'custom_tag': 'custom-tag-value',
             'region': 'us-east-1',
         }
+        isolate_cache(self)
         self.config['cf_conn'] = boto.cloudformation.connect_to_region(self.config['region'])
         self.config['s3_conn'] = boto.s3.connect_to_region(self.config['region'])
 
@@ -73,9 +499,8 @@ class TestStackActions(unittest.TestCase):
     def test_create_stack_no_stack_name(self):
         stack_name = None
         with open('tests/fixtures/no_metadata_template.yaml') as tpl_file:
-            with self.assertRaises(SystemExit) as err:
+            with self.assertRaises(StacksError):
                 cf.create_stack(self.config['cf_conn'], stack_name, tpl_file, self.config)
-            self.assertEqual(err.exception.code, 1)
 
     def test_create_stack_no_metadata(self):
         stack_name = 'my-stack'
@@ -86,5 +511,6 @@ class TestStackActions(unittest.TestCase):
         self.assertEqual(self.config['env'], stack.tags['Env'])
         self.assertEqual('b08c2e9d7003f62ba8ffe5c985c50a63', stack.tags['MD5Sum'])
 
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+from unittest import mock
+
+from stacks.backend import Backend
+from stacks.client import StacksClient
+from stacks.exceptions import ConfigError, StackNotFoundError, TemplateError
+from tests.helpers import FakeCFConnection
+
+
+class FakeBackend(Backend):
+    def __init__(self, cf_conn):
+        super(FakeBackend, self).__init__()
+        self.cf_conn = cf_conn
+
+    def new_connection(self, service, region, profile=None):
+        return self.cf_conn
+
+
+class TestStacksClient(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = FakeCFConnection({'infra': {'VpcId': 'vpc-123'}})
+        self.client = StacksClient(region='us-east-1', config={'env': 'dev', 'cf_conn': self.conn},
+                                   properties={'test_tag': 'testing'}, connect=False)
+
+    def test_render(self):
+        tpl, metadata = self.client.render('tests/fixtures/valid_template.yaml')
+        self.assertIn('dev-test-vpc', tpl)
+        self.assertEqual(metadata['metadata']['tags'][0]['value'], 'testing')
+
+    def test_render_invalid_template(self):
+        with self.assertRaises(TemplateError):
+            self.client.render('tests/fixtures/invalid_template.yaml')
+
+    def test_create_dry(self):
+        with mock.patch('builtins.print') as fake_print:
+            result = self.client.create('tests/fixtures/valid_template.yaml', 'dev-test-stack', dry=True)
+        fake_print.assert_not_called()
+        self.assertEqual(result['name'], 'dev-test-stack')
+        self.assertIn('"Description": "Test Stack"', result['template'])
+        self.assertEqual(result['size'], len(result['template']))
+        self.assertEqual(result['tags']['Env'], 'dev')
+        self.assertEqual(result['children'], {})
+
+    def test_outputs(self):
+        self.assertEqual(self.client.outputs('infra'), {'VpcId': 'vpc-123'})
+
+    def test_outputs_missing_stack(self):
+        with self.assertRaises(StackNotFoundError):
+            self.client.outputs('missing')
+
+    def test_close(self):
+        backend = FakeBackend(self.conn)
+        with StacksClient(region='us-east-1', config={'env': 'dev'}, backend=backend) as client:
+            self.assertEqual(client.outputs('infra'), {'VpcId': 'vpc-123'})
+            client.conn.close()
+            self.assertFalse(self.conn.closed)
+        self.assertTrue(self.conn.closed)
+
+    def test_config_not_shared(self):
+        config = {'env': 'dev'}
+        eu = StacksClient(region='eu-west-1', config=config, properties={'vpc': 'eu'}, connect=False)
+        us = StacksClient(region='us-east-1', config=config, properties={'vpc': 'us'})
+        self.assertEqual(config, {'env': 'dev'})
+        self.assertEqual(eu.config['vpc'], 'eu')
+        self.assertEqual(us.config['vpc'], 'us')
+        self.assertNotIn('region', eu.config)
+
+    def test_reserved_properties(self):
+        with self.assertRaises(ConfigError):
+            StacksClient(region='us-east-1', config={'env': 'dev'}, properties=['env=prod'], connect=False)
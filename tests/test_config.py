@@ -1,7 +1,10 @@
+import threading
+import time
 import unittest
 import uuid
 
 from stacks import config
+from stacks.exceptions import ConfigError
 
 
 class TestConfig(unittest.TestCase):
@@ -77,6 +80,104 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(cfg['comes_from'], '20-config')
 
 
+class TestLazyValues(unittest.TestCase):
+    def setUp(self):
+        self.config = config.config_load('myenv', 'tests/fixtures/config_lazy.yaml')
+
+    def test_lazy_values_loaded(self):
+        self.assertIsInstance(self.config['tag_from_ref'], config.LazyValue)
+        self.assertIsInstance(self.config['coreos_ami'], config.LazyValue)
+        self.assertEqual(str(self.config['subnet']), '!stack_output !ref infra_stack_name SubnetAZ0')
+
+    def test_lazy_ref(self):
+        value = config.resolve(self.config, self.config['tag_from_ref'])
+        self.assertEqual(value, 'infra')
+
+    def test_lazy_env(self):
+        self.assertEqual(config.resolve(self.config, self.config['home']), '/nonexistent')
+
+    def test_lazy_lookup_memoized(self):
+        calls = []
+
+        def get_ami_id(conn, name):
+            calls.append((conn, name))
+            return 'ami-123'
+
+        self.config['get_ami_id'] = get_ami_id
+        self.config['ec2_conn'] = 'ec2'
+        context = config.render_context(self.config)
+        for _ in range(2):
+            self.assertEqual(config.resolve(context, self.config['coreos_ami']), 'ami-123')
+        self.assertEqual(calls, [('ec2', 'CoreOS-stable')])
+
+        # Without a run memo every render looks values up again
+        config.resolve(config.render_context(self.config), self.config['coreos_ami'])
+        self.assertEqual(len(calls), 2)
+
+    def test_lazy_lookup_memoized_per_run(self):
+        calls = []
+
+        def get_ami_id(conn, name):
+            calls.append(name)
+            return 'ami-123'
+
+        self.config['get_ami_id'] = get_ami_id
+        self.config[config.MEMO_KEY] = {}
+        for _ in range(2):
+            config.resolve(config.render_context(self.config), self.config['coreos_ami'])
+        self.assertEqual(calls, ['CoreOS-stable'])
+        # A fresh memo does not see nor keep values of the run
+        context = config.render_context(self.config, fresh=True)
+        config.resolve(context, self.config['coreos_ami'])
+        self.assertEqual(len(calls), 2)
+        self.assertIsNot(context[config.MEMO_KEY], self.config[config.MEMO_KEY])
+
+    def test_lazy_concurrent_resolve(self):
+        def get_ami_id(conn, name):
+            time.sleep(0.05)
+            return 'ami-123'
+
+        self.config['get_ami_id'] = get_ami_id
+        self.config['ami'] = config.LazyValue('!ref', ['coreos_ami'])
+        context = config.render_context(self.config)
+        results = []
+        errors = []
+
+        def resolve():
+            try:
+                results.append(config.resolve(context, self.config['ami']))
+            except Exception as err:
+                errors.append(err)
+
+        threads = [threading.Thread(target=resolve) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(results, ['ami-123'] * 4)
+
+    def test_lazy_nested_values(self):
+        self.config['tags'] = {'stack': self.config['tag_from_ref'], 'names': [self.config['tag_from_ref'], 'b']}
+        self.assertEqual(config.resolve(self.config, self.config['tags']),
+                         {'stack': 'infra', 'names': ['infra', 'b']})
+        self.config['ref_tags'] = config.LazyValue('!ref', ['tags'])
+        self.assertEqual(config.resolve(self.config, self.config['ref_tags'])['names'], ['infra', 'b'])
+
+        plain = {'a': [1, 2]}
+        self.assertIs(config.resolve(self.config, plain), plain)
+
+    def test_lazy_lookup_without_helper(self):
+        with self.assertRaises(ConfigError):
+            config.resolve(self.config, self.config['coreos_ami'])
+
+    def test_lazy_circular_ref(self):
+        self.config['a'] = config.LazyValue('!ref', ['b'])
+        self.config['b'] = config.LazyValue('!ref', ['a'])
+        with self.assertRaises(ConfigError):
+            config.resolve(self.config, self.config['a'])
+
+
 class TestPrintConfig(unittest.TestCase):
     def test_print_config(self):
         config_file = 'tests/fixtures/config_flat.yaml'
@@ -0,0 +1,69 @@
+import json
+import unittest
+from datetime import datetime, timedelta
+
+from stacks import durations
+from tests.helpers import isolate_cache
+
+START = datetime(2017, 1, 1)
+
+
+def event(minutes, logical_id, status, rtype='AWS::EC2::Instance'):
+    return {'timestamp': START + timedelta(minutes=minutes), 'logical_resource_id': logical_id,
+            'resource_status': status, 'resource_type': rtype}
+
+
+DEPLOY = [
+    event(0, 'app', 'UPDATE_IN_PROGRESS', 'AWS::CloudFormation::Stack'),
+    event(1, 'Instance', 'CREATE_IN_PROGRESS'),
+    event(1, 'Db', 'UPDATE_IN_PROGRESS', 'AWS::RDS::DBInstance'),
+    event(1, 'Instance', 'CREATE_IN_PROGRESS'),
+    event(4, 'Instance', 'CREATE_COMPLETE'),
+    event(11, 'Db', 'UPDATE_COMPLETE', 'AWS::RDS::DBInstance'),
+    event(12, 'app', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'AWS::CloudFormation::Stack'),
+    event(12, 'app', 'UPDATE_COMPLETE', 'AWS::CloudFormation::Stack'),
+]
+
+
+class TestDurations(unittest.TestCase):
+
+    def setUp(self):
+        isolate_cache(self)
+
+    def test_tracker(self):
+        tracker = durations.Tracker('app')
+        tracker.observe(DEPLOY)
+        self.assertEqual(sorted(tracker.durations), [
+            ('AWS::CloudFormation::Stack', 'UPDATE', 720),
+            ('AWS::EC2::Instance', 'CREATE', 180),
+            ('AWS::RDS::DBInstance', 'UPDATE', 600),
+        ])
+        self.assertEqual(tracker.started, {})
+
+    def test_history(self):
+        for _ in range(2):
+            tracker = durations.Tracker('app', durations.load('eu-west-1'))
+            tracker.observe(DEPLOY)
+            tracker.save('eu-west-1')
+        history = durations.load('eu-west-1')
+        self.assertEqual(history['app']['AWS::RDS::DBInstance']['UPDATE'], {'count': 2, 'mean': 600, 'max': 600})
+        rows = durations.rows(history)
+        self.assertEqual(rows[0][:4], ['app', 'AWS::CloudFormation::Stack', 'UPDATE', 2])
+        self.assertEqual(json.loads(durations.format_rows(history, 'other-*', 'json')), [])
+
+        # Another stack falls back to durations of the same resource types
+        tracker = durations.Tracker('other', history)
+        tracker.observe(DEPLOY[:3])
+        self.assertEqual(tracker.remaining(START + timedelta(minutes=5)), 420)
+        self.assertEqual(tracker.slow(START + timedelta(minutes=5)), [])
+        slow = tracker.slow(START + timedelta(minutes=30))
+        self.assertEqual([s[0] for s in slow], ['Db', 'Instance', 'app'])
+
+    def test_format_seconds(self):
+        self.assertEqual(durations.format_seconds(12.4), '12s')
+        self.assertEqual(durations.format_seconds(245), '4m05s')
+        self.assertEqual(durations.format_seconds(3720), '1h02m')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import date
+
+from stacks import cache
+from stacks import index
+from stacks.config import LazyValue
+from stacks.exceptions import TemplateError
+from tests.helpers import isolate_cache
+
+
+class TestHeaderSource(unittest.TestCase):
+
+    def test_header_source(self):
+        self.assertEqual(index.header_source('---\nname: a\n---\nResources: {}\n'), '\nname: a\n')
+        self.assertEqual(index.header_source('name: a\n---\nResources: {}\n'), 'name: a\n')
+
+    def test_header_source_single_document(self):
+        self.assertIsNone(index.header_source('---\nResources: {}\n'))
+        self.assertIsNone(index.header_source('Resources: {}\n'))
+
+
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        isolate_cache(self)
+        self.tpl_dir = tempfile.mkdtemp()
+        self.write('tags.yaml', "{% macro tags(name) %}[{key: Name, value: {{ name }}}]{% endmacro %}\n")
+        self.write('vpc.yaml', "{% from 'tags.yaml' import tags %}\n"
+                               "---\nname: {{ env }}-vpc\ntags: {{ tags(env) }}\n---\n"
+                               "Resources:\n  VPC:\n    Type: AWS::EC2::VPC\n"
+                               "    Properties:\n      CidrBlock: {{ cidr }}\n")
+        self.write('sg.yaml', "---\nname: {{ env }}-sg\n---\nResources:\n  SG:\n    Type: AWS::EC2::SecurityGroup\n")
+        self.write('plain.yaml', "Resources:\n  SG:\n    Type: AWS::EC2::SecurityGroup\n")
+        self.config = {'env': 'dev'}
+
+    def tearDown(self):
+        shutil.rmtree(self.tpl_dir)
+
+    def write(self, fname, content):
+        with open(os.path.join(self.tpl_dir, fname), 'w') as f:
+            f.write(content)
+
+    def tpl(self, fname):
+        return os.path.join(self.tpl_dir, fname)
+
+    def test_template_metadata_renders_header_only(self):
+        # cidr is only used by the template body
+        metadata = index.template_metadata(self.tpl('vpc.yaml'), self.config)
+        self.assertEqual(metadata, {'name': 'dev-vpc', 'tags': [{'key': 'Name', 'value': 'dev'}]})
+
+    def test_template_metadata_cached(self):
+        index.template_metadata(self.tpl('sg.yaml'), self.config)
+        self.assertEqual(len(os.listdir(os.path.join(cache.CACHE_DIR, index.INDEX_DIR))), 1)
+        index.template_metadata(self.tpl('sg.yaml'), {'env': 'prod'})
+        self.assertEqual(len(os.listdir(os.path.join(cache.CACHE_DIR, index.INDEX_DIR))), 2)
+
+        # A changed include changes the key
+        self.write('tags.yaml', "{% macro tags(name) %}[{key: Env, value: {{ name }}}]{% endmacro %}\n")
+        metadata = index.template_metadata(self.tpl('vpc.yaml'), self.config)
+        self.assertEqual(metadata['tags'], [{'key': 'Env', 'value': 'dev'}])
+
+    def test_template_metadata_lazy_values(self):
+        self.config['env'] = LazyValue('!ref', ['stage'])
+        self.config['stage'] = 'dev'
+        self.assertEqual(index.template_metadata(self.tpl('sg.yaml'), self.config)['name'], 'dev-sg')
+        # A changed value referenced by the header is a cache miss
+        self.config['stage'] = 'prod'
+        self.assertEqual(index.template_metadata(self.tpl('sg.yaml'), self.config)['name'], 'prod-sg')
+
+    def test_template_metadata_non_json_values(self):
+        self.config['env'] = date(2026, 1, 1)
+        self.assertEqual(index.template_metadata(self.tpl('sg.yaml'), self.config)['name'], '2026-01-01-sg')
+        self.config['env'] = date(2026, 2, 1)
+        self.assertEqual(index.template_metadata(self.tpl('sg.yaml'), self.config)['name'], '2026-02-01-sg')
+
+    def test_template_metadata_lookups_not_cached(self):
+        self.config['env'] = LazyValue('!stack_output', ['infra', 'Env'])
+        self.config['cf_conn'] = None
+        for env in ['dev', 'prod']:
+            self.config['get_stack_output'] = lambda conn, stack, key: env
+            self.assertEqual(index.template_metadata(self.tpl('sg.yaml'), self.config)['name'], env + '-sg')
+        self.assertFalse(os.path.exists(os.path.join(cache.CACHE_DIR, index.INDEX_DIR)))
+
+    def test_template_metadata_missing_properties(self):
+        with self.assertRaises(TemplateError):
+            index.template_metadata(self.tpl('sg.yaml'), {})
+
+    def test_template_metadata_without_metadata(self):
+        self.assertIsNone(index.template_metadata(self.tpl('plain.yaml'), self.config))
+
+    def test_build_index_and_find(self):
+        entries = index.build_index(index.template_files([self.tpl_dir]), self.config, jobs=2)
+        self.assertEqual(len(entries), 4)
+        self.assertEqual([e['name'] for e in index.find(entries, 'dev-*')], ['dev-sg', 'dev-vpc'])
+        self.assertEqual([e['template'] for e in index.find(entries, 'dev-vpc')], [self.tpl('vpc.yaml')])
+
+        changed = index.find(entries, changed=[self.tpl('tags.yaml')])
+        self.assertEqual([e['name'] for e in changed], ['dev-vpc'])
+
+
+if __name__ == '__main__':
+    unittest.main()
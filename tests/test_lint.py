@@ -0,0 +1,55 @@
+import unittest
+
+from stacks import cf
+from stacks import lint
+from stacks import render
+from stacks.exceptions import TemplateError
+
+
+class TestLint(unittest.TestCase):
+
+    def lint_fixture(self, fname):
+        config = render.offline_config('dev', 'tests/fixtures/config_flat.yaml', properties={'test_tag': 'test'})
+        with open(fname) as tpl_file:
+            return cf.lint_template(tpl_file, config)
+
+    def test_valid_template(self):
+        self.assertEqual(self.lint_fixture('tests/fixtures/valid_template.yaml'), [])
+
+    def test_lint_template(self):
+        problems = self.lint_fixture('tests/fixtures/lint_template.yaml')
+        messages = set((p['severity'], p['location'], p['message']) for p in problems)
+        self.assertEqual(messages, {
+            ('error', 'rendered line 27', 'SubnetA is defined more than once'),
+            ('error', 'Resources/SubnetA', 'Ref of undefined VPC'),
+            ('error', 'Resources/SubnetB', 'Ref of undefined VPC'),
+            ('error', 'Resources/Queue', 'Fn::GetAtt of undefined resource DeadLetter'),
+            ('error', 'Resources/Queue', 'Circular dependency: Queue -> Topic -> Queue'),
+            ('warning', 'Parameters/Unused', 'Parameter is never referenced'),
+        })
+
+    def test_create_stack_lint_first(self):
+        config = render.offline_config('dev', 'tests/fixtures/config_flat.yaml')
+        with open('tests/fixtures/lint_template.yaml') as tpl_file:
+            with self.assertRaises(TemplateError):
+                cf.create_stack(None, None, tpl_file, config, dry=True, lint_first=True)
+
+    def test_references(self):
+        value = {'Fn::Join': ['', [{'Ref': 'A'}, {'Fn::GetAtt': ['B', 'Arn']},
+                                   {'Fn::Sub': ['${C}-${D.Name}-${!Literal}-${E}', {'E': {'Ref': 'F'}}]}]]}
+        self.assertEqual(sorted(lint.references(value)), [
+            ('Fn::GetAtt', 'B', 'Arn'),
+            ('Fn::GetAtt', 'D', 'Name'),
+            ('Fn::Sub', 'C', None),
+            ('Ref', 'A', None),
+            ('Ref', 'F', None),
+        ])
+
+    def test_lint_matrix(self):
+        results = render.lint_matrix(['tests/fixtures/valid_template.yaml', 'tests/fixtures/lint_template.yaml'],
+                                     ['dev'], properties={'test_tag': 'test'}, jobs=2)
+        self.assertEqual([len(lint.errors(r['problems'])) for r in results], [0, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+
+from stacks import aws
+from stacks import cf
+from stacks.exceptions import LookupFailedError
+from tests.helpers import FakeCFConnection, FakePage, isolate_cache
+
+
+class FakeRegion(object):
+    name = 'eu-west-1'
+
+
+class FakeExportsConnection(FakeCFConnection):
+    """Serves ListExports, one export per page"""
+    region = FakeRegion()
+    profile_name = None
+
+    def __init__(self, stacks, exports):
+        super(FakeExportsConnection, self).__init__(stacks)
+        self.exports = exports
+        self.list_calls = 0
+
+    def get_list(self, action, params, markers):
+        self.list_calls += 1
+        n = int(params.get('NextToken', 0))
+        page = FakePage()
+        for name, (value, stack_name) in sorted(self.exports.items())[n:n + 1]:
+            export = aws.Export()
+            export.endElement('ExportingStackId', 'arn:aws:cloudformation:eu-west-1:123:stack/{}/1'.format(stack_name),
+                              None)
+            export.endElement('Name', name, None)
+            export.endElement('Value', value, None)
+            page.append(export)
+        if n + 1 < len(self.exports):
+            page.next_token = str(n + 1)
+        return page
+
+
+class TestExports(unittest.TestCase):
+
+    def setUp(self):
+        aws.reset_exports()
+        isolate_cache(self)
+        self.conn = FakeExportsConnection({'infra': {'VpcId': 'vpc-123'}}, {
+            'infra-VpcId': ('vpc-123', 'infra'),
+            'shared-zone': ('Z123', 'dns'),
+        })
+
+    def tearDown(self):
+        aws.reset_exports()
+        aws.EXPORTS_TTL = 0
+
+    def test_get_export(self):
+        self.assertEqual(aws.get_export(self.conn, 'shared-zone'), 'Z123')
+        self.assertEqual(aws.get_export(self.conn, 'infra-VpcId'), 'vpc-123')
+        self.assertEqual(self.conn.list_calls, 2)
+        with self.assertRaises(LookupFailedError):
+            aws.get_export(self.conn, 'missing')
+
+    def test_stack_output_not_from_index(self):
+        aws.get_export(self.conn, 'shared-zone')
+        # Outputs are described even if they are exported
+        self.assertEqual(aws.get_stack_output(self.conn, 'infra', 'VpcId'), 'vpc-123')
+        self.assertEqual(self.conn.calls, 1)
+
+    def test_exports_ttl(self):
+        aws.EXPORTS_TTL = 60
+        aws.get_export(self.conn, 'shared-zone')
+        aws.reset_exports()
+        self.assertEqual(aws.get_export(self.conn, 'shared-zone'), 'Z123')
+        self.assertEqual(self.conn.list_calls, 2)
+
+
+class TestParallelLookups(unittest.TestCase):
+
+    def setUp(self):
+        self.cf_conn = FakeCFConnection({
+            'infra': {'SubnetAZ0': 'subnet-123', 'SecurityGroup': 'sg-123'},
+        })
+        self.ami_calls = []
+
+        def get_ami_id(conn, name):
+            self.ami_calls.append(name)
+            return 'ami-123'
+
+        self.config = {
+            'env': 'dev',
+            'cf_conn': self.cf_conn,
+            'ec2_conn': None,
+            'get_ami_id': get_ami_id,
+            'get_stack_output': aws.get_stack_output,
+        }
+
+    def test_parallel_lookups_match_sequential(self):
+        with open('tests/fixtures/lookups_template.yaml') as tpl_file:
+            expected = cf.gen_template(tpl_file, self.config)
+        with open('tests/fixtures/lookups_template.yaml') as tpl_file:
+            tpl = cf.gen_template(tpl_file, self.config, parallel_lookups=True)
+        self.assertEqual(expected, tpl)
+
+    def test_parallel_lookups_group_stack_calls(self):
+        with open('tests/fixtures/lookups_template.yaml') as tpl_file:
+            cf.gen_template(tpl_file, self.config, parallel_lookups=True)
+        self.assertEqual(self.cf_conn.calls, 1)
+        self.assertEqual(self.ami_calls, ['coreos'])
+
+    def test_parallel_lookups_missing_output(self):
+        del self.cf_conn.stacks['infra']['SecurityGroup']
+        with open('tests/fixtures/lookups_template.yaml') as tpl_file:
+            with self.assertRaises(RuntimeError):
+                cf.gen_template(tpl_file, self.config, parallel_lookups=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from boto.exception import BotoServerError
+
+from stacks import aws
+from stacks import metrics
+
+
+class FakeRequest(object):
+    def __init__(self, action):
+        self.params = {'Action': action}
+        self.method = 'POST'
+
+
+class FakeConnection(object):
+    def _mexe(self, request):
+        return request.params['Action']
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        metrics.reset()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_render_counter(self):
+        metrics.counter('stacks_test', 'Test counter').inc({'name': 'a"b'})
+        metrics.counter('stacks_test', 'Test counter').inc({'name': 'a"b'}, 2)
+        self.assertEqual(metrics.render(), '# HELP stacks_test Test counter\n'
+                                           '# TYPE stacks_test counter\n'
+                                           'stacks_test_total{name="a\\"b"} 3\n')
+
+    def test_render_histogram(self):
+        h = metrics.histogram('stacks_test_seconds', 'Test histogram', buckets=(1, 10))
+        for value in [0.5, 5, 50]:
+            h.observe(value)
+        lines = metrics.render().splitlines()
+        self.assertIn('stacks_test_seconds_bucket{le="1"} 1', lines)
+        self.assertIn('stacks_test_seconds_bucket{le="10"} 2', lines)
+        self.assertIn('stacks_test_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('stacks_test_seconds_sum 55.5', lines)
+        self.assertIn('stacks_test_seconds_count 3', lines)
+
+    def test_instrument(self):
+        conn = metrics.instrument(FakeConnection(), 'cloudformation')
+        self.assertEqual(conn._mexe(FakeRequest('DescribeStacks')), 'DescribeStacks')
+        conn._mexe(FakeRequest('DescribeStacks'))
+        self.assertIn('stacks_aws_requests_total{action="DescribeStacks",service="cloudformation"} 2',
+                      metrics.render().splitlines())
+
+    def test_throttling_retries(self):
+        calls = []
+
+        @aws.throttling_retry
+        def throttled():
+            calls.append(1)
+            if len(calls) < 2:
+                raise BotoServerError(400, 'Bad Request', body={'Error': {'Code': 'Throttling'}})
+
+        sleep = aws.time.sleep
+        aws.time.sleep = lambda _: None
+        try:
+            throttled()
+        finally:
+            aws.time.sleep = sleep
+        self.assertIn('stacks_throttle_retries_total{function="throttled"} 1', metrics.render().splitlines())
+
+    def test_write_textfile(self):
+        metrics.counter('stacks_test', 'Test counter').inc()
+        fname = os.path.join(self.tmp_dir, 'stacks.prom')
+        metrics.write_textfile(fname)
+        with open(fname) as f:
+            self.assertEqual(f.read(), metrics.render())
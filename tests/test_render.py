@@ -0,0 +1,114 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from stacks import render
+
+
+class TestRenderMatrix(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_render_matrix(self):
+        templates = ['tests/fixtures/valid_template.yaml', 'tests/fixtures/lookups_template.yaml']
+        envs = ['dev', 'prod']
+        results = render.render_matrix(templates, envs, self.output_dir,
+                                       properties={'test_tag': 'testing'}, jobs=2)
+        self.assertEqual(len(results), 4)
+        for r in results:
+            self.assertIsNone(r['error'])
+            self.assertTrue(os.path.isfile(r['file']))
+            self.assertEqual(r['size'], os.path.getsize(r['file']))
+
+        with open(os.path.join(self.output_dir, render.MANIFEST)) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest, results)
+
+    def test_render_matrix_offline_lookups(self):
+        results = render.render_matrix(['tests/fixtures/lookups_template.yaml'], ['dev'], self.output_dir)
+        with open(results[0]['file']) as f:
+            tpl = json.load(f)
+        props = tpl['Resources']['Instance']['Properties']
+        self.assertEqual(props['SubnetId'], 'get_stack_output:infra:SubnetAZ0')
+        self.assertEqual(results[0]['name'], 'dev-lookups')
+
+    def test_render_matrix_same_name(self):
+        tpl_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tpl_dir)
+        for d in ['a', 'b']:
+            os.makedirs(os.path.join(tpl_dir, d))
+            with open(os.path.join(tpl_dir, d, 'main.yaml'), 'w') as f:
+                f.write("Description: {{ '%s' }}\n" % d)
+        templates = [os.path.join(tpl_dir, d, 'main.yaml') for d in ['a', 'b']]
+        results = render.render_matrix(templates, ['dev'], self.output_dir)
+        self.assertEqual([r['file'] for r in results],
+                         [os.path.join(self.output_dir, 'dev', d, 'main.json') for d in ['a', 'b']])
+        for r, d in zip(results, ['a', 'b']):
+            with open(r['file']) as f:
+                self.assertEqual(json.load(f)['Description'], d)
+
+    def test_render_matrix_missing_properties(self):
+        results = render.render_matrix(['tests/fixtures/valid_template.yaml'], ['dev'], self.output_dir)
+        self.assertIsNotNone(results[0]['error'])
+
+
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.tpl_dir = tempfile.mkdtemp()
+        self.write('config.yaml', 'common:\n  cidr: 10.0.0.0/16\n')
+        self.write('tags.yaml', "{% macro tags(name) %}Tags: [{Key: Name, Value: {{ name }}}]{% endmacro %}\n")
+        self.write('vpc.yaml', "{% from 'tags.yaml' import tags %}\n"
+                               "Resources:\n  VPC:\n    Type: AWS::EC2::VPC\n    Properties:\n"
+                               "      CidrBlock: {{ cidr }}\n      {{ tags(env + '-vpc') }}\n")
+        self.write('sg.yaml', "Resources:\n  SG:\n    Type: AWS::EC2::SecurityGroup\n")
+        self.templates = [os.path.join(self.tpl_dir, t) for t in ['vpc.yaml', 'sg.yaml']]
+        self.watcher = render.Watcher(self.templates, ['dev'], self.output_dir,
+                                      config_file=os.path.join(self.tpl_dir, 'config.yaml'))
+        self.mtime = 1000000000
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+        shutil.rmtree(self.tpl_dir)
+
+    def write(self, fname, content):
+        fname = os.path.join(self.tpl_dir, fname)
+        with open(fname, 'w') as f:
+            f.write(content)
+        # Make sure the change is visible regardless of mtime resolution
+        if hasattr(self, 'mtime'):
+            self.mtime += 1
+            os.utime(fname, (self.mtime, self.mtime))
+
+    def test_render_all(self):
+        results = self.watcher.render_all()
+        self.assertEqual([r['template'] for r in results], self.templates)
+        self.assertTrue(all(r['error'] is None and r['diff'] is None for r in results))
+        self.assertEqual(self.watcher.poll(), [])
+
+    def test_snippet_change(self):
+        self.watcher.render_all()
+        self.write('tags.yaml', "{% macro tags(name) %}Tags: [{Key: Id, Value: {{ name }}}]{% endmacro %}\n")
+        results = self.watcher.poll()
+        self.assertEqual([r['template'] for r in results], self.templates[:1])
+        self.assertIn('+            "Key": "Id",', results[0]['diff'].splitlines())
+        self.assertEqual(self.watcher.poll(), [])
+
+    def test_config_change(self):
+        self.watcher.render_all()
+        self.write('config.yaml', 'common:\n  cidr: 10.1.0.0/16\n')
+        results = self.watcher.poll()
+        self.assertEqual(len(results), 2)
+        self.assertIn('10.1.0.0/16', results[0]['diff'])
+        self.assertEqual(results[1]['diff'], '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+from unittest import mock
+
+from stacks import rollout
+
+
+class TestRollout(unittest.TestCase):
+
+    def setUp(self):
+        self.targets = rollout.matrix(['staging', 'prod'], ['eu-west-1', 'us-east-1', 'ap-southeast-2'])
+
+    def result(self, target, status='UPDATE_COMPLETE', error=None):
+        return {'env': target[0], 'region': target[1], 'stack_name': target[0] + '-app', 'status': status,
+                'error': error, 'duration': 1.0}
+
+    def test_plan(self):
+        waves = rollout.plan(self.targets, canary=1, batch_size=2)
+        self.assertEqual([len(w) for w in waves], [1, 2, 2, 1])
+        self.assertEqual(waves[0], [('staging', 'eu-west-1')])
+        self.assertEqual(rollout.plan(self.targets, canary=0), [self.targets])
+
+    def test_rollout(self):
+        deployed = []
+
+        def deploy_target(target):
+            deployed.append(target)
+            return self.result(target)
+
+        report = mock.Mock()
+        results = rollout.rollout(rollout.plan(self.targets, 1, 3), deploy_target, report=report)
+        self.assertEqual(sorted(deployed), sorted(self.targets))
+        self.assertFalse(any(rollout.failed(r) for r in results))
+        self.assertEqual(report.call_count, 6)
+
+    def test_failure_budget(self):
+        def deploy_target(target):
+            if target[1] == 'us-east-1':
+                return self.result(target, 'UPDATE_ROLLBACK_COMPLETE')
+            return self.result(target)
+
+        waves = rollout.plan(self.targets, 1, 2)
+        results = rollout.rollout(waves, deploy_target, failure_budget=0)
+        self.assertEqual([r['status'] for r in results],
+                         ['UPDATE_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE', 'UPDATE_COMPLETE',
+                          'SKIPPED', 'SKIPPED', 'SKIPPED'])
+
+        results = rollout.rollout(waves, deploy_target, failure_budget=2)
+        self.assertNotIn(rollout.SKIPPED, [r['status'] for r in results])
+
+    def test_deploy_error(self):
+        # Fails rendering, valid_template requires a test_tag property
+        result = rollout.deploy(('dev', 'eu-west-1'), 'tests/fixtures/valid_template.yaml')
+        self.assertTrue(rollout.failed(result))
+        self.assertIsNotNone(result['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
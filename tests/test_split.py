@@ -0,0 +1,77 @@
+import json
+import unittest
+
+from stacks import split
+
+
+def chain_template(length):
+    """Return a template with a VPC and a chain of dependent resources"""
+    resources = {'VPC': {'Type': 'AWS::EC2::VPC', 'Properties': {'CidrBlock': {'Ref': 'Cidr'}}}}
+    previous = 'VPC'
+    for n in range(length):
+        name = 'SG{}'.format(n)
+        resources[name] = {
+            'Type': 'AWS::EC2::SecurityGroup',
+            'Properties': {
+                'VpcId': {'Ref': 'VPC'},
+                'GroupDescription': {'Fn::Sub': '${AWS::StackName} after ${' + previous + '}'},
+                'Tags': [{'Key': 'Previous', 'Value': {'Fn::GetAtt': [previous, 'GroupId']}}],
+            },
+        }
+        previous = name
+    for n in range(length):
+        resources['Bucket{}'.format(n)] = {'Type': 'AWS::S3::Bucket', 'Condition': 'IsProd'}
+    return {
+        'AWSTemplateFormatVersion': '2010-09-09',
+        'Parameters': {'Cidr': {'Type': 'String'}, 'Env': {'Type': 'String'}},
+        'Conditions': {'IsProd': {'Fn::Equals': [{'Ref': 'Env'}, 'prod']}},
+        'Resources': resources,
+        'Outputs': {'Last': {'Value': {'Ref': previous}}},
+    }
+
+
+class TestSplit(unittest.TestCase):
+
+    def test_needs_split(self):
+        self.assertFalse(split.needs_split(chain_template(10), 1000))
+        self.assertTrue(split.needs_split(chain_template(300), 1000))
+        self.assertTrue(split.needs_split(chain_template(1), split.MAX_TEMPLATE_SIZE + 1))
+
+    def test_partition_keeps_clusters_together(self):
+        resources = chain_template(5)['Resources']
+        partitions = split.partition(resources, max_resources=6)
+        self.assertIn(['VPC', 'SG0', 'SG1', 'SG2', 'SG3', 'SG4'], partitions)
+        self.assertEqual(sorted(sum(partitions, [])), sorted(resources))
+        self.assertTrue(all(len(p) <= 6 for p in partitions))
+
+    def test_split_template(self):
+        template = chain_template(25)
+        parent, children = split.split_template(template, max_resources=10)
+
+        names = sum([list(c['Resources']) for c in children.values()], [])
+        self.assertEqual(sorted(names), sorted(template['Resources']))
+        self.assertTrue(all(len(c['Resources']) <= 10 for c in children.values()))
+
+        for child, child_tpl in children.items():
+            body = json.dumps(child_tpl['Resources'])
+            params = parent['Resources'][child]['Properties'].get('Parameters', {})
+            self.assertEqual(set(params), set(child_tpl.get('Parameters', {})))
+            for name in template['Resources']:
+                if name not in child_tpl['Resources']:
+                    self.assertNotIn('"Ref": "{}"'.format(name), body)
+                    self.assertNotIn('${' + name + '}', body)
+            for value in params.values():
+                if 'Fn::GetAtt' in value:
+                    self.assertIn(value['Fn::GetAtt'][0], children)
+                    self.assertLess(int(value['Fn::GetAtt'][0][5:]), int(child[5:]))
+            if any(r.get('Condition') for r in child_tpl['Resources'].values()):
+                self.assertIn('IsProd', child_tpl['Conditions'])
+                self.assertIn('Env', params)
+
+        last = parent['Outputs']['Last']['Value']['Fn::GetAtt']
+        self.assertEqual(last[1], 'Outputs.SG24Ref')
+        self.assertIn('SG24Ref', children[last[0]]['Outputs'])
+
+
+if __name__ == '__main__':
+    unittest.main()